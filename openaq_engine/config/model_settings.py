@@ -1,12 +1,31 @@
 import os
 from dataclasses import field
-from typing import Any, Dict, List, Sequence
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Union
 
-import boto3
 from pydantic import StrictStr
 from pydantic.dataclasses import dataclass
 
 
+@lru_cache(maxsize=None)
+def s3_resource():
+    """Created on first use, so importing the settings never resolves credentials"""
+    import boto3
+
+    return boto3.resource("s3")
+
+
+@dataclass
+class ExecutorConfig:
+    # "serial", "threads" for I/O-bound stages, "processes" or "loky"
+    # for CPU-bound ones
+    BACKEND: str = "loky"
+    N_JOBS: int = -1
+    CHUNK_SIZE: int = 1
+    # arrays above this size are memmapped to process workers
+    MAX_NBYTES: Optional[str] = "1M"
+
+
 @dataclass
 class BuildFeaturesConfig:
     TARGET_COL: str = "value"
@@ -28,11 +47,79 @@ class BuildFeaturesConfig:
         ]
     )
     SATELLITE_FEATURES = []
+    # see NeighborFeaturesConfig
+    NEIGHBOR_FEATURES: List[StrictStr] = field(
+        default_factory=lambda: [
+            "knn_mean",
+            "knn_idw",
+            "knn_distance_km",
+            "radius_count",
+            "radius_mean",
+            "radius_idw",
+        ]
+    )
+    STORE_DIR: str = "data/intermediate"
+    # build features one stored record batch at a time
+    OUT_OF_CORE: bool = False
+    # float32 feature matrices per cohort and the category dictionaries
+    MATRIX_DIR: str = "data/matrices"
+    # features kept between runs per feature set version, None to recompute
+    FEATURE_STORE_DIR: Optional[str] = "data/feature_store"
 
     @property
     def ALL_MODEL_FEATURES(self) -> List[str]:
         """Return all features to be fed into the model"""
-        return list(set(self.CORE_FEATURES + self.CATEGORICAL_FEATURES))
+        return list(
+            set(
+                self.CORE_FEATURES
+                + self.CATEGORICAL_FEATURES
+                + self.NEIGHBOR_FEATURES
+                + TemporalFeaturesConfig().FEATURE_NAMES
+            )
+        )
+
+
+@dataclass
+class NeighborFeaturesConfig:
+    DATE_COL: str = "timestamp_utc"
+    TARGET_COL: str = "value"
+    # neighbors are the other sensors measuring the same parameter that day
+    K_NEIGHBORS: int = 8
+    RADIUS_KM: float = 50.0
+    # floor on inverse distance weights, for sensors at the same site
+    MIN_DISTANCE_KM: float = 0.1
+
+
+@dataclass
+class TemporalFeaturesConfig:
+    DATE_COL: str = "timestamp_utc"
+    TARGET_COL: str = "value"
+    ENTITY_COLS: List[StrictStr] = field(
+        default_factory=lambda: ["parameter", "location"]
+    )
+    # readings are resampled to this grid, lags and windows count its steps
+    FREQ: str = "1h"
+    LAGS: List[int] = field(default_factory=lambda: [1, 2, 3, 24, 168])
+    ROLLING_WINDOWS: List[int] = field(default_factory=lambda: [3, 24, 168])
+    # any of "mean", "std", "max" and "count"
+    ROLLING_STATS: List[StrictStr] = field(
+        default_factory=lambda: ["mean", "std", "max"]
+    )
+    # "diurnal" by hour of day, "weekly" by day of week
+    PROFILES: List[StrictStr] = field(default_factory=lambda: ["diurnal", "weekly"])
+
+    @property
+    def FEATURE_NAMES(self) -> List[str]:
+        return (
+            [f"lag_{lag}" for lag in self.LAGS]
+            + [
+                f"rolling_{window}_{stat}"
+                for window in self.ROLLING_WINDOWS
+                for stat in self.ROLLING_STATS
+            ]
+            + [f"{profile}_mean" for profile in self.PROFILES]
+            + ["gap_steps"]
+        )
 
 
 @dataclass
@@ -84,6 +171,10 @@ class EEConfig:
     BUCKET_NAME = "earthengine-bucket"
     PATH_TO_PRIVATE_KEY = "private_keys/unicef-367711-29676476912d.json"
     SERVICE_ACCOUNT = "earth-engine@unicef-367711.iam.gserviceaccount.com"
+    # one getRegion request per location and collection, latency bound
+    EXECUTOR: ExecutorConfig = field(
+        default_factory=lambda: ExecutorConfig(BACKEND="threads", N_JOBS=16)
+    )
 
     @property
     def VARIABLE_SATELLITES(self) -> zip(List[str], List[str]):
@@ -133,6 +224,44 @@ class EEConfig:
         )
 
 
+@dataclass
+class ScanBudgetConfig:
+    # left out of the pipeline's stage fingerprints: they decide whether
+    # queries run, not what they return. The budget is ignored for a run
+    # with --ignore-scan-budget.
+    # refuse to submit a stage's athena queries estimated past this
+    MAX_SCAN_GB: float = field(default=100.0, metadata={"fingerprint": False})
+    # bytes scanned per table, calibrated from the queries run
+    STATS_PATH: str = field(
+        default="data/scan_stats.json", metadata={"fingerprint": False}
+    )
+
+
+@dataclass
+class SamplingConfig:
+    # about this fraction of the data for quick experiments, None for all
+    FRACTION: Optional[float] = None
+    # "hash" keeps the same locations on every run, "bernoulli" is
+    # athena's TABLESAMPLE, a different subset of rows on every run
+    METHOD: str = "hash"
+    ID_COL: str = "location"
+    # hash samples keep at least one location of each stratum,
+    # e.g. ["country", "sourcetype"]
+    STRATA: List[StrictStr] = field(default_factory=lambda: ["country"])
+    SEED: int = 0
+
+
+@dataclass
+class RegionConfig:
+    # keep measurements in any of these, None for anywhere
+    COUNTRIES: Optional[List[StrictStr]] = None
+    CITIES: Optional[List[StrictStr]] = None
+    # [min_longitude, min_latitude, max_longitude, max_latitude]
+    BBOX: Optional[List[float]] = None
+    # a GeoJSON file of polygons, kept on top of BBOX when both are set
+    GEOJSON_PATH: Optional[str] = None
+
+
 @dataclass
 class CohortBuilderConfig:
     ENTITY_ID_COLS: Sequence[str] = field(default_factory=lambda: ["unique_id"])
@@ -146,11 +275,82 @@ class CohortBuilderConfig:
             filter_non_null_values=["value"],
             filter_extreme_values=["value"],
             filter_no_coordinates=["coordinates"],
-            # filter_countries=["country"],
-            # filter_cities=["city"],
+            # the geographic filters only apply when REGION_FILTER sets them
+            filter_countries=["country"],
+            filter_cities=["city"],
+            filter_region=["coordinates"],
         ),
     )
-    POLLUTANT_TO_PREDICT = "pm25"
+    # a single pollutant or a list, queried together in one scan
+    POLLUTANT_TO_PREDICT: Union[StrictStr, List[StrictStr]] = "pm25"
+    # add the other pollutants at the same location and time as columns
+    CO_LOCATED_POLLUTANTS: bool = False
+    # partition column -> strftime format, coarsest first,
+    # e.g. {"year": "%Y", "month": "%m", "day": "%d"}
+    PARTITION_COLS: Dict[str, str] = field(default_factory=dict)
+    PARAMETER_PARTITION_COL: Optional[str] = None
+    # read cohorts from the table written by the `materialize` stage
+    USE_STAGING_TABLE: bool = False
+    STAGING_TABLE_NAME: str = "openaq_pm25_staging"
+    # only fetch measurements past the stored per-parameter watermark
+    INCREMENTAL: bool = False
+    # "none", "sql" (pushed into the cohort query) or "pandas"
+    AGGREGATION: str = "none"
+    EXPECTED_DAILY_READINGS: int = 24
+    # cohorts are handed to the next stage through local arrow files,
+    # postgres is an optional extra sink (always used when INCREMENTAL)
+    STORE_DIR: str = "data/intermediate"
+    WRITE_TO_DB: bool = False
+    # one athena query per window, mostly spent waiting on athena
+    ATHENA_EXECUTOR: ExecutorConfig = field(
+        default_factory=lambda: ExecutorConfig(BACKEND="threads", N_JOBS=8)
+    )
+    # row-wise preprocessing is CPU bound, one process per core
+    PREPROCESS_EXECUTOR: ExecutorConfig = field(default_factory=ExecutorConfig)
+    PREPROCESS_SHARD_ROWS: int = 100_000
+    # windows or batches waiting between the fetch, preprocess and load
+    # steps, which overlap on their own threads
+    STREAM_QUEUE_SIZE: int = 2
+    # stream athena results in bounded batches spilled to local parquet,
+    # for cohorts that don't fit in memory
+    OUT_OF_CORE: bool = False
+    # result rows fetched, preprocessed and loaded at a time in both modes
+    BATCH_ROWS: int = 500_000
+    SPILL_DIR: str = "data/spill"
+    # fail the stage past this resident size, leaving headroom on 16 GB
+    MAX_MEMORY_GB: float = 12.0
+    SAMPLING: SamplingConfig = field(default_factory=SamplingConfig)
+    REGION_FILTER: RegionConfig = field(default_factory=RegionConfig)
+    SCAN_BUDGET: ScanBudgetConfig = field(default_factory=ScanBudgetConfig)
+    S3_BUCKET = os.getenv("S3_BUCKET_OPENAQ")
+    S3_OUTPUT = os.getenv("S3_OUTPUT_OPENAQ")
+
+
+@dataclass
+class MaterializeConfig:
+    DATE_COL: str = "date.utc"
+    SOURCE_TABLE_NAME: str = "openaq"
+    # the table and pollutants the cohort builder reads with USE_STAGING_TABLE
+    STAGING_TABLE_NAME: str = field(
+        default_factory=lambda: CohortBuilderConfig().STAGING_TABLE_NAME
+    )
+    POLLUTANT_TO_PREDICT: Union[StrictStr, List[StrictStr]] = field(
+        default_factory=lambda: CohortBuilderConfig().POLLUTANT_TO_PREDICT
+    )
+    HISTORY_START_DATE: str = "2015-06-01"
+    FILTERS: List[StrictStr] = field(
+        default_factory=lambda: [
+            "filter_pollutant",
+            "filter_non_null_values",
+            "filter_extreme_values",
+            "filter_no_coordinates",
+        ]
+    )
+    # partition layout of the source table, see CohortBuilderConfig
+    PARTITION_COLS: Dict[str, str] = field(default_factory=dict)
+    PARAMETER_PARTITION_COL: Optional[str] = None
+    REGION = "us-east-1"
+    DATABASE = os.getenv("DB_NAME_OPENAQ")
     S3_BUCKET = os.getenv("S3_BUCKET_OPENAQ")
     S3_OUTPUT = os.getenv("S3_OUTPUT_OPENAQ")
 
@@ -159,20 +359,71 @@ class CohortBuilderConfig:
 class TimeSplitterConfig:
     DATE_COL: str = "date.utc"
     TARGET_VARIABLE = "pm25"
+    # lengths are counted in WINDOW_UNIT, "months", "weeks" or "days":
+    # validation windows of WITHIN_WINDOW_SAMPLER end TIME_WINDOW_LENGTH
+    # apart, and training windows end GAP before them and expand back to
+    # the first date, or roll over TRAINING_WINDOW_LENGTH when it is set
     TIME_WINDOW_LENGTH: int = 12
     WITHIN_WINDOW_SAMPLER: int = 3
     WINDOW_COUNT: int = 3  # this will increase for more than one split
+    WINDOW_UNIT: str = "months"
+    TRAINING_WINDOW_LENGTH: Optional[int] = None
+    GAP: int = 0
     TABLE_NAME: str = "openaq"
+    # partition column -> strftime format, coarsest first,
+    # e.g. {"year": "%Y", "month": "%m", "day": "%d"}
+    PARTITION_COLS: Dict[str, str] = field(default_factory=dict)
+    PARAMETER_PARTITION_COL: Optional[str] = None
+    SCAN_BUDGET: ScanBudgetConfig = field(default_factory=ScanBudgetConfig)
     REGION = "us-east-1"
     DATABASE = os.getenv("DB_NAME_OPENAQ")
     AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
     AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
     S3_BUCKET = os.getenv("S3_BUCKET_OPENAQ")
     S3_OUTPUT = os.getenv("S3_OUTPUT_OPENAQ")
-    RESOURCE = boto3.resource("s3")
-    TRAIN_VALIDATION_DICT: Dict[str, List[Any]] = field(
-        default_factory=lambda: dict(
-            validation=[],
-            training=[],
-        )
-    )
+
+    @property
+    def RESOURCE(self):
+        return s3_resource()
+
+
+@dataclass
+class ModelRunnerConfig:
+    # where FeatureMatrixBuilder wrote the matrix, see BuildFeaturesConfig
+    MATRIX_DIR: str = "data/matrices"
+    N_ESTIMATORS: int = 100
+    MAX_DEPTH: Optional[int] = None
+    MIN_SAMPLES_LEAF: int = 1
+    RANDOM_STATE: int = 0
+    # threads per model, the executor runs cores // MODEL_N_JOBS splits
+    # at once when its N_JOBS is -1
+    MODEL_N_JOBS: int = 1
+    EXECUTOR: ExecutorConfig = field(default_factory=ExecutorConfig)
+    METRICS_TABLE: str = "model_metrics"
+
+
+@dataclass
+class PipelineConfig:
+    ARTIFACT_DIR: str = "artifacts"
+
+
+@dataclass
+class BackendConfig:
+    # "aws" or "fake": the fake athena replays responses recorded in
+    # ATHENA_RECORDINGS_DIR and computes the others with duckdb over
+    # FAKE_ATHENA_DATA_PATH, or FAKE_ATHENA_ROWS synthetic rows.
+    # With "aws", every page of successful responses is recorded there.
+    ATHENA_BACKEND: str = os.getenv("OPENAQ_ATHENA_BACKEND", "aws")
+    ATHENA_RECORDINGS_DIR: Optional[str] = os.getenv("OPENAQ_ATHENA_RECORDINGS_DIR")
+    FAKE_ATHENA_DATA_PATH: Optional[str] = None
+    FAKE_ATHENA_TABLE_NAME: str = "openaq"
+    FAKE_ATHENA_ROWS: int = 100_000
+    FAKE_ATHENA_QUEUE_SECONDS: float = 0.5
+    FAKE_ATHENA_EXECUTION_SECONDS: float = 2.0
+    FAKE_ATHENA_API_SECONDS: float = 0.05
+    FAKE_ATHENA_FAILURE_RATE: float = 0.0
+    # "earthengine" or "fake", answering getRegion from synthetic rasters
+    EE_BACKEND: str = os.getenv("OPENAQ_EE_BACKEND", "earthengine")
+    FAKE_EE_LATENCY_SECONDS: float = 0.2
+    FAKE_EE_QUOTA_PER_MINUTE: int = 0  # 0 for no quota
+    FAKE_SEED: int = 0
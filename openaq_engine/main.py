@@ -1,31 +1,52 @@
+import os
+
 import click
-from setup_environment import get_dbengine
-from src.cohort_builder import CohortBuilder
-from src.features.build_features import BuildFeaturesRandomForest
-from src.time_splitter import TimeSplitter
+from src.utils.instrumentation import profile_run
 
 from config.model_settings import (
     BuildFeaturesConfig,
     CohortBuilderConfig,
+    MaterializeConfig,
+    ModelRunnerConfig,
+    PipelineConfig,
     TimeSplitterConfig,
 )
 
+# stage modules pull in pandas, boto3, shapely, joblib and earth engine,
+# so they are imported by the subcommand that needs them
+
 
 class TimeSplitterFlow:
     def __init__(self) -> None:
         self.config = TimeSplitterConfig()
 
     def execute(self):
+        from src.time_splitter import TimeSplitter
+
         return TimeSplitter.from_dataclass_config(
             self.config,
         )
 
 
-class CohortBuilderFlow:
+class MaterializeFlow:
     def __init__(self):
-        self.config = CohortBuilderConfig()
+        self.config = MaterializeConfig()
+
+    def execute(self):
+        from src.materialize import Materialize
+
+        return Materialize.from_dataclass_config(
+            self.config,
+        )
+
+
+class CohortBuilderFlow:
+    def __init__(self, incremental: bool = False):
+        self.config = CohortBuilderConfig(INCREMENTAL=incremental)
 
     def execute(self):
+        from src.cohort_builder import CohortBuilder
+
         return CohortBuilder.from_dataclass_config(
             self.config,
         )
@@ -36,57 +57,231 @@ class BuildFeaturesFlow:
         self.config = BuildFeaturesConfig()
 
     def execute(self):
+        from src.features.build_features import BuildFeaturesRandomForest
+
         # Trigger the authentication flow.
         return BuildFeaturesRandomForest.from_dataclass_config(self.config)
 
 
+class ModelRunnerFlow:
+    def __init__(self):
+        self.config = ModelRunnerConfig()
+
+    def execute(self):
+        from src.model_runner import ModelRunner
+
+        return ModelRunner.from_dataclass_config(self.config)
+
+
 @click.command("time-splitter", help="Splits csvs for time splits")
 def time_splitter():
     time_splitter = TimeSplitterFlow().execute()
     time_splitter.execute()
 
 
+@click.command(
+    "materialize", help="Create or refresh the pre-filtered pollutant staging table"
+)
+def materialize():
+    materialize = MaterializeFlow().execute()
+    materialize.execute()
+
+
 @click.command("cohort-builder", help="Generate cohorts for time splits")
-def cohort_builder():
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only fetch measurements newer than the last cohort build",
+)
+def cohort_builder(incremental):
+    from setup_environment import get_dbengine
+    from src.time_splitter import to_train_validation_dict
+
     # initialize engine
     engine = get_dbengine()
     time_splitter = TimeSplitterFlow().execute()
-    train_validation_dict = time_splitter.execute()
+    splits = time_splitter.execute()
 
-    cohort_builder = CohortBuilderFlow().execute()
-    cohort_builder.execute(train_validation_dict, engine)
+    cohort_builder = CohortBuilderFlow(incremental).execute()
+    cohort_builder.execute(to_train_validation_dict(splits), engine)
 
 
 @click.command("feature-builder", help="Generate features for cohorts")
 def feature_builder():
-    engine = get_dbengine()
-
     build_features = BuildFeaturesFlow().execute()
-    build_features.execute(engine)
+    build_features.execute()
+
+
+@click.command("model-runner", help="Train and evaluate models on every time split")
+def model_runner():
+    from setup_environment import get_dbengine
+
+    model_runner = ModelRunnerFlow().execute()
+    model_runner.execute(engine=get_dbengine())
+
+
+class PipelineFlow:
+    def __init__(self):
+        self.config = PipelineConfig()
+
+    def execute(self, engine):
+        from src.cohort_builder import CohortBuilder
+        from src.cohort_store import CohortStore
+        from src.features.build_features import BuildFeaturesRandomForest
+        from src.features.feature_matrix import FeatureMatrixBuilder
+        from src.model_runner import ModelRunner
+        from src.pipeline import (
+            PipelineRunner,
+            Stage,
+            cohort_store_to_frames,
+            features_to_frames,
+            frames_to_cohort_store,
+            frames_to_features,
+            frames_to_matrices,
+            frames_to_metrics,
+            frames_to_windows,
+            matrices_to_frames,
+            metrics_to_frames,
+            windows_to_frames,
+        )
+        from src.preprocess import Preprocess
+        from src.time_splitter import TimeSplitter, to_train_validation_dict
+
+        time_splitter_flow = TimeSplitterFlow()
+        cohort_builder_flow = CohortBuilderFlow()
+        build_features_flow = BuildFeaturesFlow()
+        model_runner_flow = ModelRunnerFlow()
+
+        def build_cohorts(splits):
+            if cohort_builder_flow.config.USE_STAGING_TABLE:
+                MaterializeFlow().execute().execute()
+            return cohort_builder_flow.execute().execute(
+                to_train_validation_dict(splits), engine
+            )
+
+        return (
+            PipelineRunner.from_dataclass_config(self.config)
+            .add_stage(
+                Stage(
+                    "time-splitter",
+                    time_splitter_flow.config,
+                    lambda: time_splitter_flow.execute().execute(),
+                    windows_to_frames,
+                    frames_to_windows,
+                    code=[TimeSplitter],
+                    always_run=True,
+                )
+            )
+            .add_stage(
+                Stage(
+                    "cohort-builder",
+                    cohort_builder_flow.config,
+                    build_cohorts,
+                    cohort_store_to_frames,
+                    frames_to_cohort_store,
+                    upstream=["time-splitter"],
+                    code=[CohortBuilder, CohortStore, Preprocess],
+                )
+            )
+            .add_stage(
+                Stage(
+                    "feature-builder",
+                    build_features_flow.config,
+                    # out of core cohorts only hand over their definitions,
+                    # the features stream the stored measurements instead
+                    lambda cohort_store: build_features_flow.execute().execute(
+                        None
+                        if cohort_builder_flow.config.OUT_OF_CORE
+                        else cohort_store.measurements_df
+                    ),
+                    features_to_frames,
+                    frames_to_features,
+                    upstream=["cohort-builder"],
+                    code=[BuildFeaturesRandomForest],
+                )
+            )
+            .add_stage(
+                Stage(
+                    "feature-matrix",
+                    build_features_flow.config,
+                    lambda cohort_store, features_df: (
+                        FeatureMatrixBuilder.from_dataclass_config(
+                            build_features_flow.config
+                        ).execute(
+                            cohort_store.cohort_definitions_df,
+                            features_df,
+                            None
+                            if features_df is None
+                            else cohort_store.measurements_df[
+                                build_features_flow.config.TARGET_COL
+                            ],
+                        )
+                    ),
+                    matrices_to_frames,
+                    frames_to_matrices,
+                    upstream=["cohort-builder", "feature-builder"],
+                    code=[FeatureMatrixBuilder],
+                )
+            )
+            .add_stage(
+                Stage(
+                    "model-runner",
+                    model_runner_flow.config,
+                    lambda cohorts_df: model_runner_flow.execute().execute(
+                        cohorts_df, engine
+                    ),
+                    metrics_to_frames,
+                    frames_to_metrics,
+                    upstream=["feature-matrix"],
+                    code=[ModelRunner],
+                )
+            )
+        )
 
 
 @click.command("run-pipeline", help="Run all pipeline")
-def run_pipeline():
+@click.option("--from-stage", help="Rerun from this stage, loading earlier ones")
+@click.option("--to-stage", help="Stop after this stage")
+@click.option("--force", is_flag=True, help="Ignore cached stage artifacts")
+def run_pipeline(from_stage, to_stage, force):
+    from setup_environment import get_dbengine
+
     # initialize engine
     engine = get_dbengine()
-    time_splitter = TimeSplitterFlow().execute()
-    train_validation_dict = time_splitter.execute()
-
-    cohort_builder = CohortBuilderFlow().execute()
-    df = cohort_builder.execute(train_validation_dict, engine)
-    build_features = BuildFeaturesFlow().execute()
-    build_features.execute(df, save_images=False)
+    pipeline = PipelineFlow().execute(engine)
+    pipeline.execute(from_stage=from_stage, to_stage=to_stage, force=force)
 
 
 @click.group("openaq-engine", help="Library to query openaq data")
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Write a json run report and a cpu profile of the command",
+)
+@click.option(
+    "--profile-dir", default="profiles", help="Where to write the profiling output"
+)
+@click.option(
+    "--ignore-scan-budget",
+    is_flag=True,
+    help="Run athena queries estimated past ScanBudgetConfig.MAX_SCAN_GB",
+)
 @click.pass_context
-def cli(ctx):
-    ...
+def cli(ctx, profile, profile_dir, ignore_scan_budget):
+    if ignore_scan_budget:
+        # read by the ScanBudget of every stage the command runs, see
+        # src.query.scan_cost.IGNORE_BUDGET_ENV
+        os.environ["OPENAQ_IGNORE_SCAN_BUDGET"] = "1"
+    if profile:
+        ctx.with_resource(profile_run(profile_dir, ctx.invoked_subcommand))
 
 
 cli.add_command(time_splitter)
+cli.add_command(materialize)
 cli.add_command(cohort_builder)
 cli.add_command(feature_builder)
+cli.add_command(model_runner)
+cli.add_command(run_pipeline)
 
 
 if __name__ == "__main__":
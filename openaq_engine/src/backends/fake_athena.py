@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional
+
+import pandas as pd
+from src.backends.synthetic import openaq_frame
+
+from config.model_settings import BackendConfig
+
+# athena returns at most 1000 rows per get_query_results page
+PAGE_SIZE = 1000
+# executions whose results were never paged to the end, e.g. failed or
+# abandoned queries, are dropped oldest first past this many
+MAX_EXECUTIONS = 64
+
+
+def recording_path(recordings_dir: str, query: str) -> str:
+    return os.path.join(
+        recordings_dir, f"{hashlib.sha256(query.encode()).hexdigest()}.json"
+    )
+
+
+def record_response(
+    recordings_dir: str, query: str, responses: Iterable[Dict[str, Any]]
+):
+    """
+    Save the rows of every get_query_results page of a query so the fake
+    client can replay them, paged again `PAGE_SIZE` rows at a time.
+    """
+    rows = [row for response in responses for row in response["ResultSet"]["Rows"]]
+    os.makedirs(recordings_dir, exist_ok=True)
+    with open(recording_path(recordings_dir, query), "w") as f:
+        json.dump(dict(query=query, ResultSet=dict(Rows=rows)), f)
+
+
+@lru_cache(maxsize=None)
+def _duckdb_connection(data_path: Optional[str], table_name: str, rows: int, seed: int):
+    """
+    An in-memory duckdb database holding the raw measurements with the
+    `date` and `coordinates` row types, numeric `value` and boolean
+    `mobile` athena exposes, built once per process.
+    """
+    import duckdb
+
+    raw_df = pd.read_parquet(data_path) if data_path else openaq_frame(rows, seed)
+    connection = duckdb.connect()
+    connection.register("raw", raw_df)
+    connection.execute(
+        f"""create table "{table_name}" as select
+        {{'utc': regexp_extract(date, 'utc=([^,]*)', 1),
+        'local': regexp_extract(date, 'local=([^}}]*)', 1)}} as date,
+        * exclude (date, coordinates, value, mobile),
+        try_cast(value as double) as value,
+        try_cast(mobile as boolean) as mobile,
+        case when coordinates = '{{}}' then null else {{
+        'latitude': cast(regexp_extract(coordinates, 'latitude=([^,]*)', 1) as double),
+        'longitude': cast(regexp_extract(coordinates, 'longitude=([^}}]*)', 1)
+        as double)}} end as coordinates
+        from raw"""
+    )
+    connection.execute(
+        """create macro from_iso8601_timestamp(value) as
+        cast(replace(value, 'Z', '') as timestamp)"""
+    )
+    # deterministic like athena's, though not the same hash values
+    connection.execute("create macro to_utf8(value) as value")
+    connection.execute("create macro crc32(value) as hash(value) % 4294967296")
+    connection.unregister("raw")
+    return connection
+
+
+def _to_duckdb(query: str) -> str:
+    """Rewrite the athena syntax duckdb does not parse or has no macro for"""
+    return re.sub(
+        r"TABLESAMPLE\s+BERNOULLI\s*\(([^)]*)\)",
+        r"TABLESAMPLE \1% (bernoulli)",
+        query,
+        flags=re.IGNORECASE,
+    )
+
+
+def _athena_value(value: Any) -> Dict[str, str]:
+    """Render a value the way athena serialises it, nulls have no value"""
+    if value is None:
+        return {}
+    if isinstance(value, dict):
+        if all(field is None for field in value.values()):
+            return {"VarCharValue": "{}"}
+        fields = ", ".join(f"{key}={field}" for key, field in value.items())
+        return {"VarCharValue": f"{{{fields}}}"}
+    if isinstance(value, bool):
+        return {"VarCharValue": str(value).lower()}
+    if isinstance(value, datetime):
+        return {"VarCharValue": value.strftime("%Y-%m-%d %H:%M:%S.000 UTC")}
+    return {"VarCharValue": str(value)}
+
+
+class FakeAthenaClient:
+    """
+    Stand-in for the boto3 athena client used by `query_results`. Each
+    query is queued and then runs for the configured latencies, fails
+    with the configured rate, and its results are replayed from a
+    recording or computed with duckdb. An execution's results are
+    dropped once their last page is served.
+    """
+
+    # shared like athena's own state, so later clients can page results
+    executions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    lock = threading.Lock()
+
+    def __init__(
+        self,
+        recordings_dir: Optional[str],
+        data_path: Optional[str],
+        table_name: str,
+        rows: int,
+        queue_seconds: float,
+        execution_seconds: float,
+        api_seconds: float,
+        failure_rate: float,
+        seed: int,
+    ):
+        self.recordings_dir = recordings_dir
+        self.data_path = data_path
+        self.table_name = table_name
+        self.rows = rows
+        self.queue_seconds = queue_seconds
+        self.execution_seconds = execution_seconds
+        self.api_seconds = api_seconds
+        self.failure_rate = failure_rate
+        self.seed = seed
+
+    @classmethod
+    def from_dataclass_config(cls, config: BackendConfig) -> "FakeAthenaClient":
+        return cls(
+            recordings_dir=config.ATHENA_RECORDINGS_DIR,
+            data_path=config.FAKE_ATHENA_DATA_PATH,
+            table_name=config.FAKE_ATHENA_TABLE_NAME,
+            rows=config.FAKE_ATHENA_ROWS,
+            queue_seconds=config.FAKE_ATHENA_QUEUE_SECONDS,
+            execution_seconds=config.FAKE_ATHENA_EXECUTION_SECONDS,
+            api_seconds=config.FAKE_ATHENA_API_SECONDS,
+            failure_rate=config.FAKE_ATHENA_FAILURE_RATE,
+            seed=config.FAKE_SEED,
+        )
+
+    def start_query_execution(self, QueryString: str, **kwargs) -> Dict[str, Any]:
+        time.sleep(self.api_seconds)
+        query_execution_id = str(uuid.uuid4())
+        with self.lock:
+            self.executions[query_execution_id] = dict(
+                query=QueryString,
+                started=time.monotonic(),
+                failed=random.random() < self.failure_rate,
+                result=None,
+                scanned_bytes=0,
+            )
+            while len(self.executions) > MAX_EXECUTIONS:
+                self.executions.popitem(last=False)
+        return {"QueryExecutionId": query_execution_id}
+
+    def get_query_execution(self, QueryExecutionId: str) -> Dict[str, Any]:
+        time.sleep(self.api_seconds)
+        execution = self.executions[QueryExecutionId]
+        elapsed = time.monotonic() - execution["started"]
+        status: Dict[str, Any] = {}
+        if elapsed < self.queue_seconds:
+            status["State"] = "QUEUED"
+        elif elapsed < self.queue_seconds + self.execution_seconds:
+            status["State"] = "RUNNING"
+        elif execution["failed"]:
+            status.update(State="FAILED", StateChangeReason="Injected failure")
+        else:
+            try:
+                self._result(execution)
+                status["State"] = "SUCCEEDED"
+            except Exception as error:
+                status.update(State="FAILED", StateChangeReason=str(error))
+        return {
+            "QueryExecution": {
+                "QueryExecutionId": QueryExecutionId,
+                "Query": execution["query"],
+                "Status": status,
+                "Statistics": {
+                    "DataScannedInBytes": execution["scanned_bytes"],
+                    "EngineExecutionTimeInMillis": int(
+                        max(elapsed - self.queue_seconds, 0) * 1000
+                    ),
+                    "QueryQueueTimeInMillis": int(
+                        min(elapsed, self.queue_seconds) * 1000
+                    ),
+                },
+            }
+        }
+
+    def get_query_results(
+        self,
+        QueryExecutionId: str,
+        NextToken: Optional[str] = None,
+        MaxResults: int = PAGE_SIZE,
+    ) -> Dict[str, Any]:
+        time.sleep(self.api_seconds)
+        rows = self._result(self.executions[QueryExecutionId])
+        start = int(NextToken or 0)
+        end = start + min(MaxResults, PAGE_SIZE)
+        response: Dict[str, Any] = {"ResultSet": {"Rows": rows[start:end]}}
+        if end < len(rows):
+            response["NextToken"] = str(end)
+        else:
+            with self.lock:
+                self.executions.pop(QueryExecutionId, None)
+        return response
+
+    def _result(self, execution: Dict[str, Any]) -> List[Dict[str, Any]]:
+        if execution["result"] is None:
+            execution["result"] = self._replay(execution["query"])
+            if execution["result"] is None:
+                execution["result"] = self._compute(execution["query"])
+            # the size of the rows stands in for the bytes athena scans
+            execution["scanned_bytes"] = len(json.dumps(execution["result"]))
+        return execution["result"]
+
+    def _replay(self, query: str) -> Optional[List[Dict[str, Any]]]:
+        if not self.recordings_dir:
+            return None
+        path = recording_path(self.recordings_dir, query)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)["ResultSet"]["Rows"]
+
+    def _compute(self, query: str) -> List[Dict[str, Any]]:
+        cursor = _duckdb_connection(
+            self.data_path, self.table_name, self.rows, self.seed
+        ).cursor()
+        cursor.execute(_to_duckdb(query))
+        header = [column[0] for column in cursor.description]
+        return [{"Data": [{"VarCharValue": column} for column in header]}] + [
+            {"Data": [_athena_value(value) for value in values]}
+            for values in cursor.fetchall()
+        ]
@@ -0,0 +1,137 @@
+import time
+import zlib
+from collections import deque
+from typing import Any, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# the day of the single image in an unfiltered collection
+STATIC_IMAGE_DAY = "2020-01-01"
+
+
+class EEException(Exception):
+    ...
+
+
+class Date:
+    def __init__(self, day: Any):
+        self.timestamp = pd.Timestamp(day)
+
+    def advance(self, delta: float, unit: str) -> "Date":
+        return Date(self.timestamp + pd.Timedelta(**{f"{unit}s": delta}))
+
+
+class Geometry:
+    @staticmethod
+    def Point(lon: float, lat: float) -> Tuple[float, float]:
+        return lon, lat
+
+
+class _Region:
+    """The pending result of a getRegion call, evaluated by `getInfo`"""
+
+    def __init__(self, earth_engine: "FakeEarthEngine", rows: List[List[Any]]):
+        self.earth_engine = earth_engine
+        self.rows = rows
+
+    def getInfo(self) -> List[List[Any]]:
+        self.earth_engine.request()
+        return self.rows
+
+
+class _ImageCollection:
+    """Daily synthetic images, whose bands are smooth fields over space and time"""
+
+    def __init__(
+        self,
+        earth_engine: "FakeEarthEngine",
+        collection: str,
+        bands: Sequence[str] = (),
+        start: Date = None,
+        end: Date = None,
+    ):
+        self.earth_engine = earth_engine
+        self.collection = collection
+        self.bands = list(bands)
+        self.start = start
+        self.end = end
+
+    def select(self, bands: List[str]) -> "_ImageCollection":
+        return _ImageCollection(self.earth_engine, self.collection, bands)
+
+    def filterDate(self, start: Date, end: Date) -> "_ImageCollection":
+        return _ImageCollection(
+            self.earth_engine, self.collection, self.bands, start, end
+        )
+
+    def getRegion(self, point: Tuple[float, float], scale: float) -> _Region:
+        lon, lat = point
+        if self.start is None:
+            # an unfiltered collection, e.g. a static one, holds a single image
+            days = pd.DatetimeIndex([STATIC_IMAGE_DAY])
+        else:
+            days = pd.date_range(
+                self.start.timestamp.normalize(),
+                self.end.timestamp.normalize(),
+                freq="D",
+                inclusive="left",
+            )
+        phase = (zlib.crc32(self.collection.encode()) + self.earth_engine.seed) % 360
+        values = [
+            np.sin(np.radians(lat + phase + index * 30)) * np.cos(np.radians(lon))
+            + 0.5 * np.sin(2 * np.pi * days.dayofyear / 365.25 + index)
+            for index in range(len(self.bands))
+        ]
+        return _Region(
+            self.earth_engine,
+            [["id", "longitude", "latitude", "time", *self.bands]]
+            + [
+                [
+                    day.strftime("%Y%m%d"),
+                    lon,
+                    lat,
+                    int(day.timestamp() * 1000),
+                    *[float(band[position]) for band in values],
+                ]
+                for position, day in enumerate(days)
+            ],
+        )
+
+
+class FakeEarthEngine:
+    """
+    Stand-in for the parts of the `ee` module used by `EEFeatures`.
+    Every `getInfo` waits `latency_seconds`, and raises `EEException`
+    past `quota_per_minute` requests. The quota is shared by threads but
+    counted per process, as each process worker holds its own instance.
+    """
+
+    EEException = EEException
+    Date = Date
+    Geometry = Geometry
+
+    def __init__(self, latency_seconds: float, quota_per_minute: int, seed: int):
+        self.latency_seconds = latency_seconds
+        self.quota_per_minute = quota_per_minute
+        self.seed = seed
+        self.requests = deque()
+
+    def Authenticate(self):
+        ...
+
+    def Initialize(self):
+        ...
+
+    def ImageCollection(self, collection: str) -> _ImageCollection:
+        return _ImageCollection(self, collection)
+
+    def request(self):
+        now = time.monotonic()
+        while self.requests and now - self.requests[0] > 60:
+            self.requests.popleft()
+        if self.quota_per_minute and len(self.requests) >= self.quota_per_minute:
+            raise EEException("Too many concurrent aggregations.")
+        self.requests.append(now)
+        time.sleep(self.latency_seconds)
@@ -0,0 +1,81 @@
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+
+POLLUTANTS = ["pm25", "pm10", "no2", "o3", "so2", "co"]
+COUNTRIES = ["US", "IN", "GB", "FR", "DE", "CN", "BR", "ZA"]
+CITIES = ["Delhi", "London", "Paris", "Berlin", "Beijing", "Lagos", "Lima"]
+SOURCE_TYPES = ["government", "research", "other"]
+
+
+def openaq_frame(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Raw measurements as athena returns them, with the `date` and
+    `coordinates` row types serialised into `{key=value, ...}` strings.
+    A few rows carry missing coordinates, negative or extreme values.
+    """
+    rng = np.random.default_rng(seed)
+    n_locations = max(n_rows // 100, 1)
+    location = rng.integers(0, n_locations, n_rows)
+    latitude = rng.uniform(-60, 70, n_locations)[location].round(5)
+    longitude = rng.uniform(-180, 180, n_locations)[location].round(5)
+    timestamps = pd.Timestamp("2019-01-01") + pd.to_timedelta(
+        rng.integers(0, 4 * 365 * 24, n_rows), unit="h"
+    )
+    utc = timestamps.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    local = timestamps.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+    coordinates = pd.Series(
+        [
+            f"{{latitude={lat}, longitude={lon}}}"
+            for lat, lon in zip(latitude, longitude)
+        ]
+    )
+    coordinates[rng.random(n_rows) < 0.01] = "{}"
+    return pd.DataFrame(
+        dict(
+            date=[f"{{utc={u}, local={loc}}}" for u, loc in zip(utc, local)],
+            parameter=rng.choice(POLLUTANTS, n_rows),
+            location=[f"location_{index}" for index in location],
+            value=rng.normal(40, 60, n_rows).round(2).astype(str),
+            unit="µg/m³",
+            city=[
+                f"[{','.join(rng.choice(CITIES, size, replace=False))}]"
+                for size in rng.integers(1, 3, n_rows)
+            ],
+            country=[
+                f"[{','.join(rng.choice(COUNTRIES, size, replace=False))}]"
+                for size in rng.integers(1, 3, n_rows)
+            ],
+            coordinates=coordinates,
+            # a location keeps its source type, a few of them are mobile
+            sourcetype=rng.choice(SOURCE_TYPES, n_locations)[location],
+            mobile=np.where(rng.random(n_locations) < 0.05, "true", "false")[location],
+        )
+    )
+
+
+def athena_response(df: pd.DataFrame) -> Dict[str, Any]:
+    """A `get_query_results` response holding `df`, header row first"""
+
+    def row(values: List[Any]) -> Dict[str, Any]:
+        return {"Data": [{"VarCharValue": str(value)} for value in values]}
+
+    return {
+        "ResultSet": {
+            "Rows": [row(list(df.columns))]
+            + [row(values) for values in df.itertuples(index=False)]
+        }
+    }
+
+
+def ee_region_array(n_rows: int, bands: List[str], seed: int = 0) -> List[List[Any]]:
+    """An `ee.Image.getRegion(...).getInfo()` array, header row first"""
+    rng = np.random.default_rng(seed)
+    times = 1609459200000 + rng.integers(0, 365, n_rows) * 86400000
+    values = rng.normal(size=(n_rows, len(bands)))
+    values[rng.random(values.shape) < 0.05] = np.nan
+    return [["id", "longitude", "latitude", "time", *bands]] + [
+        [f"image_{index}", 12.5, 41.9, int(time), *band_values]
+        for index, (time, band_values) in enumerate(zip(times, values.tolist()))
+    ]
@@ -1,15 +1,41 @@
+import bisect
 import logging
+import math
 import os
 from abc import ABC
+from functools import partial
 from itertools import chain
-from typing import Any, Dict
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
-from joblib import Parallel, delayed
+from src.cohort_store import (
+    COHORT_DEFINITIONS_TABLE,
+    MEASUREMENTS_TABLE,
+    CohortStore,
+)
+from src.executor import Executor
+from src.intermediate_store import ArrowStore
+from src.materialize import STAGING_PARTITION_COLS
+from src.out_of_core import MemoryBudget, SpillStore
 from src.preprocess import Preprocess
-from src.utils.utils import query_results, write_to_db
+from src.preprocessing.aggregate import Aggregate
+from src.preprocessing.region import Region
+from src.query.partitions import PartitionLayout
+from src.query.scan_cost import PlannedQuery, ScanBudget
+from src.query.sql_aggregate import SqlAggregate
+from src.query.sql_filter import SqlFilter
+from src.query.sql_sample import SqlSample
+from src.streaming import StreamStage, interleave, stream
+from src.utils.instrumentation import timed
+from src.utils.utils import (
+    iter_query_result_pages,
+    query_results,
+    to_list,
+    write_to_db,
+)
 
-from config.model_settings import CohortBuilderConfig
+from config.model_settings import CohortBuilderConfig, MaterializeConfig
 
 
 class CohortBuilderBase(ABC):
@@ -19,19 +45,44 @@ class CohortBuilderBase(ABC):
         region_name: str,
         bucket: str,
         s3_output: str,
+        scan_budget: Optional[ScanBudget] = None,
     ):
         self.table_name = table_name
         self.region_name = region_name
         self.bucket = bucket
         self.s3_output = s3_output
+        self.scan_budget = scan_budget or ScanBudget()
 
     def _build_response_from_aws(self, params, sql_query):
         response_query_result = query_results(params, sql_query)
+        self.scan_budget.record(sql_query, response_query_result)
         header = [
             d["VarCharValue"]
             for d in response_query_result["ResultSet"]["Rows"][0]["Data"]
         ]
-        rows = response_query_result["ResultSet"]["Rows"][1:]
+        return self._rows_to_frame(
+            header, response_query_result["ResultSet"]["Rows"][1:]
+        )
+
+    def _iter_response_batches(
+        self, params, sql_query, batch_rows: int
+    ) -> Iterator[pd.DataFrame]:
+        """Page through the query results in frames of about `batch_rows` rows"""
+        header, rows = None, []
+        for response_query_result in iter_query_result_pages(params, sql_query):
+            page_rows = response_query_result["ResultSet"]["Rows"]
+            if header is None:
+                self.scan_budget.record(sql_query, response_query_result)
+                header = [d["VarCharValue"] for d in page_rows[0]["Data"]]
+                page_rows = page_rows[1:]
+            rows.extend(page_rows)
+            if len(rows) >= batch_rows:
+                yield self._rows_to_frame(header, rows)
+                rows = []
+        if rows:
+            yield self._rows_to_frame(header, rows)
+
+    def _rows_to_frame(self, header: List[str], rows) -> pd.DataFrame:
         result = [dict(zip(header, self._get_var_char_values(row))) for row in rows]
         return pd.DataFrame(result)
 
@@ -44,100 +95,603 @@ class CohortBuilder(CohortBuilderBase):
         self,
         date_col: str,
         filter_dict: Dict[str, Any],
+        pollutant_to_predict: Union[str, List[str]],
+        partition_layout: PartitionLayout,
+        co_located_pollutants: bool = False,
+        incremental: bool = False,
+        aggregation: str = "none",
+        expected_daily_readings: int = 24,
+        store_dir: str = "data/intermediate",
+        write_to_db: bool = False,
+        athena_executor: Optional[Executor] = None,
+        preprocess_executor: Optional[Executor] = None,
+        preprocess_shard_rows: int = 100_000,
+        out_of_core: bool = False,
+        batch_rows: int = 500_000,
+        spill_dir: str = "data/spill",
+        max_memory_gb: float = 12.0,
+        queue_size: int = 2,
+        sample: Optional[SqlSample] = None,
+        countries: Optional[List[str]] = None,
+        cities: Optional[List[str]] = None,
+        region: Optional[Region] = None,
+        scan_budget: Optional[ScanBudget] = None,
+        table_name: str = CohortBuilderConfig.TABLE_NAME,
     ) -> None:
+        if out_of_core and incremental:
+            raise ValueError(
+                "Incremental refreshes need the database copy, not out of core mode"
+            )
+        if out_of_core and co_located_pollutants:
+            raise ValueError(
+                "Co-located pollutants pivot the whole cohort, not out of core mode"
+            )
         self.date_col = date_col
         self.filter_dict = filter_dict
+        self.pollutant_to_predict = pollutant_to_predict
+        self.partition_layout = partition_layout
+        self.co_located_pollutants = co_located_pollutants
+        self.incremental = incremental
+        self.aggregation = aggregation
+        self.expected_daily_readings = expected_daily_readings
+        self.store_dir = store_dir
+        self.write_to_db = write_to_db
+        self.athena_executor = athena_executor or Executor("threads", name="athena")
+        self.preprocess_executor = preprocess_executor
+        self.preprocess_shard_rows = preprocess_shard_rows
+        self.out_of_core = out_of_core
+        self.batch_rows = batch_rows
+        self.spill_dir = spill_dir
+        self.memory_budget = MemoryBudget(max_memory_gb)
+        self.queue_size = queue_size
+        self.sample = sample or SqlSample()
+        # each stratum's sampled location, picked once per run
+        self._stratum_ids: Optional[List[str]] = None
+        self.countries = countries
+        self.cities = cities
+        self.region = region
+        self._batches_loaded = 0
         super().__init__(
-            CohortBuilderConfig.TABLE_NAME,
+            table_name,
             CohortBuilderConfig.REGION,
             CohortBuilderConfig.S3_BUCKET,
             CohortBuilderConfig.S3_OUTPUT,
+            scan_budget,
         )
 
     @classmethod
     def from_dataclass_config(cls, config: CohortBuilderConfig) -> "CohortBuilder":
+        if config.USE_STAGING_TABLE:
+            cls._check_staging_table(config, MaterializeConfig())
+            partition_layout = PartitionLayout(STAGING_PARTITION_COLS)
+            table_name = config.STAGING_TABLE_NAME
+        else:
+            partition_layout = PartitionLayout.from_dataclass_config(config)
+            table_name = config.TABLE_NAME
         return cls(
             date_col=config.DATE_COL,
             filter_dict=config.FILTER_DICT,
+            pollutant_to_predict=config.POLLUTANT_TO_PREDICT,
+            partition_layout=partition_layout,
+            co_located_pollutants=config.CO_LOCATED_POLLUTANTS,
+            incremental=config.INCREMENTAL,
+            aggregation=config.AGGREGATION,
+            expected_daily_readings=config.EXPECTED_DAILY_READINGS,
+            store_dir=config.STORE_DIR,
+            write_to_db=config.WRITE_TO_DB,
+            athena_executor=Executor.from_dataclass_config(
+                config.ATHENA_EXECUTOR, name="athena"
+            ),
+            preprocess_executor=Executor.from_dataclass_config(
+                config.PREPROCESS_EXECUTOR, name="preprocess"
+            ),
+            preprocess_shard_rows=config.PREPROCESS_SHARD_ROWS,
+            out_of_core=config.OUT_OF_CORE,
+            batch_rows=config.BATCH_ROWS,
+            spill_dir=config.SPILL_DIR,
+            max_memory_gb=config.MAX_MEMORY_GB,
+            queue_size=config.STREAM_QUEUE_SIZE,
+            sample=SqlSample.from_dataclass_config(config.SAMPLING),
+            countries=config.REGION_FILTER.COUNTRIES,
+            cities=config.REGION_FILTER.CITIES,
+            region=Region.from_dataclass_config(config.REGION_FILTER),
+            scan_budget=ScanBudget.from_dataclass_config(config.SCAN_BUDGET),
+            table_name=table_name,
+        )
+
+    @staticmethod
+    def _check_staging_table(
+        config: CohortBuilderConfig, materialize_config: MaterializeConfig
+    ):
+        """The staging table must be the one materialized with every pollutant"""
+        missing = set(to_list(config.POLLUTANT_TO_PREDICT)) - set(
+            to_list(materialize_config.POLLUTANT_TO_PREDICT)
+        )
+        if config.STAGING_TABLE_NAME != materialize_config.STAGING_TABLE_NAME:
+            raise ValueError(
+                f"""USE_STAGING_TABLE reads {config.STAGING_TABLE_NAME}, but
+                {materialize_config.STAGING_TABLE_NAME} is materialized"""
+            )
+        if missing:
+            raise ValueError(
+                f"""The staging table {config.STAGING_TABLE_NAME} holds no
+                {", ".join(sorted(missing))} measurements, add them to
+                MaterializeConfig.POLLUTANT_TO_PREDICT"""
+            )
+
+    @timed("stage", "cohort-builder")
+    def execute(self, train_validation_dict, engine) -> CohortStore:
+        """
+        Build the cohorts of every target pollutant for every time window
+        from a single scan per window. In incremental mode, once every
+        pollutant has a watermark only measurements ingested after it are
+        fetched and appended, to the database and to the local arrow
+        handoff, and the cohort definitions are recomputed in place.
+
+        In out of core mode the measurements only go to the local arrow
+        handoff, and the returned store holds the cohort definitions.
+        """
+        if self.sample.enabled:
+            logging.info(
+                f"""Sampling {self.sample.fraction:.2%} of the data by
+                {self.sample.method}"""
+            )
+        if self.out_of_core:
+            return self._execute_out_of_core(train_validation_dict, engine)
+        windows = self._merge_windows(train_validation_dict)
+        watermarks = (
+            {
+                pollutant: CohortStore.get_watermark(engine, pollutant)
+                for pollutant in self.pollutants
+            }
+            if self.incremental
+            else {}
+        )
+        if watermarks and None not in watermarks.values():
+            return self._refresh_cohorts(train_validation_dict, engine, watermarks)
+        self._plan_scans(windows)
+
+        # each batch of result pages is preprocessed and loaded while the
+        # next ones are fetched. Daily and co-located aggregations span
+        # batches, so they take a window at a time, as merged windows
+        # cover disjoint days.
+        spanning = self.aggregation == "pandas" or (
+            self.co_located_pollutants and len(self.pollutants) > 1
+        )
+        stages = [StreamStage("preprocess", self._preprocess)]
+        load_db = self.write_to_db or self.incremental
+        if load_db:
+            stages.append(StreamStage("db-load", partial(self._load_batch, engine)))
+        self._batches_loaded = 0
+        measurements_dfs = list(
+            stream(
+                self._iter_window_batches(
+                    windows, math.inf if spanning else self.batch_rows
+                ),
+                stages,
+                self.queue_size,
+            )
         )
+        cohort_store = CohortStore.from_windows(
+            (
+                pd.concat(measurements_dfs, axis=0, ignore_index=True)
+                if measurements_dfs
+                else pd.DataFrame()
+            ),
+            train_validation_dict,
+            self.pollutants,
+        )
+
+        cohort_store.to_store(ArrowStore(self.store_dir))
+        if load_db:
+            self._finish_load(cohort_store, engine)
+            self._advance_watermarks(engine, cohort_store.measurements_df)
+        return cohort_store
+
+    def _load_batch(self, engine, measurements_df: pd.DataFrame) -> pd.DataFrame:
+        """Append a batch's measurements, replacing the table on the first"""
+        if not measurements_df.empty:
+            write_to_db(
+                measurements_df,
+                engine,
+                MEASUREMENTS_TABLE,
+                "public",
+                "append" if self._batches_loaded else "replace",
+            )
+            self._batches_loaded += 1
+        return measurements_df
+
+    def _finish_load(self, cohort_store: CohortStore, engine):
+        # the loaded rows are in arrival order, readers sort them
+        if not self._batches_loaded:
+            cohort_store.to_db(engine)
+            return
+        cohort_store.index_measurements(engine)
+        cohort_store.write_cohort_definitions(engine)
+
+    def _execute_out_of_core(self, train_validation_dict, engine) -> CohortStore:
+        """
+        Stream every window from athena in `batch_rows` sized batches,
+        preprocess them and spill them to parquet partitioned by parameter
+        and day. The partitions are then aggregated, sorted and appended
+        to the arrow handoff one at a time, so that no more than a batch
+        or a day of measurements is ever held in memory.
+        """
+        windows = self._merge_windows(train_validation_dict)
+        self._plan_scans(windows)
+        spill_store = SpillStore(self.spill_dir, ["parameter", "day"])
+        spill_store.clear()
+        for _ in stream(
+            self._iter_window_batches(windows, self.batch_rows),
+            [
+                StreamStage("preprocess", partial(self._preprocess, aggregate=False)),
+                StreamStage("spill", partial(self._spill_batch, spill_store)),
+            ],
+            self.queue_size,
+        ):
+            self.memory_budget.check("Spilling the cohort windows")
+
+        store = ArrowStore(self.store_dir)
+        offsets: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        total_rows = store.write_batches(
+            MEASUREMENTS_TABLE,
+            self._iter_sorted_partitions(spill_store, offsets, engine),
+        )
+        spill_store.clear()
+        keys = sorted(offsets)
+        logging.info(
+            f"""Wrote {total_rows} measurements from {len(keys)}
+            parameter and day partitions"""
+        )
+
+        def row_position(parameter: str, boundary: str, side: str) -> int:
+            # whole days sort before or after the boundary, only the
+            # boundary's own day is read back
+            position = bisect.bisect_left(keys, (parameter, boundary[:10]))
+            if position == len(keys):
+                return total_rows
+            start_row, end_row = offsets[keys[position]]
+            if keys[position] != (parameter, boundary[:10]):
+                return start_row
+            timestamps = store.read_rows(
+                MEASUREMENTS_TABLE, start_row, end_row, ["timestamp_utc"]
+            ).timestamp_utc.astype(str)
+            return int(
+                start_row + np.searchsorted(timestamps.to_numpy(), boundary, side)
+            )
 
-    def execute(self, train_validation_dict, engine):
-        filter_cols = ", ".join(
-            set(list(chain.from_iterable(self.filter_dict.values())))
+        cohort_store = CohortStore(
+            store.read_rows(MEASUREMENTS_TABLE, 0, 0),
+            CohortStore.cohort_definitions(
+                train_validation_dict, self.pollutants, row_position
+            ),
         )
+        store.write(COHORT_DEFINITIONS_TABLE, cohort_store.cohort_definitions_df)
+        if self.write_to_db:
+            cohort_store.index_measurements(engine)
+            cohort_store.write_cohort_definitions(engine)
+        return cohort_store
 
-        cohorts_df = pd.concat(
-            Parallel(n_jobs=-1, backend="multiprocessing", verbose=5)(
-                delayed(self.cohort_builder)(
-                    cohort_type, train_validation_dict, filter_cols
+    def _iter_window_batches(
+        self, windows, batch_rows: float
+    ) -> Iterator[pd.DataFrame]:
+        """The result batches of every window, several windows fetched at once"""
+        return interleave(
+            (
+                self._iter_query_batches(start_date, end_date, batch_rows)
+                for start_date, end_date in windows
+            ),
+            self.athena_executor.workers,
+            self.queue_size,
+        )
+
+    def _iter_query_batches(
+        self, start_date, end_date, batch_rows: float
+    ) -> Iterator[pd.DataFrame]:
+        params, query = self._cohort_query(start_date, end_date)
+        yield from self._iter_response_batches(params, f"{query};", batch_rows)
+
+    def _spill_batch(self, spill_store: SpillStore, measurements_df: pd.DataFrame):
+        if not measurements_df.empty:
+            spill_store.write(
+                measurements_df.assign(day=measurements_df.timestamp_utc.str[:10])
+            )
+
+    def _iter_sorted_partitions(
+        self,
+        spill_store: SpillStore,
+        offsets: Dict[Tuple[str, str], Tuple[int, int]],
+        engine,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Yield the spilled partitions in `parameter`, `timestamp_utc` order,
+        recording the row range each one is written to in `offsets`.
+        """
+        rows = 0
+        for (parameter, day), partition_df in spill_store.iter_partitions():
+            partition_df = partition_df.drop(columns="day")
+            if self.aggregation == "pandas":
+                partition_df = Aggregate.daily(
+                    partition_df, self.expected_daily_readings
+                )
+            partition_df = partition_df.sort_values(
+                "timestamp_utc", kind="mergesort"
+            ).reset_index(drop=True)
+            if self.write_to_db:
+                write_to_db(
+                    partition_df,
+                    engine,
+                    MEASUREMENTS_TABLE,
+                    "public",
+                    "append" if offsets else "replace",
                 )
-                for cohort_type in train_validation_dict.keys()
+            offsets[(parameter, day)] = (rows, rows + len(partition_df))
+            rows += len(partition_df)
+            self.memory_budget.check(f"Partition {parameter} {day}")
+            yield partition_df
+
+    @property
+    def pollutants(self) -> List[str]:
+        return to_list(self.pollutant_to_predict)
+
+    def _refresh_cohorts(
+        self, train_validation_dict, engine, watermarks: Dict[str, str]
+    ) -> CohortStore:
+        """Append measurements past the watermarks and move the windows"""
+        end_date = max(
+            end_date
+            for _, end_date in chain.from_iterable(train_validation_dict.values())
+        )
+        watermark = min(watermarks.values())
+        logging.info(
+            f"""Refreshing {", ".join(self.pollutants)} cohorts with
+            measurements after {watermark}"""
+        )
+        self._plan_scans(
+            [(watermark[:10], end_date)],
+            watermark if self.aggregation == "none" else None,
+        )
+        if self.aggregation == "none":
+            new_measurements_df = self._preprocess(
+                self.cohort_builder(watermark[:10], end_date, watermark=watermark)
+            )
+            if not new_measurements_df.empty:
+                # pollutants ingested further than the oldest watermark
+                new_measurements_df = new_measurements_df[
+                    new_measurements_df.timestamp_utc
+                    > new_measurements_df.parameter.map(watermarks)
+                ]
+        else:
+            # the watermark day was stored partially aggregated, rebuild it
+            CohortStore.delete_measurements_from(engine, watermark[:10])
+            new_measurements_df = self._preprocess(
+                self.cohort_builder(watermark[:10], end_date)
+            )
+        if not new_measurements_df.empty:
+            write_to_db(
+                new_measurements_df.sort_values(
+                    ["parameter", "timestamp_utc"], kind="mergesort"
+                ),
+                engine,
+                MEASUREMENTS_TABLE,
+                "public",
+                "append",
+            )
+        CohortStore(
+            new_measurements_df,
+            CohortStore.cohort_definitions_from_db(
+                engine, train_validation_dict, self.pollutants
             ),
-            axis=0,
-        ).reset_index(drop=True)
-        filtered_cohorts_df = (
-            Preprocess().from_options(list(self.filter_dict.keys())).execute(cohorts_df)
+        ).write_cohort_definitions(engine)
+        self._advance_watermarks(engine, new_measurements_df)
+        # keep the local handoff in sync with the refreshed tables
+        store = ArrowStore(self.store_dir)
+        if store.exists(MEASUREMENTS_TABLE):
+            CohortStore.append_to_store(
+                store,
+                new_measurements_df,
+                train_validation_dict,
+                self.pollutants,
+                replace_from=None if self.aggregation == "none" else watermark[:10],
+            )
+        else:
+            # a first refresh on this machine has no handoff to append to
+            CohortStore.from_db().to_store(store)
+        return CohortStore.from_store(store)
+
+    def _advance_watermarks(self, engine, measurements_df: pd.DataFrame):
+        if measurements_df.empty:
+            return
+        for pollutant, watermark in (
+            measurements_df.groupby("parameter").timestamp_utc.max().items()
+        ):
+            CohortStore.set_watermark(engine, pollutant, watermark)
+
+    def _preprocess(
+        self, measurements_df: pd.DataFrame, aggregate: bool = True
+    ) -> pd.DataFrame:
+        if measurements_df.empty:
+            return measurements_df
+        measurements_df = (
+            Preprocess()
+            .from_options(
+                list(self.filter_dict.keys()),
+                aggregate_daily=aggregate and self.aggregation == "pandas",
+                expected_daily_readings=self.expected_daily_readings,
+                pollutant_to_predict=self.pollutants,
+                countries=self.countries,
+                cities=self.cities,
+                region=self.region,
+                executor=self.preprocess_executor,
+                shard_rows=self.preprocess_shard_rows,
+            )
+            .execute(measurements_df)
         )
+        if self.co_located_pollutants and len(self.pollutants) > 1:
+            return Aggregate.co_located(measurements_df)
+        return measurements_df
 
-        self._results_to_db(engine, filtered_cohorts_df)
+    def _plan_scans(self, windows, watermark: Optional[str] = None):
+        """Estimate the scan of every window's query before running any"""
+        self._load_strata(windows)
+        self.scan_budget.plan(
+            "cohort-builder",
+            [
+                PlannedQuery(
+                    f"cohort {start_date}_{end_date}",
+                    self._cohort_query(start_date, end_date, watermark)[1],
+                    self.table_name,
+                    self._partition_days(start_date, end_date),
+                )
+                for start_date, end_date in windows
+            ],
+        )
+
+    def _partition_days(self, start_date, end_date) -> Optional[int]:
+        if not self.partition_layout.date_partition_cols:
+            return None
+        return len(self.partition_layout.expected_partitions(start_date, end_date))
+
+    def _load_strata(self, windows):
+        """
+        Query each stratum's sampled location once over the span of all
+        `windows`, so every window keeps the same ones and the window
+        queries don't scan their rows a second time to find them.
+        """
+        if not self.sample.stratified:
+            return
+        start_date = min(start_date for start_date, _ in windows)
+        end_date = max(end_date for _, end_date in windows)
+        query = self.sample.strata_query(
+            self.table_name, self._window_filter(start_date, end_date)
+        )
+        self.scan_budget.plan(
+            "cohort-strata",
+            [
+                PlannedQuery(
+                    f"strata {start_date}_{end_date}",
+                    query,
+                    self.table_name,
+                    self._partition_days(start_date, end_date),
+                )
+            ],
+        )
+        strata_df = self._build_response_from_aws(self._query_params(), query)
+        # a location can represent several strata
+        self._stratum_ids = (
+            [] if strata_df.empty else sorted(set(strata_df[self.sample.id_col]))
+        )
+        logging.info(
+            f"""Sampling keeps {len(self._stratum_ids)} stratum
+            locations between {start_date} and {end_date}"""
+        )
+
+    def _merge_windows(self, train_validation_dict) -> List[Tuple[Any, Any]]:
+        """
+        Merge overlapping training and validation windows so each
+        measurement is only queried once.
+        """
+        merged_windows = []
+        for start_date, end_date in sorted(
+            chain.from_iterable(train_validation_dict.values())
+        ):
+            if merged_windows and start_date <= merged_windows[-1][1]:
+                merged_windows[-1] = (
+                    merged_windows[-1][0],
+                    max(merged_windows[-1][1], end_date),
+                )
+            else:
+                merged_windows.append((start_date, end_date))
+        return merged_windows
 
     def cohort_builder(
-        self, cohort_type, train_validation_dict, filter_cols
+        self, start_date, end_date, watermark: Optional[str] = None
     ) -> pd.DataFrame:
         """
-        Retrieve coded er data data from train data.
-
-        Ensures that dataframe always has columns mentioned in
-        ENTITY_ID_COLUMNS even if dataframe is empty.
+        Retrieve the distinct openaq measurements between two dates,
+        optionally only those strictly after `watermark`.
 
         Returns
         -------
         pd.DataFrame
-            Cohort dataframe for openaq data
+            Measurements dataframe for openaq data
         """
-        date_tup_list = list(train_validation_dict[f"{cohort_type}"])
-        df_list = []
-        params = {
+        params, query = self._cohort_query(start_date, end_date, watermark)
+        # every result page, not only the first 1000 rows
+        dfs = list(self._iter_response_batches(params, f"{query};", self.batch_rows))
+        df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+        if df.empty:
+            logging.info(
+                f"""No openaq data found for
+                {start_date}_{end_date}
+                time window"""
+            )
+        return df
+
+    def _query_params(self) -> Dict[str, str]:
+        return {
             "region": str(self.region_name),
             "database": str(os.getenv("DB_NAME_OPENAQ")),
             "bucket": str(self.bucket),
             "path": f"{self.s3_output}/cohorts",
         }
 
-        for index, date_tuple in enumerate(date_tup_list):
-            query = """SELECT DISTINCT *
-                FROM {table}
-                WHERE {date_col}
-                BETWEEN '{start_date}'
-                AND '{end_date}';""".format(
-                table=self.table_name,
-                date_col=self.date_col,
-                start_date=date_tuple[0],
-                end_date=date_tuple[1],
-            )
-
-            df = self._build_response_from_aws(params, query)
-            df["train_validation_set"] = index
-            df["cohort"] = f"{index}_{date_tuple[0]}_{date_tuple[1]}"
-            df["cohort_type"] = f"{cohort_type}"
-            if df.empty:
-                logging.info(
-                    f"""No openaq data found for
-                    {date_tuple[0].date()}_{date_tuple[1].date()}
-                    time window"""
-                )
-
-            df_list.append(df)
-        cohort_df = pd.concat(df_list, axis=0).reset_index(drop=True)
-        return cohort_df
-
-    def _results_to_db(self, filtered_cohorts_df, engine):
-        """Write model results to the database for all cohorts"""
+    def _window_filter(self, start_date, end_date) -> str:
+        return """{date_col}
+            BETWEEN '{start_date}'
+            AND '{end_date}'{pollutant_filter}{region_filter}
+            {partition_filter}""".format(
+            date_col=self.date_col,
+            start_date=start_date,
+            end_date=end_date,
+            # all target pollutants come back from the same scan
+            pollutant_filter=(
+                f"""
+            AND {SqlFilter.filter_pollutant(self.pollutant_to_predict)}"""
+                if "filter_pollutant" in self.filter_dict
+                else ""
+            ),
+            # the region's bounding box, its polygons are tested after download
+            region_filter=(
+                f"""
+            AND {SqlFilter.filter_region(self.region)}"""
+                if "filter_region" in self.filter_dict and self.region is not None
+                else ""
+            ),
+            partition_filter=self.partition_layout.partition_filter(
+                start_date, end_date, self.pollutant_to_predict
+            ),
+        )
 
-        write_to_db(
-            engine,
-            filtered_cohorts_df,
-            "cohorts",
-            "public",
-            "replace",
+    def _cohort_query(
+        self, start_date, end_date, watermark: Optional[str] = None
+    ) -> Tuple[Dict[str, str], str]:
+        if self.sample.stratified and self._stratum_ids is None:
+            self._load_strata([(start_date, end_date)])
+        query = """SELECT DISTINCT *
+            FROM {table}{table_sample}
+            WHERE {window_filter}{watermark_filter}{sample_filter}""".format(
+            table=self.table_name,
+            table_sample=self.sample.table_sample(),
+            window_filter=self._window_filter(start_date, end_date),
+            watermark_filter=(
+                f"""
+            AND from_iso8601_timestamp({self.date_col})
+            > from_iso8601_timestamp('{watermark}')"""
+                if watermark
+                else ""
+            ),
+            sample_filter=self.sample.sample_filter(self._stratum_ids or []),
         )
+        if self.aggregation == "sql":
+            query = SqlAggregate.daily(
+                query,
+                self.date_col,
+                SqlFilter.from_options(
+                    list(self.filter_dict.keys()),
+                    self.pollutant_to_predict,
+                    self.region,
+                ),
+                self.expected_daily_readings,
+            )
+        return self._query_params(), query
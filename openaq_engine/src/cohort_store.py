@@ -0,0 +1,380 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from sqlalchemy import inspect, text
+from src.intermediate_store import ArrowStore, IntermediateStore
+from src.utils.utils import get_data, write_to_db
+
+MEASUREMENTS_TABLE = "measurements"
+COHORT_DEFINITIONS_TABLE = "cohort_definitions"
+WATERMARKS_TABLE = "cohort_watermarks"
+
+
+def _sort_keys(
+    measurements_df: pd.DataFrame, date_col: str
+) -> Tuple[np.ndarray, np.ndarray]:
+    if measurements_df.empty:
+        return np.array([], dtype=object), np.array([], dtype=object)
+    return (
+        measurements_df.parameter.astype(str).to_numpy(dtype=object),
+        measurements_df[date_col].astype(str).to_numpy(dtype=object),
+    )
+
+
+def _sorted_row_position(
+    measured_parameters: np.ndarray, timestamps: np.ndarray
+) -> Callable[[str, str, str], int]:
+    """`row_position` over measurements sorted by parameter and timestamp"""
+
+    def row_position(parameter: str, boundary: str, side: str) -> int:
+        block_start = np.searchsorted(measured_parameters, parameter, "left")
+        block_end = np.searchsorted(measured_parameters, parameter, "right")
+        return int(
+            block_start
+            + np.searchsorted(timestamps[block_start:block_end], boundary, side)
+        )
+
+    return row_position
+
+
+class CohortStore:
+    """
+    Normalized cohort storage: every measurement is kept once, sorted by
+    `parameter` and `timestamp_utc`, and each cohort is a row range into
+    that frame, so overlapping time windows no longer duplicate rows and
+    every pollutant gets its own contiguous block of cohorts.
+    """
+
+    def __init__(
+        self,
+        measurements_df: pd.DataFrame,
+        cohort_definitions_df: pd.DataFrame,
+        date_col: str = "timestamp_utc",
+    ):
+        self.measurements_df = measurements_df
+        self.cohort_definitions_df = cohort_definitions_df.set_index(
+            "cohort", drop=False
+        ).rename_axis(None)
+        self.date_col = date_col
+
+    @classmethod
+    def from_windows(
+        cls,
+        measurements_df: pd.DataFrame,
+        train_validation_dict: Dict[str, List[Tuple[Any, Any]]],
+        parameters: List[str],
+        date_col: str = "timestamp_utc",
+    ) -> "CohortStore":
+        """
+        Sort the deduplicated measurements once and record each window of
+        `train_validation_dict` as a [start_row, end_row) range per
+        parameter.
+        """
+        measurements_df = measurements_df.sort_values(
+            ["parameter", date_col], kind="mergesort"
+        ).reset_index(drop=True)
+        return cls(
+            measurements_df,
+            cls.cohort_definitions(
+                train_validation_dict,
+                parameters,
+                _sorted_row_position(*_sort_keys(measurements_df, date_col)),
+            ),
+            date_col,
+        )
+
+    @staticmethod
+    def append_to_store(
+        store: ArrowStore,
+        new_measurements_df: pd.DataFrame,
+        train_validation_dict: Dict[str, List[Tuple[Any, Any]]],
+        parameters: List[str],
+        replace_from: Optional[str] = None,
+        date_col: str = "timestamp_utc",
+    ) -> pd.DataFrame:
+        """
+        Merge measurements newer than the stored ones into the arrow
+        handoff, after dropping the stored ones on or after `replace_from`,
+        and rewrite the cohort definitions, which are returned. Only the
+        sort keys of the stored measurements are read, their rows are
+        copied over a cohort at a time.
+        """
+        stored = (
+            store.read_table(MEASUREMENTS_TABLE),
+            *_sort_keys(
+                store.read(MEASUREMENTS_TABLE, columns=["parameter", date_col]),
+                date_col,
+            ),
+        )
+        new_measurements_df = new_measurements_df.sort_values(
+            ["parameter", date_col], kind="mergesort"
+        ).reset_index(drop=True)
+        new = (
+            pa.Table.from_pandas(new_measurements_df, preserve_index=False),
+            *_sort_keys(new_measurements_df, date_col),
+        )
+
+        # each parameter's stored rows, then its new ones
+        pieces = []
+        for parameter in np.unique(np.concatenate([stored[1], new[1]])):
+            for source in [stored, new]:
+                start = np.searchsorted(source[1], parameter, "left")
+                end = np.searchsorted(source[1], parameter, "right")
+                if source is stored and replace_from is not None:
+                    end = start + np.searchsorted(
+                        source[2][start:end], replace_from, "left"
+                    )
+                if end > start:
+                    pieces.append((source, start, end))
+
+        cohort_definitions_df = CohortStore.cohort_definitions(
+            train_validation_dict,
+            parameters,
+            _sorted_row_position(
+                *[
+                    np.concatenate(
+                        [np.array([], dtype=object)]
+                        + [source[key][start:end] for source, start, end in pieces]
+                    )
+                    for key in [1, 2]
+                ]
+            ),
+        )
+        boundaries = np.unique(
+            cohort_definitions_df[["start_row", "end_row"]].to_numpy()
+        )
+
+        def iter_batches() -> Iterator[pd.DataFrame]:
+            row = 0
+            for source, start, end in pieces:
+                # cut at the cohort boundaries, as `to_store` does
+                cuts = boundaries[(boundaries > row) & (boundaries < row + end - start)]
+                offsets = [start, *(cuts - row + start), end]
+                for cut_start, cut_end in zip(offsets[:-1], offsets[1:]):
+                    yield source[0].slice(cut_start, cut_end - cut_start).to_pandas()
+                row += end - start
+
+        store.write_batches(MEASUREMENTS_TABLE, iter_batches())
+        store.write(COHORT_DEFINITIONS_TABLE, cohort_definitions_df)
+        return cohort_definitions_df
+
+    @staticmethod
+    def cohort_definitions(
+        train_validation_dict: Dict[str, List[Tuple[Any, Any]]],
+        parameters: List[str],
+        row_position: Callable[[str, str, str], int],
+    ) -> pd.DataFrame:
+        """
+        Build one row per parameter and window, where
+        `row_position(parameter, boundary, side)` locates a date boundary
+        in the sorted measurements like `np.searchsorted`.
+        """
+        definitions = []
+        for parameter in parameters:
+            for cohort_type, date_tup_list in train_validation_dict.items():
+                for index, (start_date, end_date) in enumerate(date_tup_list):
+                    definitions.append(
+                        dict(
+                            cohort=f"{parameter}_{index}_{start_date}_{end_date}",
+                            cohort_type=cohort_type,
+                            parameter=parameter,
+                            train_validation_set=index,
+                            start_date=str(start_date),
+                            end_date=str(end_date),
+                            # same bounds as `date.utc BETWEEN start AND end`
+                            start_row=row_position(parameter, str(start_date), "left"),
+                            end_row=row_position(parameter, str(end_date), "right"),
+                        )
+                    )
+        return pd.DataFrame(definitions)
+
+    @staticmethod
+    def cohort_definitions_from_db(
+        engine,
+        train_validation_dict: Dict[str, List[Tuple[Any, Any]]],
+        parameters: List[str],
+        date_col: str = "timestamp_utc",
+    ) -> pd.DataFrame:
+        """
+        Locate the window boundaries with indexed counts on the stored
+        measurements, so refreshing cohorts never reads the table itself.
+        """
+
+        def row_position(parameter: str, boundary: str, side: str) -> int:
+            operator = "<" if side == "left" else "<="
+            return int(
+                pd.read_sql(
+                    text(
+                        f"""select count(*) from "{MEASUREMENTS_TABLE}"
+                        where "parameter" collate "C" < :parameter
+                        or ("parameter" = :parameter
+                        and "{date_col}" collate "C" {operator} :boundary)"""
+                    ),
+                    engine,
+                    params={"parameter": parameter, "boundary": boundary},
+                ).iloc[0, 0]
+            )
+
+        return CohortStore.cohort_definitions(
+            train_validation_dict, parameters, row_position
+        )
+
+    @classmethod
+    def from_db(cls, date_col: str = "timestamp_utc") -> "CohortStore":
+        return cls(
+            get_data(
+                f"""select * from "{MEASUREMENTS_TABLE}"
+                order by "parameter" collate "C", "{date_col}" collate "C";"""
+            ),
+            get_data(f'select * from "{COHORT_DEFINITIONS_TABLE}";'),
+            date_col,
+        )
+
+    @classmethod
+    def from_store(
+        cls, store: IntermediateStore, date_col: str = "timestamp_utc"
+    ) -> "CohortStore":
+        return cls(
+            store.read(MEASUREMENTS_TABLE),
+            store.read(COHORT_DEFINITIONS_TABLE),
+            date_col,
+        )
+
+    @staticmethod
+    def read_cohort(
+        store: IntermediateStore, cohort: str, columns: Optional[List[str]] = None
+    ) -> pd.DataFrame:
+        """Read a single cohort without loading the other measurements"""
+        definitions_df = store.read(COHORT_DEFINITIONS_TABLE)
+        start_row, end_row = definitions_df.loc[
+            definitions_df.cohort == cohort, ["start_row", "end_row"]
+        ].iloc[0]
+        return store.read_rows(MEASUREMENTS_TABLE, start_row, end_row, columns)
+
+    @property
+    def cohorts(self) -> List[str]:
+        return list(self.cohort_definitions_df.cohort)
+
+    def get_cohort(self, cohort: str) -> pd.DataFrame:
+        """Return the measurements of a cohort as a slice, without copying"""
+        start_row, end_row = self.cohort_definitions_df.loc[
+            cohort, ["start_row", "end_row"]
+        ]
+        return self.measurements_df.iloc[start_row:end_row]
+
+    def iter_cohorts(
+        self, cohort_type: Optional[str] = None, parameter: Optional[str] = None
+    ) -> Iterator[Tuple[str, pd.DataFrame]]:
+        definitions = self.cohort_definitions_df
+        if cohort_type is not None:
+            definitions = definitions[definitions.cohort_type == cohort_type]
+        if parameter is not None:
+            definitions = definitions[definitions.parameter == parameter]
+        for cohort in definitions.cohort:
+            yield cohort, self.get_cohort(cohort)
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Denormalize into the legacy one-row-per-cohort-membership frame.
+        Only use this for small cohorts, it duplicates overlapping rows.
+        """
+        return pd.concat(
+            [
+                self.get_cohort(cohort).assign(
+                    train_validation_set=definition.train_validation_set,
+                    cohort=cohort,
+                    cohort_type=definition.cohort_type,
+                )
+                for cohort, definition in self.cohort_definitions_df.iterrows()
+            ],
+            axis=0,
+        ).reset_index(drop=True)
+
+    def to_store(self, store: IntermediateStore):
+        """
+        Write the measurements split at every cohort boundary, so each
+        cohort maps onto whole record batches, and the cohort definitions.
+        """
+        store.write(
+            MEASUREMENTS_TABLE,
+            self.measurements_df,
+            split_rows=pd.concat(
+                [
+                    self.cohort_definitions_df.start_row,
+                    self.cohort_definitions_df.end_row,
+                ]
+            ).unique(),
+        )
+        store.write(COHORT_DEFINITIONS_TABLE, self.cohort_definitions_df)
+
+    def to_db(self, engine, table_behaviour: str = "replace"):
+        """Write the measurements and cohort definitions to the database"""
+        write_to_db(
+            self.measurements_df,
+            engine,
+            MEASUREMENTS_TABLE,
+            "public",
+            table_behaviour,
+        )
+        self.index_measurements(engine)
+        self.write_cohort_definitions(engine)
+
+    def write_cohort_definitions(self, engine):
+        write_to_db(
+            self.cohort_definitions_df,
+            engine,
+            COHORT_DEFINITIONS_TABLE,
+            "public",
+            "replace",
+        )
+
+    def index_measurements(self, engine):
+        with engine.begin() as connection:
+            connection.execute(
+                text(
+                    f"""create index if not exists
+                    "{MEASUREMENTS_TABLE}_{self.date_col}_idx"
+                    on "{MEASUREMENTS_TABLE}"
+                    ("parameter" collate "C", "{self.date_col}" collate "C")"""
+                )
+            )
+
+    @staticmethod
+    def delete_measurements_from(engine, start_date: str, date_col="timestamp_utc"):
+        """Drop stored measurements on or after `start_date` before re-ingesting"""
+        with engine.begin() as connection:
+            connection.execute(
+                text(
+                    f'delete from "{MEASUREMENTS_TABLE}" where "{date_col}" >= :start'
+                ),
+                {"start": start_date},
+            )
+
+    @staticmethod
+    def get_watermark(engine, parameter: str) -> Optional[str]:
+        """Latest ingested timestamp for `parameter`, None before the first build"""
+        if not inspect(engine).has_table(WATERMARKS_TABLE, schema="public"):
+            return None
+        watermarks_df = pd.read_sql(
+            text(f'select * from "{WATERMARKS_TABLE}" where parameter = :parameter'),
+            engine,
+            params={"parameter": parameter},
+        )
+        if watermarks_df.empty:
+            return None
+        return watermarks_df.watermark.iloc[0]
+
+    @staticmethod
+    def set_watermark(engine, parameter: str, watermark: str):
+        watermarks_df = pd.DataFrame(columns=["parameter", "watermark"])
+        if inspect(engine).has_table(WATERMARKS_TABLE, schema="public"):
+            watermarks_df = pd.read_sql(f'select * from "{WATERMARKS_TABLE}"', engine)
+        watermarks_df = pd.concat(
+            [
+                watermarks_df[watermarks_df.parameter != parameter],
+                pd.DataFrame(dict(parameter=[parameter], watermark=[watermark])),
+            ]
+        )
+        write_to_db(watermarks_df, engine, WATERMARKS_TABLE, "public", "replace")
@@ -0,0 +1,98 @@
+import logging
+from typing import Any, Callable, Iterable, List, Optional
+
+from joblib import Parallel, delayed, effective_n_jobs
+from src.utils.instrumentation import measure
+
+from config.model_settings import ExecutorConfig
+
+BACKENDS = {
+    "serial": None,
+    "threads": "threading",
+    # both process backends memmap numpy arrays larger than `max_nbytes`
+    # into shared memory instead of pickling them to every worker
+    "processes": "multiprocessing",
+    "loky": "loky",
+}
+
+
+class Executor:
+    """
+    Runs a stage's tasks serially, on threads for I/O-bound work such as
+    athena and earth engine calls, or on processes for CPU-bound work.
+
+    `chunk_size` tasks are sent to a worker at a time, and `progress` is
+    called with the number of finished and total tasks as results come
+    back.
+    """
+
+    def __init__(
+        self,
+        backend: str = "loky",
+        n_jobs: int = -1,
+        chunk_size: int = 1,
+        max_nbytes: Optional[str] = "1M",
+        name: str = "executor",
+        progress: Optional[Callable[[int, int], None]] = None,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(
+                f"Unknown executor backend {backend}, use one of {list(BACKENDS)}"
+            )
+        self.backend = backend
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.max_nbytes = max_nbytes
+        self.name = name
+        self.progress = progress or self._log_progress
+
+    @classmethod
+    def from_dataclass_config(
+        cls,
+        config: ExecutorConfig,
+        name: str = "executor",
+        progress: Optional[Callable[[int, int], None]] = None,
+    ) -> "Executor":
+        return cls(
+            backend=config.BACKEND,
+            n_jobs=config.N_JOBS,
+            chunk_size=config.CHUNK_SIZE,
+            max_nbytes=config.MAX_NBYTES,
+            name=name,
+            progress=progress,
+        )
+
+    @property
+    def workers(self) -> int:
+        """The number of tasks run at once"""
+        return 1 if self.backend == "serial" else effective_n_jobs(self.n_jobs)
+
+    def map(self, func: Callable[..., Any], *iterables: Iterable) -> List[Any]:
+        """`[func(*args) for args in zip(*iterables)]`, in input order"""
+        tasks = list(zip(*iterables))
+        results: List[Any] = []
+        with measure(
+            "executor", self.name, backend=self.backend, rows_in=len(tasks)
+        ) as metrics:
+            if self.backend == "serial" or len(tasks) <= 1:
+                for args in tasks:
+                    results.append(func(*args))
+                    self.progress(len(results), len(tasks))
+            else:
+                # results stream back in order while later tasks still run,
+                # the multiprocessing pool only returns them all at once
+                for result in Parallel(
+                    n_jobs=self.n_jobs,
+                    backend=BACKENDS[self.backend],
+                    batch_size=self.chunk_size,
+                    max_nbytes=self.max_nbytes,
+                    return_as="list" if self.backend == "processes" else "generator",
+                )(delayed(func)(*args) for args in tasks):
+                    results.append(result)
+                    self.progress(len(results), len(tasks))
+            metrics["rows_out"] = len(results)
+        return results
+
+    def _log_progress(self, done: int, total: int):
+        if done == total or done % max(total // 10, 1) == 0:
+            logging.info(f"{self.name}: {done}/{total} tasks done")
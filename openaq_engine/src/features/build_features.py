@@ -1,11 +1,25 @@
+import math
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Optional, Type
+from typing import Any, Dict, Iterator, List, Optional, Type
 
 import pandas as pd
+from src.cohort_store import MEASUREMENTS_TABLE, CohortStore
+from src.features.feature_matrix import FEATURES_TABLE
+from src.features.feature_store import FeatureStore, feature_set_version
 from src.features.satellite._ee_data import EEFeatures
-from src.utils.utils import get_data
+from src.features.spatial._coordinates import COORDINATE_FEATURES, CoordinateFeatures
+from src.features.spatial._neighbors import NeighborFeatures
+from src.features.temporal._lags import TemporalFeatures
+from src.intermediate_store import ArrowStore
+from src.utils.instrumentation import timed
 
-from config.model_settings import BuildFeaturesConfig, EEConfig
+from config.model_settings import (
+    BuildFeaturesConfig,
+    CohortBuilderConfig,
+    EEConfig,
+    NeighborFeaturesConfig,
+    TemporalFeaturesConfig,
+)
 
 
 class BuildFeatureBase(ABC):
@@ -22,9 +36,15 @@ class BuildFeaturesRandomForest(BuildFeatureBase):
         self,
         categorical_features: Dict[str, List[Any]],
         all_model_features: Optional[List[str]],
+        store_dir: str = "data/intermediate",
+        out_of_core: bool = False,
+        feature_store_dir: Optional[str] = None,
     ) -> None:
         self.categorical_features = categorical_features
         self._all_model_features = all_model_features
+        self.store_dir = store_dir
+        self.out_of_core = out_of_core
+        self.feature_store_dir = feature_store_dir
         super().__init__(BuildFeaturesConfig.TARGET_COL)
 
     @classmethod
@@ -34,20 +54,137 @@ class BuildFeaturesRandomForest(BuildFeatureBase):
         return cls(
             categorical_features=config.CATEGORICAL_FEATURES,
             all_model_features=config.ALL_MODEL_FEATURES,
+            store_dir=config.STORE_DIR,
+            out_of_core=config.OUT_OF_CORE,
+            feature_store_dir=config.FEATURE_STORE_DIR,
         )
 
+    @timed("stage", "feature-builder")
     def execute(
         self,
-        df: pd.DataFrame,
-    ) -> pd.DataFrame:
-        cohort_query = """select * from "cohorts";"""
-        df = get_data(cohort_query)
+        df: Optional[pd.DataFrame] = None,
+    ) -> Optional[pd.DataFrame]:
+        if df is None and self.out_of_core:
+            self._execute_batches()
+            return None
+        if df is None:
+            # features only depend on the measurement, not on cohort membership
+            df = self._read_measurements()
+        if self.feature_store_dir:
+            df = self._read_feature_store(df)
+        else:
+            df = self._compute_features(df)
+        # the rotation is fit on the sensors of this run, so it isn't stored
+        df = CoordinateFeatures().fit(df).execute(df)
+        return df.pipe(self._change_to_categorical_type)[self.all_model_features]
+
+    def _compute_features(self, df: pd.DataFrame) -> pd.DataFrame:
         return (
-            df.pipe(self._add_ee_variable_features)
-            .pipe(self._add_ee_static_features)
-            .pipe(self._change_to_categorical_type)[self.all_model_features]
+            df.pipe(self._add_neighbor_features)
+            .pipe(self._add_temporal_features)
+            .pipe(self._add_ee_features)
         )
 
+    def _read_feature_store(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Only compute the features of the days the feature store doesn't
+        hold as they are, and read every reading's features from it. The
+        diurnal and weekly profiles average a sensor's whole history, so
+        they are computed over `df` rather than stored.
+        """
+        temporal_config = TemporalFeaturesConfig()
+        store = FeatureStore(
+            self.feature_store_dir,
+            feature_set_version(
+                [
+                    BuildFeaturesConfig(),
+                    NeighborFeaturesConfig(),
+                    temporal_config,
+                    # features of a sample or a region see fewer neighbors
+                    CohortBuilderConfig().SAMPLING,
+                    CohortBuilderConfig().REGION_FILTER,
+                ],
+                [
+                    BuildFeaturesRandomForest,
+                    FeatureStore,
+                    NeighborFeatures,
+                    TemporalFeatures,
+                ],
+            ),
+            key_cols=temporal_config.ENTITY_COLS,
+            date_col=temporal_config.DATE_COL,
+        )
+        store.prune()
+        # lags and windows of a new day reach back into the stored days
+        history = pd.Timedelta(temporal_config.FREQ) * max(
+            temporal_config.LAGS + temporal_config.ROLLING_WINDOWS, default=0
+        )
+        profile_features = [f"{profile}_mean" for profile in temporal_config.PROFILES]
+        store.update(
+            df,
+            lambda context_df: self._compute_features(context_df).drop(
+                columns=profile_features
+            ),
+            lookback_days=math.ceil(history / pd.Timedelta(days=1)),
+        )
+        df = store.read(
+            df,
+            [
+                feature
+                for feature in self.all_model_features
+                if feature not in df
+                and feature not in profile_features
+                and feature not in COORDINATE_FEATURES
+            ],
+        )
+        profiles_df = TemporalFeatures(
+            date_col=temporal_config.DATE_COL,
+            target_col=temporal_config.TARGET_COL,
+            entity_cols=temporal_config.ENTITY_COLS,
+            freq=temporal_config.FREQ,
+            lags=[],
+            rolling_windows=[],
+            rolling_stats=[],
+            profiles=temporal_config.PROFILES,
+            feature_names=profile_features,
+        ).execute(df)
+        return df.assign(**{name: profiles_df[name] for name in profile_features})
+
+    def _execute_batches(self):
+        """
+        Build the features of each stored measurement batch and stream them
+        to the features arrow file. Categorical columns are kept as strings
+        on disk, as an arrow file can't change its dictionaries between
+        batches.
+        """
+        store = ArrowStore(self.store_dir)
+        store.write_batches(FEATURES_TABLE, self._iter_feature_batches(store))
+
+    def _iter_feature_batches(self, store: ArrowStore) -> Iterator[pd.DataFrame]:
+        # a first pass over the locations fits the coordinates' rotation
+        coordinates = CoordinateFeatures().fit_batches(
+            store.iter_batches(MEASUREMENTS_TABLE, columns=["x", "y"])
+        )
+        # batches hold one parameter and day each in time order, the
+        # temporal features carry what they need from the earlier days
+        dfs = TemporalFeatures.from_dataclass_config(
+            TemporalFeaturesConfig()
+        ).execute_batches(
+            df.pipe(self._add_neighbor_features)
+            for df in store.iter_batches(MEASUREMENTS_TABLE)
+        )
+        for df in dfs:
+            yield df.pipe(self._add_ee_features).pipe(coordinates.execute)[
+                self.all_model_features
+            ]
+
+    def _read_measurements(self) -> pd.DataFrame:
+        """Prefer the local arrow handoff, fall back to the database"""
+        store = ArrowStore(self.store_dir)
+        if store.exists(MEASUREMENTS_TABLE):
+            return store.read(MEASUREMENTS_TABLE)
+        return CohortStore.from_db().measurements_df
+
     @property
     def all_model_features(self):
         return self._all_model_features
@@ -58,7 +195,18 @@ class BuildFeaturesRandomForest(BuildFeatureBase):
             raise ValueError("All the feature names should be strings!")
         self._all_model_features = features
 
-    def _add_ee_variable_features(self, df):
+    def _add_neighbor_features(self, df: pd.DataFrame) -> pd.DataFrame:
+        return NeighborFeatures.from_dataclass_config(NeighborFeaturesConfig()).execute(
+            df
+        )
+
+    def _add_temporal_features(self, df: pd.DataFrame) -> pd.DataFrame:
+        return TemporalFeatures.from_dataclass_config(TemporalFeaturesConfig()).execute(
+            df
+        )
+
+    def _add_ee_features(self, df: pd.DataFrame) -> pd.DataFrame:
+        # EEFeatures reads the variable and the static satellites
         return EEFeatures.from_dataclass_config(EEConfig()).execute(
             df, save_images=False
         )
@@ -67,10 +215,8 @@ class BuildFeaturesRandomForest(BuildFeatureBase):
         return df.assign(year=lambda df: pd.to_datetime(df.listed_at).dt.year)
 
     def _change_to_categorical_type(self, df: pd.DataFrame) -> pd.DataFrame:
-        for cat_col in self.categorical_features:
-            df.loc[:, cat_col] = df[cat_col].astype("category")
-
-        return df
+        # codes are per frame, FeatureMatrixBuilder keeps them across cohorts
+        return df.astype(dict.fromkeys(self.categorical_features, "category"))
 
 
 def get_feature_builder(algorithm: str) -> Type[BuildFeatureBase]:
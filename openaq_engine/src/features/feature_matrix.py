@@ -0,0 +1,344 @@
+import json
+import logging
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from src.cohort_store import MEASUREMENTS_TABLE
+from src.intermediate_store import ArrowStore
+from src.utils.instrumentation import measure
+
+from config.model_settings import BuildFeaturesConfig
+
+FEATURES_TABLE = "features"
+CATEGORIES_FILE = "categories.json"
+# every measurement's features, the cohorts are row ranges into it
+MATRIX_NAME = "features"
+COHORTS_FILE = "cohorts.parquet"
+# the code of missing values and of categories not seen in training
+UNSEEN_CATEGORY = 0
+
+
+class CategoryEncoder:
+    """
+    Category dictionaries learned on the training cohorts, so a category
+    gets the same code in every cohort. Codes start at 1, anything else
+    maps to `UNSEEN_CATEGORY`.
+    """
+
+    def __init__(self, categories: Dict[str, List[str]]):
+        self.categories = categories
+
+    @classmethod
+    def fit(cls, dfs: Iterator[pd.DataFrame], columns: List[str]) -> "CategoryEncoder":
+        seen = {column: set() for column in columns}
+        for df in dfs:
+            for column in columns:
+                seen[column].update(df[column].dropna().astype(str).unique())
+        return cls({column: sorted(values) for column, values in seen.items()})
+
+    def encode(self, column: str, values: pd.Series) -> np.ndarray:
+        codes = pd.Categorical(
+            values.astype(str), categories=self.categories[column]
+        ).codes.astype(np.int32)
+        codes[values.isna().to_numpy()] = -1
+        # unseen and missing values are coded -1, shift them onto 0
+        return codes + 1
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.categories, f, indent=4)
+
+    @classmethod
+    def load(cls, path: str) -> "CategoryEncoder":
+        with open(path) as f:
+            return cls(json.load(f))
+
+
+class FeatureMatrix:
+    """
+    A C-contiguous float32 matrix with its column names, the indices of
+    the category coded columns and optionally the target of each row,
+    saved as `.npy` files and a json sidecar so models can memory map it
+    without a copy.
+    """
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        feature_names: List[str],
+        categorical_feature_indices: List[int],
+        target: Optional[np.ndarray] = None,
+    ):
+        self.values = values
+        self.feature_names = feature_names
+        self.categorical_feature_indices = categorical_feature_indices
+        self.target = target
+
+    @staticmethod
+    def encode(
+        df: pd.DataFrame,
+        feature_names: List[str],
+        encoder: CategoryEncoder,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """The float32 values of `df`, written into `out` when given"""
+        if out is None:
+            out = np.empty((len(df), len(feature_names)), dtype=np.float32)
+        for index, feature in enumerate(feature_names):
+            if feature in encoder.categories:
+                # float32 holds category codes exactly up to 2**24
+                out[:, index] = encoder.encode(feature, df[feature])
+            else:
+                out[:, index] = pd.to_numeric(df[feature], errors="coerce")
+        return out
+
+    @staticmethod
+    def categorical_indices(
+        feature_names: List[str], encoder: CategoryEncoder
+    ) -> List[int]:
+        return [
+            index
+            for index, feature in enumerate(feature_names)
+            if feature in encoder.categories
+        ]
+
+    @classmethod
+    def from_frame(
+        cls,
+        df: pd.DataFrame,
+        feature_names: List[str],
+        encoder: CategoryEncoder,
+        target: Optional[pd.Series] = None,
+    ) -> "FeatureMatrix":
+        return cls(
+            cls.encode(df, feature_names, encoder),
+            feature_names,
+            cls.categorical_indices(feature_names, encoder),
+            None
+            if target is None
+            else pd.to_numeric(target, errors="coerce").to_numpy(dtype=np.float32),
+        )
+
+    @staticmethod
+    def _paths(matrix_dir: str, name: str) -> Tuple[str, str, str]:
+        return (
+            os.path.join(matrix_dir, f"{name}.npy"),
+            os.path.join(matrix_dir, f"{name}.json"),
+            os.path.join(matrix_dir, f"{name}_target.npy"),
+        )
+
+    def rows(self, start_row: int, end_row: int) -> "FeatureMatrix":
+        """A view of a row range, sharing the values and target"""
+        return FeatureMatrix(
+            self.values[start_row:end_row],
+            self.feature_names,
+            self.categorical_feature_indices,
+            None if self.target is None else self.target[start_row:end_row],
+        )
+
+    def save(self, matrix_dir: str, name: str):
+        os.makedirs(matrix_dir, exist_ok=True)
+        values_path, _, target_path = self._paths(matrix_dir, name)
+        np.save(values_path, self.values)
+        if self.target is not None:
+            np.save(target_path, self.target)
+        self.save_metadata(matrix_dir, name)
+
+    def save_metadata(self, matrix_dir: str, name: str):
+        _, metadata_path, _ = self._paths(matrix_dir, name)
+        with open(metadata_path, "w") as f:
+            json.dump(
+                dict(
+                    feature_names=self.feature_names,
+                    categorical_feature_indices=self.categorical_feature_indices,
+                ),
+                f,
+                indent=4,
+            )
+
+    @classmethod
+    def create(
+        cls,
+        matrix_dir: str,
+        name: str,
+        rows: int,
+        feature_names: List[str],
+        categorical_feature_indices: List[int],
+    ) -> "FeatureMatrix":
+        """An empty matrix and target memory mapped on disk, to fill in batches"""
+        os.makedirs(matrix_dir, exist_ok=True)
+        values_path, _, target_path = cls._paths(matrix_dir, name)
+        matrix = cls(
+            np.lib.format.open_memmap(
+                values_path, "w+", np.float32, (rows, len(feature_names))
+            ),
+            feature_names,
+            categorical_feature_indices,
+            np.lib.format.open_memmap(target_path, "w+", np.float32, (rows,)),
+        )
+        matrix.save_metadata(matrix_dir, name)
+        return matrix
+
+    @classmethod
+    def load(cls, matrix_dir: str, name: str, mmap: bool = True) -> "FeatureMatrix":
+        values_path, metadata_path, target_path = cls._paths(matrix_dir, name)
+        mmap_mode = "r" if mmap else None
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        return cls(
+            np.load(values_path, mmap_mode=mmap_mode),
+            metadata["feature_names"],
+            metadata["categorical_feature_indices"],
+            np.load(target_path, mmap_mode=mmap_mode)
+            if os.path.exists(target_path)
+            else None,
+        )
+
+
+class FeatureMatrixBuilder:
+    """
+    Write one feature matrix of every measurement, with its target, and
+    the cohorts as row ranges into it, along with the category
+    dictionaries learned on the training cohorts.
+    """
+
+    def __init__(
+        self,
+        feature_names: List[str],
+        categorical_features: List[str],
+        target_col: str,
+        matrix_dir: str,
+        store_dir: str,
+        training_cohort_type: str = "training",
+    ):
+        # ALL_MODEL_FEATURES comes from a set, fix the column order
+        self.feature_names = sorted(feature_names)
+        self.categorical_features = [
+            feature for feature in categorical_features if feature in feature_names
+        ]
+        self.target_col = target_col
+        self.matrix_dir = matrix_dir
+        self.store_dir = store_dir
+        self.training_cohort_type = training_cohort_type
+
+    @classmethod
+    def from_dataclass_config(
+        cls, config: BuildFeaturesConfig
+    ) -> "FeatureMatrixBuilder":
+        return cls(
+            feature_names=config.ALL_MODEL_FEATURES,
+            categorical_features=config.CATEGORICAL_FEATURES,
+            target_col=config.TARGET_COL,
+            matrix_dir=config.MATRIX_DIR,
+            store_dir=config.STORE_DIR,
+        )
+
+    def execute(
+        self,
+        cohort_definitions_df: pd.DataFrame,
+        features_df: Optional[pd.DataFrame] = None,
+        target: Optional[pd.Series] = None,
+    ) -> pd.DataFrame:
+        """
+        Encode the features, row aligned with the stored measurements, and
+        their `target`. Without `features_df` both are streamed from the
+        out of core features and measurements files.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per cohort with its row range into the matrix
+        """
+        training_df = cohort_definitions_df[
+            cohort_definitions_df.cohort_type == self.training_cohort_type
+        ]
+        if training_df.empty:
+            raise ValueError(
+                f"No {self.training_cohort_type} cohorts to learn categories from"
+            )
+        encoder = CategoryEncoder.fit(
+            (
+                self._cohort_features(definition, features_df)
+                for definition in training_df.itertuples()
+            ),
+            self.categorical_features,
+        )
+        os.makedirs(self.matrix_dir, exist_ok=True)
+        encoder.save(os.path.join(self.matrix_dir, CATEGORIES_FILE))
+
+        with measure("features", "matrix") as metrics:
+            if features_df is not None:
+                matrix = FeatureMatrix.from_frame(
+                    features_df, self.feature_names, encoder, target
+                )
+                matrix.save(self.matrix_dir, MATRIX_NAME)
+            else:
+                matrix = self._write_batches(encoder)
+            metrics["rows_out"] = len(matrix.values)
+
+        cohorts_df = (
+            cohort_definitions_df[
+                [
+                    "cohort",
+                    "cohort_type",
+                    "parameter",
+                    "train_validation_set",
+                    "start_row",
+                    "end_row",
+                ]
+            ]
+            .assign(rows=lambda df: (df.end_row - df.start_row).clip(lower=0))
+            .reset_index(drop=True)
+        )
+        cohorts_df.to_parquet(os.path.join(self.matrix_dir, COHORTS_FILE), index=False)
+        logging.info(
+            f"""Wrote a feature matrix of {len(matrix.values)} rows for
+            {len(cohorts_df)} cohorts to {self.matrix_dir}"""
+        )
+        return cohorts_df
+
+    def _write_batches(self, encoder: CategoryEncoder) -> FeatureMatrix:
+        store = ArrowStore(self.store_dir)
+        matrix = FeatureMatrix.create(
+            self.matrix_dir,
+            MATRIX_NAME,
+            store.num_rows(FEATURES_TABLE),
+            self.feature_names,
+            FeatureMatrix.categorical_indices(self.feature_names, encoder),
+        )
+        start_row = 0
+        for features_df in store.iter_batches(FEATURES_TABLE, self.feature_names):
+            end_row = start_row + len(features_df)
+            FeatureMatrix.encode(
+                features_df,
+                self.feature_names,
+                encoder,
+                out=matrix.values[start_row:end_row],
+            )
+            start_row = end_row
+        start_row = 0
+        for measurements_df in store.iter_batches(
+            MEASUREMENTS_TABLE, [self.target_col]
+        ):
+            end_row = start_row + len(measurements_df)
+            matrix.target[start_row:end_row] = pd.to_numeric(
+                measurements_df[self.target_col], errors="coerce"
+            )
+            start_row = end_row
+        matrix.values.flush()
+        matrix.target.flush()
+        return matrix
+
+    def _cohort_features(
+        self, definition, features_df: Optional[pd.DataFrame]
+    ) -> pd.DataFrame:
+        if features_df is not None:
+            return features_df.iloc[slice(definition.start_row, definition.end_row)]
+        return ArrowStore(self.store_dir).read_rows(
+            FEATURES_TABLE,
+            definition.start_row,
+            definition.end_row,
+            self.feature_names,
+        )
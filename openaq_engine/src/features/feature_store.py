@@ -0,0 +1,244 @@
+import glob
+import hashlib
+import inspect
+import json
+import logging
+import os
+import shutil
+import uuid
+from dataclasses import asdict
+from typing import Any, Callable, List, Optional, Sequence, Set
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+INDEX_FILE = "_index.parquet"
+# the update that wrote each stored row
+BATCH_COL = "_batch"
+
+
+def feature_set_version(configs: Sequence[Any], code: Sequence[Any]) -> str:
+    """
+    Hash of the feature configs and of the source of the modules defining
+    `code`, so changing either starts a new version of the feature set.
+    """
+    source = "".join(inspect.getsource(inspect.getmodule(obj)) for obj in code)
+    return hashlib.sha256(
+        json.dumps(
+            dict(
+                configs=[asdict(config) for config in configs],
+                code=hashlib.sha256(source.encode()).hexdigest(),
+            ),
+            sort_keys=True,
+            default=str,
+        ).encode()
+    ).hexdigest()[:12]
+
+
+class FeatureStore:
+    """
+    Features of each reading, kept between runs as parquet partitioned by
+    feature set version and day, with an index of the (key, day) pairs
+    stored, how many readings each was computed from and the batch that
+    wrote it. A day is computed again when a pair of it is new or has a
+    different number of readings, as when readings arrive after the day
+    was stored, and its new batch supersedes the earlier one. A new
+    version leaves the older ones behind to be pruned.
+    """
+
+    def __init__(
+        self,
+        store_dir: str,
+        version: str,
+        key_cols: Sequence[str] = ("parameter", "location"),
+        date_col: str = "timestamp_utc",
+    ):
+        self.store_dir = store_dir
+        self.version = version
+        self.key_cols = list(key_cols)
+        self.date_col = date_col
+
+    @property
+    def version_dir(self) -> str:
+        return os.path.join(self.store_dir, f"version={self.version}")
+
+    @property
+    def index_cols(self) -> List[str]:
+        return self.key_cols + ["day"]
+
+    def _with_day(self, df: pd.DataFrame) -> pd.DataFrame:
+        return df.assign(day=df[self.date_col].astype(str).str[:10])
+
+    def prune(self):
+        """Delete the features of every other version"""
+        if not os.path.isdir(self.store_dir):
+            return
+        for name in os.listdir(self.store_dir):
+            if name.startswith("version=") and name != f"version={self.version}":
+                logging.info(f"Feature definitions changed, removing {name}")
+                shutil.rmtree(os.path.join(self.store_dir, name))
+
+    def index(self) -> pd.DataFrame:
+        path = os.path.join(self.version_dir, INDEX_FILE)
+        if not os.path.exists(path):
+            return pd.DataFrame(
+                {
+                    **{col: pd.Series(dtype=str) for col in self.index_cols},
+                    "rows": pd.Series(dtype=int),
+                    "batch": pd.Series(dtype=str),
+                }
+            )
+        return pd.read_parquet(path)
+
+    def _row_counts(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Readings of each (key, day) of `df`, compared as strings"""
+        return (
+            df[self.index_cols]
+            .astype(str)
+            .value_counts(sort=False)
+            .rename("rows")
+            .reset_index()
+        )
+
+    def stale_days(self, df: pd.DataFrame) -> Set[str]:
+        """
+        The days of `df` with a (key, day) not stored from the same number
+        of readings. A sensor's features depend on the other sensors of
+        its day, so the whole day is computed again.
+        """
+        counts_df = self._row_counts(self._with_day(df)).merge(
+            self.index()[self.index_cols + ["rows"]].astype(
+                dict.fromkeys(self.index_cols, str)
+            ),
+            on=self.index_cols,
+            how="left",
+            suffixes=("", "_stored"),
+        )
+        return set(counts_df.day[counts_df.rows != counts_df.rows_stored])
+
+    def missing(self, df: pd.DataFrame) -> pd.DataFrame:
+        """The rows of `df` on days whose features aren't stored as they are"""
+        df = self._with_day(df)
+        return df[df.day.isin(self.stale_days(df))]
+
+    def update(
+        self,
+        df: pd.DataFrame,
+        compute: Callable[[pd.DataFrame], pd.DataFrame],
+        lookback_days: int = 0,
+    ) -> int:
+        """
+        Compute and append the features of the stale days of `df`.
+        `compute` sees every row of those days, and of the `lookback_days`
+        before, so features over neighbors and history come out as they
+        would over the whole of `df`.
+        """
+        df = self._with_day(df)
+        stale_days = self.stale_days(df)
+        if not stale_days:
+            logging.info(f"All features are stored in {self.version_dir}")
+            return 0
+        days = pd.to_datetime(pd.Series(sorted(stale_days)))
+        context_days = {
+            day.strftime("%Y-%m-%d")
+            for offset in range(lookback_days + 1)
+            for day in days - pd.Timedelta(days=offset)
+        }
+        features_df = self._with_day(compute(df[df.day.isin(context_days)]))
+        features_df = features_df[features_df.day.isin(stale_days)]
+        self.append(features_df, self._row_counts(df[df.day.isin(stale_days)]))
+        logging.info(
+            f"""Stored features of {len(features_df)} readings on
+            {len(stale_days)} new or changed days in {self.version_dir}"""
+        )
+        return len(features_df)
+
+    def append(self, features_df: pd.DataFrame, new_keys_df: pd.DataFrame):
+        """
+        Write day partitions as a new batch, and replace the index entries
+        and files of the batches written earlier for the same days
+        """
+        batch = uuid.uuid4().hex
+        pq.write_to_dataset(
+            pa.Table.from_pandas(
+                features_df.assign(**{BATCH_COL: batch}), preserve_index=False
+            ),
+            self.version_dir,
+            partition_cols=["day"],
+            basename_template=f"{batch}-{{i}}.parquet",
+        )
+        index_df = self.index()
+        superseded = index_df.day.astype(str).isin(set(new_keys_df.day))
+        # the index is rewritten whole, it only holds a row per sensor day
+        pd.concat(
+            [index_df[~superseded], new_keys_df.assign(batch=batch)],
+            ignore_index=True,
+        ).to_parquet(os.path.join(self.version_dir, INDEX_FILE), index=False)
+        for day, old_batch in (
+            index_df[superseded][["day", "batch"]].drop_duplicates().itertuples(False)
+        ):
+            for path in glob.glob(
+                os.path.join(self.version_dir, f"day={day}", f"{old_batch}-*.parquet")
+            ):
+                os.remove(path)
+
+    def read(
+        self, df: pd.DataFrame, columns: Optional[List[str]] = None
+    ) -> pd.DataFrame:
+        """
+        Point in time join of `df` with the stored features: each row gets
+        those of the latest stored reading of its key at or before its
+        timestamp on the same day. The rows of `df` keep their order.
+        """
+        df = self._with_day(df).reset_index(drop=True)
+        features_df = (
+            ds.dataset(
+                self.version_dir,
+                format="parquet",
+                partitioning=ds.partitioning(
+                    pa.schema([("day", pa.string())]), flavor="hive"
+                ),
+                exclude_invalid_files=True,
+            )
+            .to_table(filter=ds.field("day").isin(sorted(df.day.unique())))
+            .to_pandas()
+        )
+        # only the current batch of each day, in case superseded files
+        # outlived an interrupted update
+        features_df = features_df.merge(
+            self.index()[["day", "batch"]]
+            .drop_duplicates()
+            .astype(str)
+            .rename(columns={"batch": BATCH_COL}),
+            on=["day", BATCH_COL],
+        )
+        feature_cols = [
+            col
+            for col in (columns or features_df.columns)
+            if col not in self.index_cols + [self.date_col, BATCH_COL]
+        ]
+        joined_df = pd.merge_asof(
+            self._join_keys(df).assign(_row=np.arange(len(df))).sort_values("_time"),
+            self._join_keys(features_df)
+            .join(features_df[feature_cols])
+            .sort_values("_time"),
+            on="_time",
+            by=self.index_cols,
+        )
+        return df.drop(columns=[col for col in feature_cols if col in df.columns]).join(
+            joined_df.set_index("_row")[feature_cols]
+        )
+
+    def _join_keys(self, df: pd.DataFrame) -> pd.DataFrame:
+        """The index columns as strings and the parsed timestamps"""
+        codes, timestamps = pd.factorize(df[self.date_col])
+        return (
+            df[self.index_cols]
+            .astype(str)
+            .assign(
+                _time=pd.to_datetime(pd.Series(timestamps), utc=True).to_numpy()[codes]
+            )
+        )
@@ -1,15 +1,37 @@
 import logging
-from typing import List, Tuple
+from functools import lru_cache, partial
+from typing import List, Optional, Tuple
 
 import ee
 import pandas as pd
-from ee.ee_exception import EEException
 from geetools import batch
 from googleapiclient.errors import HttpError
-from joblib import Parallel, delayed
+from src.executor import Executor
+from src.utils.instrumentation import measure
 from src.utils.utils import ee_array_to_df, get_data
 
-from config.model_settings import EEConfig
+from config.model_settings import BackendConfig, EEConfig
+
+# the satellite features of a reading are those of its location and day
+LOCATION_COLS = ["x", "y", "day"]
+
+
+@lru_cache(maxsize=None)
+def _fake_earth_engine(latency_seconds: float, quota_per_minute: int, seed: int):
+    from src.backends.fake_ee import FakeEarthEngine
+
+    return FakeEarthEngine(latency_seconds, quota_per_minute, seed)
+
+
+def earth_engine(config: BackendConfig):
+    """The `ee` module, or the fake selected in `BackendConfig`"""
+    if config.EE_BACKEND == "fake":
+        return _fake_earth_engine(
+            config.FAKE_EE_LATENCY_SECONDS,
+            config.FAKE_EE_QUOTA_PER_MINUTE,
+            config.FAKE_SEED,
+        )
+    return ee
 
 
 class EEFeatures:
@@ -22,15 +44,18 @@ class EEFeatures:
         bucket_name: str,
         path_to_private_key: str,
         service_account: str,
+        executor: Optional[Executor] = None,
     ):
 
         self.date_col = date_col
         self.table_name = table_name
-        self.variable_satellites = variable_satellites
-        self.static_satellites = static_satellites
+        # the config yields one-shot zips, every location needs them
+        self.variable_satellites = list(variable_satellites)
+        self.static_satellites = list(static_satellites)
         self.bucket_name = bucket_name
         self.path_to_private_key = path_to_private_key
         self.service_account = service_account
+        self.executor = executor or Executor("threads", name="earth-engine")
 
     @classmethod
     def from_dataclass_config(cls, config: EEConfig) -> "EEFeatures":
@@ -42,20 +67,35 @@ class EEFeatures:
             bucket_name=config.BUCKET_NAME,
             path_to_private_key=config.PATH_TO_PRIVATE_KEY,
             service_account=config.SERVICE_ACCOUNT,
+            executor=Executor.from_dataclass_config(
+                config.EXECUTOR, name="earth-engine"
+            ),
         )
 
+    @property
+    def ee(self):
+        # resolved on access, so instances stay picklable for process executors
+        return earth_engine(BackendConfig())
+
     def execute(self, df, save_images):
-        ee.Authenticate()
+        """Add the satellite bands of each reading's location and day to `df`"""
+        self.ee.Authenticate()
         # end_date, start_date = self._generate_timerange()
+        # readings of a sensor on the same day share their images
+        locations_df = df[LOCATION_COLS].drop_duplicates()
         satellite_df = pd.concat(
-            Parallel(n_jobs=-1, backend="multiprocessing", verbose=5)(
-                delayed(self.execute_for_location)(lon, lat, day, save_images)
-                for lon, lat, day in zip(df.x, df.y, df.day)
-            ),
+            [
+                pd.DataFrame(columns=LOCATION_COLS),
+                *self.executor.map(
+                    partial(self.execute_for_location, save_images=save_images),
+                    locations_df.x,
+                    locations_df.y,
+                    locations_df.day,
+                ),
+            ],
         ).reset_index(drop=True)
         features_df = self.generate_features(satellite_df)
-
-        print(features_df)
+        return df.merge(features_df, on=LOCATION_COLS, how="left")
 
     def execute_for_location(self, lon, lat, day, save_images):
         """
@@ -78,8 +118,8 @@ class EEFeatures:
         """
         df_list = []
 
-        day_of_interest = ee.Date(day)
-        centroid_point = ee.Geometry.Point(lon, lat)
+        day_of_interest = self.ee.Date(day)
+        centroid_point = self.ee.Geometry.Point(lon, lat)
         for (
             collection,
             image_bands,
@@ -102,7 +142,7 @@ class EEFeatures:
                 ee_df = ee_array_to_df(satellite_value, image_bands)
                 ee_df["x"] = lon
                 ee_df["y"] = lat
-                ee_df["date"] = day
+                ee_df["day"] = day
                 df_list.append(ee_df)
             except IndexError:
                 pass
@@ -126,11 +166,11 @@ class EEFeatures:
                 ee_df = ee_array_to_df(satellite_value, image_bands)
                 ee_df["x"] = lon
                 ee_df["y"] = lat
-                ee_df["date"] = day
+                ee_df["day"] = day
                 df_list.append(ee_df)
             except IndexError:
                 pass
-        return pd.concat(df_list)
+        return pd.concat(df_list) if df_list else pd.DataFrame(columns=LOCATION_COLS)
 
     def execute_for_collection(
         self,
@@ -153,7 +193,7 @@ class EEFeatures:
         save_images:
             a boolean flag whether to write satellite data to google storage
         """
-        ee.Initialize()
+        self.ee.Initialize()
 
         # logging.info(
         #     "please sigup to Google Earth Engine here:"
@@ -163,7 +203,7 @@ class EEFeatures:
         try:
             logging.info(f"Downloading: {collection}")
 
-            image_collection = ee.ImageCollection(collection).select(image_bands)
+            image_collection = self.ee.ImageCollection(collection).select(image_bands)
 
             if save_images is True:
                 down_args = {
@@ -177,7 +217,7 @@ class EEFeatures:
                 task.start()
             else:
                 return image_collection
-        except (EEException, HttpError):
+        except (self.ee.EEException, HttpError):
             logging.warning(
                 f"""Image collection {image_collection.getInfo()}
                 does not match any existing location."""
@@ -185,23 +225,15 @@ class EEFeatures:
             pass
 
     def generate_features(self, satellite_df):
-        features_df = (
+        """The mean of each band over the images of a location and day"""
+        return (
             satellite_df.drop(
-                labels=["time", "datetime", "longitude", "latitude"], axis=1
+                columns=["time", "datetime", "longitude", "latitude"], errors="ignore"
             )
-            .groupby(
-                [
-                    "x",
-                    "y",
-                ],
-                as_index=False,
-            )
-            .agg(["mean"])
-            .reset_index()
+            .groupby(LOCATION_COLS, as_index=False)
+            .mean()
         )
 
-        print(features_df)
-
     def _generate_timerange(self) -> Tuple[str]:
         start_date_query = """SELECT {date_col} AS datetime
         FROM {table} ORDER BY {date_col} ASC limit 1;""".format(
@@ -217,6 +249,20 @@ class EEFeatures:
         start_date = str(get_data(start_date_query)["datetime"][0])
         return end_date, start_date
 
+    def _get_value_from_static_collection(
+        self,
+        image_collection,
+        day_of_interest,
+        centroid_point,
+        resolution,
+    ):
+        """Every image of a collection that barely changes, e.g. population"""
+        try:
+            with measure("ee", "getRegion"):
+                return image_collection.getRegion(centroid_point, resolution).getInfo()
+        except (self.ee.EEException, HttpError):
+            pass
+
     def _get_value_from_variable_collection(
         self,
         image_collection,
@@ -229,11 +275,12 @@ class EEFeatures:
             filtered_image_collection = image_collection.filterDate(
                 day_of_interest, day_of_interest.advance(period, "day")
             )
-            info = filtered_image_collection.getRegion(
-                centroid_point, resolution
-            ).getInfo()
+            with measure("ee", "getRegion"):
+                info = filtered_image_collection.getRegion(
+                    centroid_point, resolution
+                ).getInfo()
             return info
-        except (EEException, HttpError):
+        except (self.ee.EEException, HttpError):
             # logging.warning(
             #     f"""Centroid location and date does not
             #     match any existing ee.Image."""
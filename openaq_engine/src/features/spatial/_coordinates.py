@@ -0,0 +1,57 @@
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+COORDINATE_FEATURES = ["pca_lat", "pca_lng"]
+
+
+class CoordinateFeatures:
+    """
+    The sensors' coordinates rotated onto their principal axes, so a
+    tree can split along the direction the sensors spread the most
+    rather than only along latitude and longitude. The rotation is fit
+    on the distinct sensor locations, so busy sensors don't pull it.
+    """
+
+    def __init__(self):
+        self.mean_ = None
+        self.components_ = None
+
+    def fit(self, df: pd.DataFrame) -> "CoordinateFeatures":
+        return self.fit_batches([df])
+
+    def fit_batches(self, dfs: Iterable[pd.DataFrame]) -> "CoordinateFeatures":
+        """Fit on the distinct locations of a stream of batches"""
+        locations = (
+            pd.concat(
+                [df[["y", "x"]].dropna().drop_duplicates() for df in dfs]
+                or [pd.DataFrame(columns=["y", "x"])]
+            )
+            .drop_duplicates()
+            .to_numpy(dtype="float64")
+        )
+        if len(locations) == 0:
+            self.mean_, self.components_ = np.zeros(2), np.eye(2)
+            return self
+        self.mean_ = locations.mean(axis=0)
+        centered = locations - self.mean_
+        # eigh sorts ascending, the first component has the largest variance
+        _, vectors = np.linalg.eigh(centered.T @ centered)
+        components = vectors[:, ::-1].T
+        # an eigenvector's sign is arbitrary, point each along its largest entry
+        signs = np.sign(components[np.arange(2), np.abs(components).argmax(axis=1)])
+        self.components_ = components * signs[:, None]
+        return self
+
+    def execute(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Add the rotated coordinates to every reading of `df`"""
+        rotated = (
+            df[["y", "x"]].to_numpy(dtype="float64") - self.mean_
+        ) @ self.components_.T
+        return df.assign(
+            **{
+                name: rotated[:, index]
+                for index, name in enumerate(COORDINATE_FEATURES)
+            }
+        )
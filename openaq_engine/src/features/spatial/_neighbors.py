@@ -0,0 +1,165 @@
+import logging
+from typing import List
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+from src.utils.instrumentation import measure
+
+from config.model_settings import NeighborFeaturesConfig
+
+EARTH_RADIUS_KM = 6371.0088
+
+NEIGHBOR_FEATURES = [
+    "knn_mean",
+    "knn_idw",
+    "knn_distance_km",
+    "radius_count",
+    "radius_mean",
+    "radius_idw",
+]
+
+
+class NeighborFeatures:
+    """
+    What the nearby sensors measured on the same day: the mean and
+    inverse distance weighted mean of the `k_neighbors` nearest sensors'
+    values and of those within `radius_km`, and how many there are. A
+    sensor never counts as its own neighbor, so its target can't leak
+    into its features.
+
+    Sensors are indexed in a haversine ball tree per parameter and day,
+    and each day's queries run as one vectorized batch.
+    """
+
+    def __init__(
+        self,
+        date_col: str,
+        target_col: str,
+        k_neighbors: int,
+        radius_km: float,
+        min_distance_km: float,
+    ):
+        self.date_col = date_col
+        self.target_col = target_col
+        self.k_neighbors = k_neighbors
+        self.radius_km = radius_km
+        self.min_distance_km = min_distance_km
+
+    @classmethod
+    def from_dataclass_config(
+        cls, config: NeighborFeaturesConfig
+    ) -> "NeighborFeatures":
+        return cls(
+            date_col=config.DATE_COL,
+            target_col=config.TARGET_COL,
+            k_neighbors=config.K_NEIGHBORS,
+            radius_km=config.RADIUS_KM,
+            min_distance_km=config.MIN_DISTANCE_KM,
+        )
+
+    @property
+    def sensor_cols(self) -> List[str]:
+        return ["parameter", "day", "x", "y"]
+
+    def execute(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Add the neighbor features to every reading of `df`"""
+        with measure("features", "neighbors", rows_in=len(df)) as metrics:
+            df = df.assign(day=df[self.date_col].astype(str).str[:10])
+            # a sensor's readings of the day are summarised by their mean
+            sensors_df = (
+                df.assign(
+                    **{
+                        self.target_col: pd.to_numeric(
+                            df[self.target_col], errors="coerce"
+                        )
+                    }
+                )
+                .dropna(subset=["x", "y", self.target_col])
+                .groupby(self.sensor_cols, sort=False, as_index=False)[self.target_col]
+                .mean()
+            )
+            if sensors_df.empty:
+                # no reading has coordinates and a value to be a neighbor
+                df = df.assign(**dict.fromkeys(NEIGHBOR_FEATURES, np.nan)).assign(
+                    radius_count=0
+                )
+                metrics["rows_out"] = len(df)
+                return df
+            features_df = pd.concat(
+                [
+                    self._day_features(day_df)
+                    for _, day_df in sensors_df.groupby(
+                        ["parameter", "day"], sort=False
+                    )
+                ],
+                ignore_index=True,
+            )
+            logging.info(
+                f"""Computed neighbor features for {len(features_df)}
+                sensor days"""
+            )
+            df = df.merge(features_df, on=self.sensor_cols, how="left")
+            df["radius_count"] = df.radius_count.fillna(0).astype(int)
+            metrics["rows_out"] = len(df)
+        return df
+
+    def _day_features(self, day_df: pd.DataFrame) -> pd.DataFrame:
+        coordinates = np.radians(day_df[["y", "x"]].to_numpy(dtype=float))
+        values = day_df[self.target_col].to_numpy(dtype=float)
+        tree = BallTree(coordinates, metric="haversine")
+        return day_df[self.sensor_cols].assign(
+            **self._nearest(tree, coordinates, values),
+            **self._within_radius(tree, coordinates, values),
+        )
+
+    def _nearest(self, tree: BallTree, coordinates: np.ndarray, values: np.ndarray):
+        n_sensors = len(values)
+        # one extra neighbor to make up for the sensor itself
+        distances, indices = tree.query(
+            coordinates, k=min(self.k_neighbors + 1, n_sensors)
+        )
+        # sensors sharing coordinates may come before the sensor itself
+        others = indices != np.arange(n_sensors)[:, None]
+        others &= np.cumsum(others, axis=1) <= self.k_neighbors
+        distances_km = distances * EARTH_RADIUS_KM
+        weights = others / np.maximum(distances_km, self.min_distance_km)
+        neighbor_values = values[indices]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return dict(
+                knn_mean=(neighbor_values * others).sum(axis=1) / others.sum(axis=1),
+                knn_idw=(neighbor_values * weights).sum(axis=1) / weights.sum(axis=1),
+                knn_distance_km=(distances_km * others).sum(axis=1)
+                / others.sum(axis=1),
+            )
+
+    def _within_radius(
+        self, tree: BallTree, coordinates: np.ndarray, values: np.ndarray
+    ):
+        n_sensors = len(values)
+        indices, distances = tree.query_radius(
+            coordinates, r=self.radius_km / EARTH_RADIUS_KM, return_distance=True
+        )
+        # flatten the ragged neighbor lists to aggregate them with bincount
+        sensors = np.repeat(
+            np.arange(n_sensors), np.fromiter(map(len, indices), int, n_sensors)
+        )
+        neighbors = np.concatenate(indices)
+        distances_km = np.concatenate(distances) * EARTH_RADIUS_KM
+        others = neighbors != sensors
+        sensors, neighbors = sensors[others], neighbors[others]
+        weights = 1 / np.maximum(distances_km[others], self.min_distance_km)
+        count = np.bincount(sensors, minlength=n_sensors)
+        weight_sum = np.bincount(sensors, weights=weights, minlength=n_sensors)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return dict(
+                radius_count=count,
+                radius_mean=np.bincount(
+                    sensors, weights=values[neighbors], minlength=n_sensors
+                )
+                / count,
+                radius_idw=np.bincount(
+                    sensors, weights=values[neighbors] * weights, minlength=n_sensors
+                )
+                / weight_sum,
+            )
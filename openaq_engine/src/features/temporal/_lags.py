@@ -0,0 +1,388 @@
+import copy
+import logging
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from src.utils.instrumentation import measure
+
+from config.model_settings import TemporalFeaturesConfig
+
+EPOCH = pd.Timestamp("1970-01-01", tz="UTC")
+
+
+class TemporalFeatures:
+    """
+    Per sensor lags, rolling statistics and diurnal and weekly profiles of
+    the target. Readings are resampled onto a regular `freq` grid per
+    sensor, so lags and windows count grid steps and a gap in the
+    readings shows up as missing values rather than older readings.
+
+    Every feature only looks at grid steps strictly before the reading's
+    own step, so no feature depends on anything measured at or after the
+    reading, and training cohorts never see values from the validation
+    windows that follow them.
+
+    The grid is one array sorted by sensor and step, and every feature is
+    computed on it at once with `searchsorted` and cumulative sums, with
+    no loop over sensors.
+
+    `execute_batches` gives the same features over batches of readings
+    sorted by time, e.g. one parameter and day each, carrying what later
+    batches need from the earlier ones.
+    """
+
+    def __init__(
+        self,
+        date_col: str,
+        target_col: str,
+        entity_cols: List[str],
+        freq: str,
+        lags: List[int],
+        rolling_windows: List[int],
+        rolling_stats: List[str],
+        profiles: List[str],
+        feature_names: List[str],
+    ):
+        self.date_col = date_col
+        self.target_col = target_col
+        self.entity_cols = entity_cols
+        self.freq = pd.Timedelta(freq)
+        self.lags = lags
+        self.rolling_windows = rolling_windows
+        self.rolling_stats = rolling_stats
+        self.profiles = profiles
+        self.feature_names = feature_names
+
+    @classmethod
+    def from_dataclass_config(
+        cls, config: TemporalFeaturesConfig
+    ) -> "TemporalFeatures":
+        return cls(
+            date_col=config.DATE_COL,
+            target_col=config.TARGET_COL,
+            entity_cols=config.ENTITY_COLS,
+            freq=config.FREQ,
+            lags=config.LAGS,
+            rolling_windows=config.ROLLING_WINDOWS,
+            rolling_stats=config.ROLLING_STATS,
+            profiles=config.PROFILES,
+            feature_names=config.FEATURE_NAMES,
+        )
+
+    @property
+    def history_steps(self) -> int:
+        """How many steps back the lags and windows reach"""
+        return max(self.lags + self.rolling_windows, default=0)
+
+    def execute(
+        self, df: pd.DataFrame, profile_totals: Optional[pd.DataFrame] = None
+    ) -> pd.DataFrame:
+        """
+        Add the temporal features to every reading of `df`. The profiles
+        also count the steps of `profile_totals`, the sums and counts of
+        earlier steps per sensor, profile and group.
+        """
+        with measure("features", "temporal", rows_in=len(df)) as metrics:
+            if df.empty:
+                return df.assign(**dict.fromkeys(self.feature_names, np.nan))
+            grid_keys, inverse, grid_values, grid_steps, span = self._grid(df)
+            features = self._grid_features(
+                grid_keys,
+                grid_values,
+                grid_steps,
+                span,
+                self._prior_totals(df, inverse, grid_steps, profile_totals),
+            )
+            logging.info(
+                f"""Computed temporal features for {len(df)} readings
+                on {len(grid_keys)} sensor steps"""
+            )
+            df = df.assign(
+                **{name: feature[inverse] for name, feature in features.items()}
+            )
+            metrics["rows_out"] = len(df)
+        return df
+
+    def execute_batches(self, dfs: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """
+        The features of each batch of `dfs`, as `execute` would give them
+        over all the batches together, when every batch's readings come
+        after those of the batches before it. The readings of the last
+        `history_steps` steps and the last reading of each sensor are
+        carried to the next batch for the lags, windows and gaps, and the
+        profiles continue from the running sums of every earlier step.
+        """
+        history_df, profile_totals = None, None
+        without_profiles = copy.copy(self)
+        without_profiles.profiles = []
+        only_profiles = copy.copy(self)
+        only_profiles.lags, only_profiles.rolling_windows = [], []
+        for df in dfs:
+            if df.empty:
+                yield self.execute(df)
+                continue
+            context_df = pd.concat(
+                [history_df, df] if history_df is not None else [df],
+                ignore_index=True,
+            )
+            context_df = without_profiles.execute(context_df)
+            features_df = context_df.tail(len(df)).set_axis(df.index)
+            if self.profiles:
+                profiles_df = only_profiles.execute(df, profile_totals)
+                features_df = features_df.assign(
+                    **{
+                        f"{profile}_mean": profiles_df[f"{profile}_mean"]
+                        for profile in self.profiles
+                    }
+                )
+            yield features_df[list(df.columns) + self.feature_names]
+            history_df = self._history(context_df[df.columns], self._steps(df).max())
+            if self.profiles:
+                batch_totals = self.profile_totals(df)
+                profile_totals = (
+                    batch_totals
+                    if profile_totals is None
+                    else profile_totals.add(batch_totals, fill_value=0)
+                )
+
+    def _history(self, df: pd.DataFrame, last_step: int) -> pd.DataFrame:
+        """
+        The readings of `df` the lags, windows and gaps of the steps after
+        `last_step` see
+        """
+        steps = self._steps(df)
+        sensor_last_steps = (
+            pd.Series(steps, index=df.index)
+            .groupby([df[col] for col in self.entity_cols], dropna=False)
+            .transform("max")
+            .to_numpy()
+        )
+        return df[
+            (steps > last_step - self.history_steps) | (steps == sensor_last_steps)
+        ].reset_index(drop=True)
+
+    def profile_totals(self, df: pd.DataFrame) -> pd.DataFrame:
+        """The sums and counts of the steps of `df` per sensor, profile and group"""
+        _, inverse, grid_values, grid_steps, _ = self._grid(df)
+        valid = ~np.isnan(grid_values)
+        entities_df = self._grid_entities(df, inverse)
+        profile_groups = self._profile_groups(grid_steps)
+        return (
+            pd.concat(
+                [
+                    entities_df.assign(
+                        profile=profile,
+                        group=profile_groups[profile],
+                        sum=np.where(valid, grid_values, 0.0),
+                        count=valid.astype(np.int64),
+                    )
+                    for profile in self.profiles
+                ],
+                ignore_index=True,
+            )
+            .groupby(self.entity_cols + ["profile", "group"], dropna=False)[
+                ["sum", "count"]
+            ]
+            .sum()
+        )
+
+    def _steps(self, df: pd.DataFrame) -> np.ndarray:
+        # readings share few distinct timestamps, parse each one once
+        timestamp_codes, timestamps = pd.factorize(df[self.date_col])
+        return (
+            (pd.to_datetime(pd.Series(timestamps), utc=True) - EPOCH) // self.freq
+        ).to_numpy(dtype=np.int64)[timestamp_codes]
+
+    def _grid(self, df: pd.DataFrame):
+        """
+        The sensor step keys, the grid position of each reading, the mean
+        of each step, its step number and the key span of a sensor
+        """
+        steps = self._steps(df)
+        sensors = (
+            df.groupby(self.entity_cols, sort=False, dropna=False)
+            .ngroup()
+            .to_numpy(dtype=np.int64)
+        )
+        # sensors are far enough apart on the key that no lag or window
+        # reaches into the previous sensor
+        first_step = steps.min()
+        span = steps.max() - first_step + self.history_steps + 1
+        grid_keys, inverse = np.unique(
+            sensors * span + steps - first_step, return_inverse=True
+        )
+        inverse = inverse.ravel()
+        grid_values = self._resample(
+            inverse,
+            pd.to_numeric(df[self.target_col], errors="coerce").to_numpy(dtype=float),
+            len(grid_keys),
+        )
+        return grid_keys, inverse, grid_values, grid_keys % span + first_step, span
+
+    def _grid_entities(self, df: pd.DataFrame, inverse: np.ndarray) -> pd.DataFrame:
+        """The entity columns of each grid step"""
+        _, first_rows = np.unique(inverse, return_index=True)
+        return df[self.entity_cols].iloc[first_rows].reset_index(drop=True)
+
+    def _prior_totals(
+        self,
+        df: pd.DataFrame,
+        inverse: np.ndarray,
+        grid_steps: np.ndarray,
+        profile_totals: Optional[pd.DataFrame],
+    ) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """The earlier sums and counts of each grid step's profile groups"""
+        if profile_totals is None or not self.profiles:
+            return {}
+        entities_df = self._grid_entities(df, inverse)
+        profile_groups = self._profile_groups(grid_steps)
+        prior = {}
+        for profile in self.profiles:
+            totals_df = entities_df.assign(
+                profile=profile, group=profile_groups[profile]
+            ).merge(
+                profile_totals.reset_index(),
+                on=self.entity_cols + ["profile", "group"],
+                how="left",
+            )
+            prior[profile] = (
+                totals_df["sum"].fillna(0.0).to_numpy(dtype=float),
+                totals_df["count"].fillna(0).to_numpy(dtype=float),
+            )
+        return prior
+
+    def _profile_groups(self, steps: np.ndarray) -> Dict[str, np.ndarray]:
+        step_ns = self.freq.value
+        return dict(
+            diurnal=steps * step_ns // 3_600_000_000_000 % 24,
+            # the epoch was a thursday, monday is 0
+            weekly=(steps * step_ns // 86_400_000_000_000 + 3) % 7,
+        )
+
+    @staticmethod
+    def _resample(inverse: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+        """Mean of the readings in each sensor step, NaN without any"""
+        valid = ~np.isnan(values)
+        sums = np.bincount(inverse[valid], weights=values[valid], minlength=size)
+        counts = np.bincount(inverse[valid], minlength=size)
+        with np.errstate(invalid="ignore"):
+            return sums / counts
+
+    def _grid_features(
+        self,
+        keys: np.ndarray,
+        values: np.ndarray,
+        steps: np.ndarray,
+        span: int,
+        prior: Optional[Dict[str, Tuple[np.ndarray, np.ndarray]]] = None,
+    ) -> Dict[str, np.ndarray]:
+        valid = ~np.isnan(values)
+        filled = np.where(valid, values, 0.0)
+        features: Dict[str, np.ndarray] = {}
+        # where each step's key minus an offset would sort, shared by the
+        # lags and windows of the same length
+        positions = {
+            offset: np.searchsorted(keys, keys - offset)
+            for offset in set(self.lags + self.rolling_windows)
+        }
+        for lag in self.lags:
+            position = np.minimum(positions[lag], len(keys) - 1)
+            features[f"lag_{lag}"] = np.where(
+                keys[position] == keys - lag, values[position], np.nan
+            )
+
+        # prefix sums turn every window sum into one subtraction
+        sums = np.concatenate([[0.0], np.cumsum(filled)])
+        squares = np.concatenate([[0.0], np.cumsum(filled**2)])
+        counts = np.concatenate([[0], np.cumsum(valid)])
+        end = np.arange(len(keys))
+        for window in self.rolling_windows:
+            start = positions[window]
+            count = counts[end] - counts[start]
+            total = sums[end] - sums[start]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = total / count
+                variance = np.where(
+                    count > 1,
+                    (squares[end] - squares[start] - total * mean) / (count - 1),
+                    np.nan,
+                )
+            stats = dict(
+                mean=mean,
+                std=np.sqrt(np.clip(variance, 0, None)),
+                count=count.astype(float),
+            )
+            if "max" in self.rolling_stats:
+                stats["max"] = self._range_max(values, start, end)
+            for stat in self.rolling_stats:
+                features[f"rolling_{window}_{stat}"] = stats[stat]
+
+        profile_groups = self._profile_groups(steps)
+        for profile in self.profiles:
+            # both profiles have fewer than 24 groups per sensor
+            features[f"{profile}_mean"] = self._expanding_mean(
+                keys // span * 24 + profile_groups[profile],
+                filled,
+                valid,
+                *(prior or {}).get(profile, ()),
+            )
+
+        previous = np.concatenate([[-1], keys[:-1]])
+        same_sensor = previous // span == keys // span
+        features["gap_steps"] = np.where(same_sensor, keys - previous, np.nan)
+        return features
+
+    @staticmethod
+    def _range_max(values: np.ndarray, start: np.ndarray, end: np.ndarray):
+        """
+        Max of `values[start:end]` for every pair of bounds, ignoring NaN.
+        Each range is covered by two blocks of the largest power of two
+        length that fits, and the block maxima are built by doubling.
+        """
+        lengths = end - start
+        level = np.zeros(len(values), dtype=np.int64)
+        nonempty = lengths > 0
+        level[nonempty] = np.floor(np.log2(lengths[nonempty])).astype(np.int64)
+        result = np.full(len(values), np.nan)
+        # block_max[i] is the max of values[i:i + 2**j]
+        block_max = values.copy()
+        for j in range(int(level.max()) + 1):
+            if j:
+                half = 2 ** (j - 1)
+                block_max[:-half] = np.fmax(block_max[:-half], block_max[half:])
+            rows = np.flatnonzero(nonempty & (level == j))
+            result[rows] = np.fmax(
+                block_max[start[rows]], block_max[end[rows] - 2**j]
+            )
+        return result
+
+    @staticmethod
+    def _expanding_mean(
+        groups: np.ndarray,
+        filled: np.ndarray,
+        valid: np.ndarray,
+        prior_sums: Union[np.ndarray, float] = 0.0,
+        prior_counts: Union[np.ndarray, float] = 0.0,
+    ) -> np.ndarray:
+        """
+        Mean of the earlier steps of each group, the grid is time sorted,
+        and of the `prior_counts` steps summing to `prior_sums` before it
+        """
+        order = np.argsort(groups, kind="stable")
+        ordered_groups = groups[order]
+        group_start = np.concatenate(
+            [[True], ordered_groups[1:] != ordered_groups[:-1]]
+        )
+        start = np.maximum.accumulate(np.where(group_start, np.arange(len(order)), 0))
+        sums = np.cumsum(filled[order]) - filled[order]
+        counts = np.cumsum(valid[order]) - valid[order]
+        prior_sums = np.broadcast_to(prior_sums, order.shape)[order]
+        prior_counts = np.broadcast_to(prior_counts, order.shape)[order]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ordered_mean = (sums - sums[start] + prior_sums) / (
+                counts - counts[start] + prior_counts
+            )
+        mean = np.empty_like(ordered_mean)
+        mean[order] = ordered_mean
+        return mean
@@ -0,0 +1,146 @@
+import os
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+class IntermediateStore(ABC):
+    """Hands dataframes from one stage to the next"""
+
+    @abstractmethod
+    def write(
+        self, name: str, df: pd.DataFrame, split_rows: Sequence[int] = ()
+    ) -> None:
+        ...
+
+    @abstractmethod
+    def read(self, name: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        ...
+
+    @abstractmethod
+    def exists(self, name: str) -> bool:
+        ...
+
+    def read_rows(
+        self,
+        name: str,
+        start_row: int,
+        end_row: int,
+        columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        return self.read(name, columns).iloc[start_row:end_row]
+
+
+class ArrowStore(IntermediateStore):
+    """
+    Local Arrow IPC (feather v2) files, read through a memory map so
+    numeric columns are not copied. `split_rows` cuts the file into record
+    batches at cohort boundaries, so reading one cohort only touches the
+    batches it spans.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.store_dir, f"{name}.arrow")
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+    def write(
+        self, name: str, df: pd.DataFrame, split_rows: Sequence[int] = ()
+    ) -> None:
+        os.makedirs(self.store_dir, exist_ok=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        boundaries = sorted(
+            {0, table.num_rows, *[int(row) for row in split_rows]}
+            & set(range(table.num_rows + 1))
+        )
+        with pa.OSFile(self._path(name), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                for start_row, end_row in zip(boundaries[:-1], boundaries[1:]):
+                    writer.write_table(
+                        table.slice(start_row, end_row - start_row),
+                        max_chunksize=end_row - start_row,
+                    )
+
+    def write_batches(self, name: str, batches: Iterable[pd.DataFrame]) -> int:
+        """
+        Stream frames into one file as consecutive record batches, without
+        holding them together, and return the number of rows written. The
+        file replaces any earlier one once complete, so the frames may be
+        read from it.
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        writer, schema, rows = None, None, 0
+        with pa.OSFile(f"{self._path(name)}.tmp", "wb") as sink:
+            for df in batches:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    schema = table.schema
+                    writer = pa.ipc.new_file(sink, schema)
+                writer.write_table(
+                    table.select(schema.names).cast(schema),
+                    max_chunksize=max(len(df), 1),
+                )
+                rows += len(df)
+            if writer is None:
+                writer = pa.ipc.new_file(sink, pa.schema([]))
+            writer.close()
+        os.replace(f"{self._path(name)}.tmp", self._path(name))
+        return rows
+
+    def iter_batches(
+        self, name: str, columns: Optional[List[str]] = None
+    ) -> Iterator[pd.DataFrame]:
+        """Read the file one record batch at a time"""
+        reader = pa.ipc.open_file(pa.memory_map(self._path(name), "r"))
+        for index in range(reader.num_record_batches):
+            table = pa.Table.from_batches([reader.get_batch(index)])
+            if columns is not None:
+                table = table.select(columns)
+            yield table.to_pandas(split_blocks=True)
+
+    def num_rows(self, name: str) -> int:
+        reader = pa.ipc.open_file(pa.memory_map(self._path(name), "r"))
+        return sum(
+            reader.get_batch(index).num_rows
+            for index in range(reader.num_record_batches)
+        )
+
+    def read_table(self, name: str) -> pa.Table:
+        """Zero-copy view of the whole file"""
+        return pa.ipc.open_file(pa.memory_map(self._path(name), "r")).read_all()
+
+    def read(self, name: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        table = self.read_table(name)
+        if columns is not None:
+            table = table.select(columns)
+        return table.to_pandas(split_blocks=True)
+
+    def read_rows(
+        self,
+        name: str,
+        start_row: int,
+        end_row: int,
+        columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        reader = pa.ipc.open_file(pa.memory_map(self._path(name), "r"))
+        if end_row <= start_row:
+            return reader.schema.empty_table().to_pandas()
+        batches = [
+            reader.get_batch(index) for index in range(reader.num_record_batches)
+        ]
+        offsets = np.cumsum([0] + [batch.num_rows for batch in batches])
+        first = int(np.searchsorted(offsets, start_row, "right")) - 1
+        last = int(np.searchsorted(offsets, end_row, "left"))
+        table = pa.Table.from_batches(batches[first:last], schema=reader.schema).slice(
+            start_row - offsets[first], end_row - start_row
+        )
+        if columns is not None:
+            table = table.select(columns)
+        return table.to_pandas(split_blocks=True)
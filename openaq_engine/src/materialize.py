@@ -0,0 +1,194 @@
+import logging
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import pandas as pd
+from src.query.partitions import PartitionLayout
+from src.query.sql_filter import SqlFilter
+from src.utils.instrumentation import timed
+from src.utils.utils import query_results
+
+from config.model_settings import MaterializeConfig
+
+# athena refuses to write more than 100 partitions in one CTAS/INSERT INTO
+MAX_PARTITIONS_PER_QUERY = 100
+STAGING_PARTITION_COLS = {"month_utc": "%Y-%m"}
+
+
+class Materialize:
+    """
+    Maintain a pre-filtered, partitioned parquet copy of the openaq table
+    holding only the pollutant to predict, so cohort queries stop
+    scanning the raw multi-pollutant table.
+    """
+
+    def __init__(
+        self,
+        date_col: str,
+        source_table_name: str,
+        staging_table_name: str,
+        pollutant_to_predict: str,
+        history_start_date: str,
+        filters: List[str],
+        partition_layout: PartitionLayout,
+        region_name: str,
+        database: str,
+        bucket: str,
+        s3_output: str,
+    ):
+        self.date_col = date_col
+        self.source_table_name = source_table_name
+        self.staging_table_name = staging_table_name
+        self.pollutant_to_predict = pollutant_to_predict
+        self.history_start_date = history_start_date
+        self.filters = filters
+        self.partition_layout = partition_layout
+        self.region_name = region_name
+        self.database = database
+        self.bucket = bucket
+        self.s3_output = s3_output
+
+    @classmethod
+    def from_dataclass_config(cls, config: MaterializeConfig) -> "Materialize":
+        return cls(
+            date_col=config.DATE_COL,
+            source_table_name=config.SOURCE_TABLE_NAME,
+            staging_table_name=config.STAGING_TABLE_NAME,
+            pollutant_to_predict=config.POLLUTANT_TO_PREDICT,
+            history_start_date=config.HISTORY_START_DATE,
+            filters=config.FILTERS,
+            partition_layout=PartitionLayout.from_dataclass_config(config),
+            region_name=config.REGION,
+            database=config.DATABASE,
+            bucket=config.S3_BUCKET,
+            s3_output=config.S3_OUTPUT,
+        )
+
+    @property
+    def params(self):
+        return {
+            "region": str(self.region_name),
+            "database": str(self.database),
+            "bucket": str(self.bucket),
+            "path": f"{self.s3_output}/materialize",
+        }
+
+    @timed("stage", "materialize")
+    def execute(self):
+        """
+        Create the staging table on the first run, then append every
+        measurement newer than the latest one already staged, in batches
+        that respect athena's partition limit.
+        """
+        if not self._staging_table_exists():
+            logging.info(f"Creating staging table {self.staging_table_name}")
+            query_results(self.params, self._create_table_query())
+            watermark = None
+        else:
+            watermark = self._get_watermark()
+
+        start_date = watermark or self.history_start_date
+        logging.info(
+            f"""Materializing {self.pollutant_to_predict} measurements
+            after {start_date} into {self.staging_table_name}"""
+        )
+        for index, (batch_start, batch_end) in enumerate(self._get_batches(start_date)):
+            # the watermark row itself is already staged
+            inclusive = watermark is None or index > 0
+            query_results(
+                self.params, self._insert_query(batch_start, batch_end, inclusive)
+            )
+
+    def _select_query(self) -> str:
+        return """SELECT *,
+            from_iso8601_timestamp({date_col}) AS timestamp_utc,
+            coordinates.latitude AS latitude,
+            coordinates.longitude AS longitude,
+            substr({date_col}, 1, 7) AS {partition_col}
+        FROM {source}""".format(
+            date_col=self.date_col,
+            source=self.source_table_name,
+            partition_col=list(STAGING_PARTITION_COLS)[0],
+        )
+
+    def _create_table_query(self) -> str:
+        return """CREATE TABLE {staging}
+        WITH (
+            format = 'PARQUET',
+            write_compression = 'SNAPPY',
+            external_location = 's3://{bucket}/{s3_output}/staging/{staging}/',
+            partitioned_by = ARRAY['{partition_col}']
+        ) AS {select}
+        WHERE {filters}
+        WITH NO DATA;""".format(
+            staging=self.staging_table_name,
+            bucket=self.bucket,
+            s3_output=self.s3_output,
+            partition_col=list(STAGING_PARTITION_COLS)[0],
+            select=self._select_query(),
+            filters=SqlFilter.from_options(self.filters, self.pollutant_to_predict),
+        )
+
+    def _insert_query(self, start_date: str, end_date: str, inclusive: bool) -> str:
+        return """INSERT INTO {staging}
+        {select}
+        WHERE {date_col} {operator} '{start_date}'
+        AND {date_col} < '{end_date}'{partition_filter}
+        AND {filters};""".format(
+            staging=self.staging_table_name,
+            select=self._select_query(),
+            date_col=self.date_col,
+            operator=">=" if inclusive else ">",
+            start_date=start_date,
+            end_date=end_date,
+            partition_filter=self.partition_layout.partition_filter(
+                start_date, end_date, self.pollutant_to_predict
+            ),
+            filters=SqlFilter.from_options(self.filters, self.pollutant_to_predict),
+        )
+
+    def _get_batches(self, start_date: str):
+        """Split [start_date, now] into runs of at most 100 monthly partitions"""
+        months = pd.period_range(
+            pd.Timestamp(start_date[:10]),
+            datetime.now(timezone.utc).replace(tzinfo=None),
+            freq="M",
+        )
+        for index in range(0, len(months), MAX_PARTITIONS_PER_QUERY):
+            batch_end_index = index + MAX_PARTITIONS_PER_QUERY
+            batch = months[index:batch_end_index]
+            batch_start = start_date if index == 0 else str(batch[0].start_time.date())
+            batch_end = str((batch[-1] + 1).start_time.date())
+            yield batch_start, batch_end
+
+    def _staging_table_exists(self) -> bool:
+        count = self._fetch_value(
+            """SELECT count(*) FROM information_schema.tables
+            WHERE table_schema = '{database}'
+            AND table_name = '{staging}';""".format(
+                database=self.database,
+                staging=self.staging_table_name,
+            )
+        )
+        return bool(count) and int(count) > 0
+
+    def _get_watermark(self) -> Optional[str]:
+        """Latest `date_col` already staged, read from the last partition only"""
+        partition_col = list(STAGING_PARTITION_COLS)[0]
+        return self._fetch_value(
+            """SELECT max({date_col}) FROM {staging}
+            WHERE {partition_col} = (
+                SELECT max({partition_col}) FROM "{staging}$partitions"
+            );""".format(
+                date_col=self.date_col,
+                staging=self.staging_table_name,
+                partition_col=partition_col,
+            )
+        )
+
+    def _fetch_value(self, sql_query: str) -> Optional[str]:
+        response_query_result = query_results(self.params, sql_query)
+        rows = response_query_result["ResultSet"]["Rows"][1:]
+        for row in rows:
+            return row["Data"][0].get("VarCharValue")
+        return None
@@ -0,0 +1,176 @@
+import logging
+import os
+import time
+from dataclasses import replace
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from joblib import effective_n_jobs
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from src.executor import Executor
+from src.features.feature_matrix import COHORTS_FILE, MATRIX_NAME, FeatureMatrix
+from src.utils.instrumentation import timed
+from src.utils.utils import write_to_db
+
+from config.model_settings import ModelRunnerConfig
+
+METRICS_COLUMNS = [
+    "parameter",
+    "train_validation_set",
+    "training_cohort",
+    "validation_cohort",
+    "training_rows",
+    "validation_rows",
+    "fit_seconds",
+    "rmse",
+    "mae",
+    "r2",
+]
+
+
+def _labelled(matrix: FeatureMatrix):
+    """The rows with a target, a view unless some are missing"""
+    labelled = ~np.isnan(matrix.target)
+    if labelled.all():
+        return matrix.values, matrix.target
+    return matrix.values[labelled], matrix.target[labelled]
+
+
+def _run_split(
+    matrix: FeatureMatrix, split: Dict[str, Any], model_params: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Fit on the split's training rows and score on its validation rows"""
+    X_train, y_train = _labelled(
+        matrix.rows(split["training_start_row"], split["training_end_row"])
+    )
+    X_validation, y_validation = _labelled(
+        matrix.rows(split["validation_start_row"], split["validation_end_row"])
+    )
+    metrics = dict(
+        parameter=split["parameter"],
+        train_validation_set=split["train_validation_set"],
+        training_cohort=split["training_cohort"],
+        validation_cohort=split["validation_cohort"],
+        training_rows=len(y_train),
+        validation_rows=len(y_validation),
+        fit_seconds=np.nan,
+        rmse=np.nan,
+        mae=np.nan,
+        r2=np.nan,
+    )
+    if not len(y_train) or not len(y_validation):
+        return metrics
+    start = time.perf_counter()
+    model = RandomForestRegressor(**model_params).fit(X_train, y_train)
+    metrics["fit_seconds"] = time.perf_counter() - start
+    predictions = model.predict(X_validation)
+    metrics["rmse"] = float(np.sqrt(mean_squared_error(y_validation, predictions)))
+    metrics["mae"] = float(mean_absolute_error(y_validation, predictions))
+    if len(y_validation) > 1:
+        metrics["r2"] = float(r2_score(y_validation, predictions))
+    return metrics
+
+
+class ModelRunner:
+    """
+    Train and evaluate a random forest on every (training, validation)
+    split of the time splitter, the splits in parallel.
+
+    The feature matrix is memory mapped once and every split is a pair
+    of row ranges into it, so workers slice views of the same pages
+    rather than each loading or receiving its own copy of the data.
+    """
+
+    def __init__(
+        self,
+        matrix_dir: str,
+        model_params: Dict[str, Any],
+        executor: Executor,
+        metrics_table: str,
+    ):
+        self.matrix_dir = matrix_dir
+        self.model_params = model_params
+        self.executor = executor
+        self.metrics_table = metrics_table
+
+    @classmethod
+    def from_dataclass_config(cls, config: ModelRunnerConfig) -> "ModelRunner":
+        executor_config = config.EXECUTOR
+        if executor_config.N_JOBS == -1:
+            # a core per model thread rather than oversubscribing them
+            executor_config = replace(
+                executor_config,
+                N_JOBS=max(effective_n_jobs(-1) // config.MODEL_N_JOBS, 1),
+            )
+        return cls(
+            matrix_dir=config.MATRIX_DIR,
+            model_params=dict(
+                n_estimators=config.N_ESTIMATORS,
+                max_depth=config.MAX_DEPTH,
+                min_samples_leaf=config.MIN_SAMPLES_LEAF,
+                random_state=config.RANDOM_STATE,
+                n_jobs=config.MODEL_N_JOBS,
+            ),
+            executor=Executor.from_dataclass_config(
+                executor_config, name="model-runner"
+            ),
+            metrics_table=config.METRICS_TABLE,
+        )
+
+    @staticmethod
+    def splits(cohorts_df: pd.DataFrame) -> List[Dict[str, Any]]:
+        """Pair each training cohort with the validation cohort of its window"""
+        keys = ["parameter", "train_validation_set"]
+        columns = keys + ["cohort", "start_row", "end_row"]
+        splits_df = cohorts_df.loc[cohorts_df.cohort_type == "training", columns].merge(
+            cohorts_df.loc[cohorts_df.cohort_type == "validation", columns],
+            on=keys,
+            suffixes=("", "_validation"),
+        )
+        return [
+            dict(
+                parameter=split.parameter,
+                train_validation_set=int(split.train_validation_set),
+                training_cohort=split.cohort,
+                training_start_row=int(split.start_row),
+                training_end_row=int(split.end_row),
+                validation_cohort=split.cohort_validation,
+                validation_start_row=int(split.start_row_validation),
+                validation_end_row=int(split.end_row_validation),
+            )
+            for split in splits_df.itertuples()
+        ]
+
+    @timed("stage", "model-runner")
+    def execute(
+        self, cohorts_df: Optional[pd.DataFrame] = None, engine=None
+    ) -> pd.DataFrame:
+        """
+        Returns
+        -------
+        pd.DataFrame
+            The validation metrics of every split, also written to the
+            database in one batch when an `engine` is given
+        """
+        if cohorts_df is None:
+            cohorts_df = pd.read_parquet(os.path.join(self.matrix_dir, COHORTS_FILE))
+        splits = self.splits(cohorts_df)
+        matrix = FeatureMatrix.load(self.matrix_dir, MATRIX_NAME, mmap=True)
+        logging.info(
+            f"""Running {len(splits)} splits over a {matrix.values.shape}
+            feature matrix on {self.executor.workers} workers"""
+        )
+        metrics_df = pd.DataFrame(
+            self.executor.map(
+                _run_split,
+                [matrix] * len(splits),
+                splits,
+                [self.model_params] * len(splits),
+            ),
+            columns=METRICS_COLUMNS,
+        )
+        if engine is not None:
+            write_to_db(metrics_df, engine, self.metrics_table, "public", "replace")
+        return metrics_df
@@ -0,0 +1,104 @@
+import os
+import resource
+import shutil
+import uuid
+from typing import Iterator, List, Sequence, Tuple
+from urllib.parse import unquote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def current_rss_gb() -> float:
+    """Resident memory of this process, the peak where /proc is missing"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**30
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+
+
+class MemoryBudget:
+    """
+    Fails a stage as soon as the process grows past `max_memory_gb`,
+    rather than letting the worker swap or be killed by the OOM killer.
+    """
+
+    def __init__(self, max_memory_gb: float):
+        self.max_memory_gb = max_memory_gb
+
+    def check(self, stage: str):
+        rss_gb = current_rss_gb()
+        if rss_gb > self.max_memory_gb:
+            raise MemoryError(
+                f"""{stage} is using {rss_gb:.1f} GB, more than the
+                {self.max_memory_gb} GB budget, lower BATCH_ROWS"""
+            )
+
+
+class SpillStore:
+    """
+    Record batches spilled to hive partitioned parquet under `spill_dir`,
+    one file per batch and partition, so a partition can be read back
+    without loading the others.
+    """
+
+    def __init__(self, spill_dir: str, partition_cols: Sequence[str]):
+        self.spill_dir = spill_dir
+        self.partition_cols = list(partition_cols)
+        self.batches = 0
+
+    def clear(self):
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def write(self, df: pd.DataFrame):
+        if df.empty:
+            return
+        # a batch of a multi-year history spans thousands of partitions,
+        # grouping its rows writes each partition's file in one go
+        df = df.sort_values(self.partition_cols, kind="mergesort")
+        n_partitions = df.groupby(self.partition_cols, dropna=False).ngroups
+        pq.write_to_dataset(
+            pa.Table.from_pandas(df, preserve_index=False),
+            self.spill_dir,
+            partition_cols=self.partition_cols,
+            # file names sort in write order, keeping the rows' order
+            basename_template=f"{self.batches:08d}-{uuid.uuid4().hex}-{{i}}.parquet",
+            max_partitions=max(n_partitions, 1024),
+        )
+        self.batches += 1
+
+    def iter_partitions(self) -> Iterator[Tuple[Tuple[str, ...], pd.DataFrame]]:
+        """Yield the partitions in sorted order of their partition values"""
+        for partition_dir, values in self._partition_dirs(self.spill_dir, ()):
+            # batches may infer different types for all-null columns, so the
+            # files are read one by one rather than as a single dataset
+            yield values, pd.concat(
+                [
+                    pq.read_table(os.path.join(partition_dir, name)).to_pandas()
+                    for name in sorted(os.listdir(partition_dir))
+                ],
+                ignore_index=True,
+            ).assign(**dict(zip(self.partition_cols, values)))
+
+    def _partition_dirs(
+        self, path: str, values: Tuple[str, ...]
+    ) -> List[Tuple[str, Tuple[str, ...]]]:
+        if len(values) == len(self.partition_cols):
+            return [(path, values)]
+        if not os.path.isdir(path):
+            return []
+        col = self.partition_cols[len(values)]
+        partitions = sorted(
+            (unquote(name.split("=", 1)[1]), name)
+            for name in os.listdir(path)
+            if name.startswith(f"{col}=")
+        )
+        return [
+            partition
+            for value, name in partitions
+            for partition in self._partition_dirs(
+                os.path.join(path, name), values + (value,)
+            )
+        ]
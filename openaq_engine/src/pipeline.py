@@ -0,0 +1,306 @@
+import ast
+import hashlib
+import importlib.util
+import inspect
+import json
+import logging
+import os
+from dataclasses import fields, is_dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+from src.cohort_store import CohortStore
+from src.time_splitter import SPLIT_COLUMNS
+from src.utils.instrumentation import measure
+
+from config.model_settings import PipelineConfig
+
+
+def fingerprint_config(config: Any) -> Any:
+    """
+    The contents of a config, nested configs included, without the fields
+    marked with `metadata={"fingerprint": False}`. Upper case class
+    attributes that aren't fields, e.g. `TABLE_NAME`, are included too.
+    """
+    if is_dataclass(config) and not isinstance(config, type):
+        config_fields = fields(config)
+        field_names = {config_field.name for config_field in config_fields}
+        return {
+            **{
+                name: fingerprint_config(value)
+                for name, value in vars(type(config)).items()
+                if name.isupper()
+                and name not in field_names
+                and not callable(value)
+                and not isinstance(value, property)
+            },
+            **{
+                config_field.name: fingerprint_config(
+                    getattr(config, config_field.name)
+                )
+                for config_field in config_fields
+                if config_field.metadata.get("fingerprint", True)
+            },
+        }
+    if isinstance(config, dict):
+        return {key: fingerprint_config(value) for key, value in config.items()}
+    if isinstance(config, (list, tuple)):
+        return [fingerprint_config(value) for value in config]
+    return config
+
+
+def source_modules(code: Iterable[Any]) -> Dict[str, str]:
+    """
+    The source of the modules defining `code` and of every `src` module
+    they import, directly or through each other, by module name. Imports
+    inside functions count too, the modules are read without importing
+    them.
+    """
+    sources: Dict[str, str] = {}
+    pending = [inspect.getmodule(obj) for obj in code]
+    pending_names: List[str] = []
+    for module in pending:
+        sources[module.__name__] = inspect.getsource(module)
+        pending_names.extend(_imported_modules(sources[module.__name__]))
+    while pending_names:
+        name = pending_names.pop()
+        if name in sources:
+            continue
+        with open(_source_path(name)) as f:
+            sources[name] = f.read()
+        pending_names.extend(_imported_modules(sources[name]))
+    return sources
+
+
+def _imported_modules(source: str) -> List[str]:
+    """The `src` modules imported by `source`"""
+    names = []
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            names.append(node.module)
+            # `from src.utils import utils` imports a module
+            names.extend(f"{node.module}.{alias.name}" for alias in node.names)
+    return [
+        name
+        for name in names
+        if name.split(".")[0] == "src" and _source_path(name) is not None
+    ]
+
+
+def _source_path(name: str) -> Optional[str]:
+    """The file of module `name`, None for names that aren't modules"""
+    try:
+        spec = importlib.util.find_spec(name)
+    except ModuleNotFoundError:
+        return None
+    return spec.origin if spec is not None and spec.has_location else None
+
+
+class Stage:
+    """
+    A pipeline stage: `run` receives the outputs of its `upstream` stages
+    and returns an output that `to_frames`/`from_frames` convert to and
+    from the dataframes persisted as the stage's parquet artifacts.
+
+    `code` lists the classes whose module source, and that of every `src`
+    module it imports, versions the stage, and
+    `always_run` marks cheap stages that depend on data outside the
+    fingerprint; their downstream stages are still skipped when the
+    output hash does not change.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        config: Any,
+        run: Callable[..., Any],
+        to_frames: Callable[[Any], Dict[str, pd.DataFrame]],
+        from_frames: Callable[[Dict[str, pd.DataFrame]], Any],
+        upstream: Optional[List[str]] = None,
+        code: Optional[List[Any]] = None,
+        always_run: bool = False,
+    ):
+        self.name = name
+        self.config = config
+        self.run = run
+        self.to_frames = to_frames
+        self.from_frames = from_frames
+        self.upstream = upstream or []
+        self.code = code or [run]
+        self.always_run = always_run
+
+
+class PipelineRunner:
+    """
+    Run stages in order, skipping every stage whose fingerprint (config
+    contents, upstream artifact hashes and code version) matches the one
+    stored with its cached artifacts.
+    """
+
+    def __init__(self, artifact_dir: str, stages: Optional[List[Stage]] = None):
+        self.artifact_dir = artifact_dir
+        self.stages = stages or []
+
+    @classmethod
+    def from_dataclass_config(cls, config: PipelineConfig) -> "PipelineRunner":
+        return cls(artifact_dir=config.ARTIFACT_DIR)
+
+    def add_stage(self, stage: Stage) -> "PipelineRunner":
+        self.stages.append(stage)
+        return self
+
+    def execute(
+        self,
+        from_stage: Optional[str] = None,
+        to_stage: Optional[str] = None,
+        force: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Run the stages between `from_stage` and `to_stage` (inclusive).
+        Earlier stages are loaded from their cached artifacts, and
+        `from_stage` itself always reruns.
+        """
+        names = [stage.name for stage in self.stages]
+        start = names.index(from_stage) if from_stage else 0
+        end = names.index(to_stage) + 1 if to_stage else len(names)
+
+        outputs, hashes = {}, {}
+        for position, stage in enumerate(self.stages[:end]):
+            fingerprint = self._fingerprint(stage, hashes)
+            manifest = self._read_manifest(stage)
+            cached = manifest is not None and manifest["fingerprint"] == fingerprint
+            if position < start:
+                if manifest is None:
+                    raise ValueError(
+                        f"No cached artifacts for {stage.name}, run it first"
+                    )
+                cached = True
+            elif (
+                force
+                or stage.always_run
+                or (from_stage is not None and position == start)
+            ):
+                cached = False
+
+            with measure("pipeline", stage.name, cached=cached):
+                if cached:
+                    logging.info(f"Skipping {stage.name}, loading cached artifacts")
+                    outputs[stage.name] = stage.from_frames(self._read_frames(stage))
+                    hashes[stage.name] = manifest["artifact_hash"]
+                else:
+                    logging.info(f"Running {stage.name}")
+                    outputs[stage.name] = stage.run(
+                        *[outputs[upstream] for upstream in stage.upstream]
+                    )
+                    hashes[stage.name] = self._write_artifacts(
+                        stage, fingerprint, stage.to_frames(outputs[stage.name])
+                    )
+        return outputs
+
+    def _stage_dir(self, stage: Stage) -> str:
+        return os.path.join(self.artifact_dir, stage.name)
+
+    def _fingerprint(self, stage: Stage, hashes: Dict[str, str]) -> str:
+        sources = source_modules(stage.code)
+        code = "".join(sources[name] for name in sorted(sources))
+        return hashlib.sha256(
+            json.dumps(
+                dict(
+                    config=fingerprint_config(stage.config),
+                    upstream={name: hashes[name] for name in stage.upstream},
+                    code=hashlib.sha256(code.encode()).hexdigest(),
+                ),
+                sort_keys=True,
+                default=str,
+            ).encode()
+        ).hexdigest()
+
+    def _read_manifest(self, stage: Stage) -> Optional[Dict[str, Any]]:
+        path = os.path.join(self._stage_dir(stage), "manifest.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _read_frames(self, stage: Stage) -> Dict[str, pd.DataFrame]:
+        manifest = self._read_manifest(stage)
+        return {
+            name: pd.read_parquet(os.path.join(self._stage_dir(stage), file_name))
+            for name, file_name in manifest["artifacts"].items()
+        }
+
+    def _write_artifacts(
+        self, stage: Stage, fingerprint: str, frames: Dict[str, pd.DataFrame]
+    ) -> str:
+        """Persist the stage output and return the hash of its artifacts"""
+        stage_dir = self._stage_dir(stage)
+        os.makedirs(stage_dir, exist_ok=True)
+        artifact_hash = hashlib.sha256()
+        artifacts = {}
+        for name, df in sorted(frames.items()):
+            file_name = f"{name}.parquet"
+            path = os.path.join(stage_dir, file_name)
+            df.to_parquet(path, index=False)
+            with open(path, "rb") as f:
+                artifact_hash.update(f.read())
+            artifacts[name] = file_name
+
+        with open(os.path.join(stage_dir, "manifest.json"), "w") as f:
+            json.dump(
+                dict(
+                    fingerprint=fingerprint,
+                    artifact_hash=artifact_hash.hexdigest(),
+                    artifacts=artifacts,
+                ),
+                f,
+                indent=4,
+            )
+        return artifact_hash.hexdigest()
+
+
+def windows_to_frames(splits: np.ndarray) -> Dict[str, pd.DataFrame]:
+    return {"windows": pd.DataFrame(splits, columns=SPLIT_COLUMNS)}
+
+
+def frames_to_windows(frames: Dict[str, pd.DataFrame]) -> np.ndarray:
+    return frames["windows"][SPLIT_COLUMNS].to_numpy(dtype="datetime64[D]")
+
+
+def cohort_store_to_frames(cohort_store: CohortStore) -> Dict[str, pd.DataFrame]:
+    return {
+        "measurements": cohort_store.measurements_df,
+        "cohort_definitions": cohort_store.cohort_definitions_df,
+    }
+
+
+def frames_to_cohort_store(frames: Dict[str, pd.DataFrame]) -> CohortStore:
+    return CohortStore(frames["measurements"], frames["cohort_definitions"])
+
+
+def features_to_frames(features_df) -> Dict[str, pd.DataFrame]:
+    if features_df is None:
+        return {}
+    return {"features": features_df}
+
+
+def frames_to_features(frames: Dict[str, pd.DataFrame]):
+    return frames.get("features")
+
+
+def matrices_to_frames(matrices_df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    return {"matrices": matrices_df}
+
+
+def frames_to_matrices(frames: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    return frames["matrices"]
+
+
+def metrics_to_frames(metrics_df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    return {"metrics": metrics_df}
+
+
+def frames_to_metrics(frames: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    return frames["metrics"]
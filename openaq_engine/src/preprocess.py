@@ -1,15 +1,27 @@
 import logging
 import re
+import tempfile
 import warnings
 from datetime import datetime, timezone
+from functools import partial
+from typing import Callable, List, Optional, Union
 
 import pandas as pd
 from shapely.errors import ShapelyDeprecationWarning
 from shapely.geometry import Point
+from src.executor import Executor
+from src.intermediate_store import ArrowStore
+from src.preprocessing.aggregate import Aggregate
 from src.preprocessing.filter import Filter
+from src.preprocessing.region import Region
+from src.utils.instrumentation import measure
 
 from config.model_settings import CohortBuilderConfig
 
+SHARDS = "shards"
+# columns the row steps add, which row-wise `apply` never adds to no rows
+ROW_STEP_COLUMNS = dict(timestamp_utc=str, timestamp_local=str, y=float, x=float)
+
 
 class Preprocess:
     def __init__(
@@ -20,6 +32,17 @@ class Preprocess:
         filter_no_coordinates: bool = True,
         filter_countries: bool = False,
         filter_cities: bool = False,
+        filter_region: bool = False,
+        countries: Optional[List[str]] = None,
+        cities: Optional[List[str]] = None,
+        region: Optional[Region] = None,
+        aggregate_daily: bool = False,
+        expected_daily_readings: int = 24,
+        pollutant_to_predict: Union[str, List[str]] = (
+            CohortBuilderConfig.POLLUTANT_TO_PREDICT
+        ),
+        executor: Optional[Executor] = None,
+        shard_rows: int = 100_000,
     ):
         self.filter_pollutant = filter_pollutant
         self.filter_non_null_values = filter_non_null_values
@@ -27,9 +50,18 @@ class Preprocess:
         self.filter_no_coordinates = filter_no_coordinates
         self.filter_countries = filter_countries
         self.filter_cities = filter_cities
+        self.filter_region = filter_region
+        self.countries = countries
+        self.cities = cities
+        self.region = region
+        self.aggregate_daily = aggregate_daily
+        self.expected_daily_readings = expected_daily_readings
+        self.pollutant_to_predict = pollutant_to_predict
+        self.executor = executor
+        self.shard_rows = shard_rows
 
     @classmethod
-    def from_options(cls, filters) -> "Preprocess":
+    def from_options(cls, filters, **kwargs) -> "Preprocess":
         filter_default = dict.fromkeys(
             [
                 "filter_pollutant",
@@ -41,7 +73,7 @@ class Preprocess:
         )
         for filter_ in filters:
             filter_default[filter_] = True
-        return cls(**filter_default)
+        return cls(**filter_default, **kwargs)
 
     def execute(self, input_df: pd.DataFrame, **kwargs) -> pd.DataFrame:
         """
@@ -58,18 +90,95 @@ class Preprocess:
         pd.DataFrame
             Processed data after all processing steps have been applied sequentially
         """
-        return (
-            input_df.pipe(self.filter_data)
-            .pipe(self.get_timestamps)
-            .pipe(self.extract_coordinates)
-            .pipe(self.validate_point)
+        if self.executor is None or len(input_df) <= self.shard_rows:
+            df = self._execute_row_steps(input_df)
+        else:
+            df = self._execute_sharded(input_df)
+        # daily aggregation spans shards, so it runs on the reassembled rows
+        return self._execute_steps(df, [self.aggregate])
+
+    @property
+    def row_steps(self) -> List[Callable[[pd.DataFrame], pd.DataFrame]]:
+        """The steps that only look at one row at a time"""
+        return [
+            self.filter_data,
+            self.get_timestamps,
+            self.extract_coordinates,
+            self.validate_point,
+            self.filter_points,
+        ]
+
+    def _execute_steps(
+        self,
+        df: pd.DataFrame,
+        steps: List[Callable[[pd.DataFrame], pd.DataFrame]],
+    ) -> pd.DataFrame:
+        for step in steps:
+            with measure("preprocess", step.__name__, rows_in=len(df)) as metrics:
+                df = step(df)
+                metrics["rows_out"] = len(df)
+        return df
+
+    def _execute_row_steps(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Run the row steps, stopping as soon as no rows are left"""
+        for step in self.row_steps:
+            if df.empty:
+                return self._empty_output(df)
+            df = self._execute_steps(df, [step])
+        return df
+
+    @staticmethod
+    def _empty_output(df: pd.DataFrame) -> pd.DataFrame:
+        """No rows, with the columns the row steps would have left"""
+        return df.drop(columns=["pnt", "point_is_valid"], errors="ignore").assign(
+            **{
+                column: pd.Series(dtype=dtype)
+                for column, dtype in ROW_STEP_COLUMNS.items()
+                if column not in df.columns
+            }
+        )
+
+    def _execute_sharded(self, input_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Run the row steps on `shard_rows` sized shards with the executor.
+        The frame is written once to a local arrow file that every worker
+        memory maps, and each worker writes its output shard next to it,
+        so no dataframe is pickled between processes.
+        """
+        boundaries = list(range(0, len(input_df), self.shard_rows)) + [len(input_df)]
+        logging.info(
+            f"Preprocessing {len(input_df)} rows in {len(boundaries) - 1} shards"
+        )
+        with tempfile.TemporaryDirectory() as store_dir:
+            store = ArrowStore(store_dir)
+            store.write(SHARDS, input_df, split_rows=boundaries)
+            shard_names = self.executor.map(
+                partial(_preprocess_shard, self, store_dir),
+                range(len(boundaries) - 1),
+                boundaries[:-1],
+                boundaries[1:],
+            )
+            return pd.concat(
+                [store.read(shard_name) for shard_name in shard_names],
+                ignore_index=True,
+            )
+
+    def aggregate(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Optionally aggregate the cleaned readings to daily values"""
+        if not self.aggregate_daily:
+            return df
+        df = Aggregate.daily(df, self.expected_daily_readings)
+        logging.info(
+            f"""Total number of daily values left after
+            aggregating readings: {len(df)}"""
         )
+        return df
 
     def filter_data(self, df: pd.DataFrame):
         if self.filter_pollutant:
             df = Filter.filter_pollutant(
                 df,
-                CohortBuilderConfig.POLLUTANT_TO_PREDICT,
+                self.pollutant_to_predict,
             )
             logging.info(
                 f"""Total number of pollutant values left after
@@ -94,20 +203,31 @@ class Preprocess:
                 f"""Total number of pollutant values left after
                 filtering non-null values : {len(df)}"""
             )
-        if self.filter_countries:
-            df = df.pipe(Filter.filter_countries)
+        if self.filter_countries and self.countries:
+            df = Filter.filter_countries(df, self.countries)
             logging.info(
                 f"""Total number of pollutant values left after
                 filtering countries: {len(df)}"""
             )
-        if self.filter_cities:
-            df = df.pipe(Filter.filter_cities)
+        if self.filter_cities and self.cities:
+            df = Filter.filter_cities(df, self.cities)
             logging.info(
                 f"""Total number of pollutant values left after
                 filtering cities: {len(df)}"""
             )
         return df
 
+    def filter_points(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Keep the readings inside the region, once coordinates are extracted"""
+        if not self.filter_region or self.region is None:
+            return df
+        df = Filter.filter_region(df, self.region)
+        logging.info(
+            f"""Total number of pollutant values left after
+            filtering region: {len(df)}"""
+        )
+        return df
+
     def get_timestamps(self, df: pd.DataFrame) -> pd.DataFrame:
         """
         Extract timezone into "utc" and "local" timezone columns.
@@ -171,3 +291,15 @@ class Preprocess:
             warnings.filterwarnings("ignore", category=ShapelyDeprecationWarning)
             row["pnt"] = Point(row["x"], row["y"])
             return row
+
+
+def _preprocess_shard(
+    preprocess: Preprocess, store_dir: str, shard: int, start_row: int, end_row: int
+) -> str:
+    """Run the row steps on one shard, returning the name of its output"""
+    store = ArrowStore(store_dir)
+    store.write(
+        f"{SHARDS}_{shard}",
+        preprocess._execute_row_steps(store.read_rows(SHARDS, start_row, end_row)),
+    )
+    return f"{SHARDS}_{shard}"
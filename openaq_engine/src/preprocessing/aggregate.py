@@ -0,0 +1,77 @@
+from typing import Sequence
+
+import pandas as pd
+
+
+class Aggregate:
+    @staticmethod
+    def daily(df: pd.DataFrame, expected_daily_readings: int = 24) -> pd.DataFrame:
+        """
+        Aggregate readings to one row per location, coordinates and day
+        with the mean, min, max, count and completeness of `value`.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Preprocessed readings with `timestamp_utc`, `x` and `y`
+        """
+        df = df.assign(
+            value=pd.to_numeric(df.value, errors="coerce"),
+            day=df.timestamp_utc.str[:10],
+        )
+        keys = [
+            col
+            for col in ["parameter", "location", "x", "y", "day"]
+            if col in df.columns
+        ]
+        other_cols = [
+            col
+            for col in df.columns
+            if col not in keys
+            and col not in ["value", "date", "timestamp_utc", "timestamp_local"]
+        ]
+        grouped = df.groupby(keys, sort=False, dropna=False)
+        return (
+            grouped[other_cols]
+            .first()
+            .join(
+                grouped.value.agg(
+                    value="mean",
+                    value_min="min",
+                    value_max="max",
+                    value_count="count",
+                )
+            )
+            .reset_index()
+            .assign(
+                value_completeness=lambda df: (
+                    df.value_count / expected_daily_readings
+                ).clip(upper=1.0),
+                timestamp_utc=lambda df: df.day + "T00:00:00.000000Z",
+            )
+        )
+
+    @staticmethod
+    def co_located(
+        df: pd.DataFrame, keys: Sequence[str] = ("location", "timestamp_utc")
+    ) -> pd.DataFrame:
+        """
+        Add the value of every pollutant measured at the same location and
+        time as a wide `value_<parameter>` column.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Long dataframe with one row per `parameter` reading
+        """
+        keys = [col for col in keys if col in df.columns]
+        wide_df = (
+            df.assign(value=pd.to_numeric(df.value, errors="coerce"))
+            .pivot_table(
+                index=keys, columns="parameter", values="value", aggfunc="mean"
+            )
+            .add_prefix("value_")
+            .reset_index()
+        )
+        wide_df.columns.name = None
+        return df.merge(wide_df, on=keys, how="left")
@@ -1,31 +1,26 @@
-from typing import List
+from typing import List, Sequence, Union
 
+import numpy as np
 import pandas as pd
+from src.preprocessing.region import Region
+from src.utils.utils import to_list
 
 
 class Filter:
     @staticmethod
-    def filter_pollutant(df: pd.DataFrame, pollutant_to_predict: str) -> pd.DataFrame:
+    def filter_pollutant(
+        df: pd.DataFrame, pollutant_to_predict: Union[str, Sequence[str]]
+    ) -> pd.DataFrame:
         """
-        Filter for rows selected pollutant
+        Filter for rows of the selected pollutant(s)
 
         Parameters
         ----------
         df : pd.DataFrame
             Dataframe with selected `pollutant`
+        pollutant_to_predict : a pollutant or a list of pollutants
         """
-
-        return (
-            df.assign(
-                selected_pollutant=(
-                    df.parameter.apply(
-                        lambda pollutant: pollutant_to_predict in str(pollutant)
-                    )
-                )
-            )
-            .query("selected_pollutant == True")
-            .drop(["selected_pollutant"], axis=1)
-        )
+        return df[df.parameter.astype(str).isin(to_list(pollutant_to_predict))]
 
     @staticmethod
     def filter_no_coordinates(df: pd.DataFrame) -> pd.DataFrame:
@@ -87,6 +82,28 @@ class Filter:
             .drop(["non_extreme_values"], axis=1)
         )
 
+    @staticmethod
+    def _lists_isin(values: pd.Series, items: Sequence[str]) -> np.ndarray:
+        """
+        Whether any item of each `[a,b]` list string is one of `items`.
+        Rows share few distinct lists, so the lists are dictionary encoded,
+        each distinct list is parsed once and the rows are matched on codes.
+        """
+        codes, lists = pd.factorize(values)
+        items = set(items)
+        matches = np.fromiter(
+            (
+                not items.isdisjoint(
+                    item.strip() for item in str(list_).strip("[]").split(",")
+                )
+                for list_ in lists
+            ),
+            dtype=bool,
+            count=len(lists),
+        )
+        # missing values are coded -1 and never match
+        return np.isin(codes, np.flatnonzero(matches))
+
     @staticmethod
     def filter_countries(df: pd.DataFrame, countries: List[str]) -> pd.DataFrame:
         """
@@ -97,20 +114,7 @@ class Filter:
         df : pd.DataFrame
         countries: list with `countries`
         """
-
-        return (
-            df.assign(
-                filtered_country=(
-                    df.country.apply(
-                        lambda country: any(
-                            str_ in country[1:-1].split(",") for str_ in countries
-                        )
-                    )
-                )
-            )
-            .query("filtered_country == True")
-            .drop(["filtered_country"], axis=1)
-        )
+        return df[Filter._lists_isin(df.country, countries)]
 
     @staticmethod
     def filter_cities(df: pd.DataFrame, cities: List[str]) -> pd.DataFrame:
@@ -122,17 +126,22 @@ class Filter:
         df : pd.DataFrame
         cities: list with `cities`
         """
+        return df[Filter._lists_isin(df.city, cities)]
 
-        return (
-            df.assign(
-                filtered_cities=(
-                    df.city.apply(
-                        lambda city: any(
-                            str_ in city[1:-1].split(",") for str_ in cities
-                        )
-                    )
-                )
+    @staticmethod
+    def filter_region(df: pd.DataFrame, region: Region) -> pd.DataFrame:
+        """
+        Filter for readings inside a region
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Dataframe with `x` longitude and `y` latitude columns
+        region : bounding boxes or polygons to keep readings in
+        """
+        return df[
+            region.contains(
+                pd.to_numeric(df.x, errors="coerce").to_numpy(dtype=float),
+                pd.to_numeric(df.y, errors="coerce").to_numpy(dtype=float),
             )
-            .query("filtered_cities == True")
-            .drop(["filtered_cities"], axis=1)
-        )
+        ]
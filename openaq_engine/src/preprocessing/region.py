@@ -0,0 +1,87 @@
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+from config.model_settings import RegionConfig
+
+
+class Region:
+    """
+    An area measurements are kept in, the union of bounding boxes and
+    GeoJSON polygons. Polygons are indexed in an STRtree, and points are
+    tested against it as whole arrays, first against the region's
+    bounds and then against the polygons whose envelopes they fall in.
+    Points on a boundary are inside.
+    """
+
+    def __init__(self, polygons: Sequence[shapely.Geometry]):
+        # multipolygons are indexed part by part, for tighter envelopes
+        self.polygons = list(shapely.get_parts(list(polygons)))
+        if not self.polygons or not all(
+            polygon.geom_type == "Polygon" for polygon in self.polygons
+        ):
+            raise ValueError("A region needs one or more polygons")
+        self.tree = shapely.STRtree(self.polygons)
+
+    @classmethod
+    def from_bbox(cls, bbox: Sequence[float]) -> "Region":
+        """`bbox` is [min_longitude, min_latitude, max_longitude, max_latitude]"""
+        min_x, min_y, max_x, max_y = bbox
+        if min_x > max_x or min_y > max_y:
+            raise ValueError(f"Bounding box {list(bbox)} has its corners swapped")
+        return cls([shapely.box(min_x, min_y, max_x, max_y)])
+
+    @classmethod
+    def from_geojson(cls, geojson: Dict[str, Any]) -> "Region":
+        """The polygons of a GeoJSON geometry, feature or feature collection"""
+        if geojson["type"] == "FeatureCollection":
+            geometries = [feature["geometry"] for feature in geojson["features"]]
+        elif geojson["type"] == "Feature":
+            geometries = [geojson["geometry"]]
+        else:
+            geometries = [geojson]
+        return cls([shape(geometry) for geometry in geometries])
+
+    @classmethod
+    def from_dataclass_config(cls, config: RegionConfig) -> Optional["Region"]:
+        """The region of the config, None when it sets neither a box nor polygons"""
+        regions: List[Region] = []
+        if config.BBOX is not None:
+            regions.append(cls.from_bbox(config.BBOX))
+        if config.GEOJSON_PATH is not None:
+            with open(config.GEOJSON_PATH) as f:
+                regions.append(cls.from_geojson(json.load(f)))
+        if not regions:
+            return None
+        if len(regions) == 1:
+            return regions[0]
+        # kept in both the box and the polygons
+        return cls([shapely.intersection_all([region.union for region in regions])])
+
+    @property
+    def union(self) -> shapely.Geometry:
+        return shapely.union_all(self.polygons)
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        """min_x, min_y, max_x, max_y of the whole region"""
+        return tuple(float(bound) for bound in shapely.total_bounds(self.polygons))
+
+    def contains(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """Whether each point is in the region, False for missing coordinates"""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        min_x, min_y, max_x, max_y = self.bounds
+        # most points of a small region are dropped by the bounds alone
+        candidates = np.flatnonzero(
+            (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+        )
+        inside = np.zeros(len(x), dtype=bool)
+        point_indices, _ = self.tree.query(
+            shapely.points(x[candidates], y[candidates]), predicate="intersects"
+        )
+        inside[candidates[point_indices]] = True
+        return inside
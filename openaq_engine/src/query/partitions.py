@@ -0,0 +1,148 @@
+from typing import Dict, List, Optional, Sequence, Union
+
+import pandas as pd
+from src.utils.utils import to_list
+
+
+class PartitionLayout:
+    """
+    Describes how the openaq athena table is partitioned, so that
+    date-bounded queries can prune partitions instead of scanning the
+    full table.
+
+    `date_partition_cols` maps each date partition column, ordered from
+    coarsest to finest, to the strftime format of its values, e.g.
+    ``{"year": "%Y", "month": "%m", "day": "%d"}`` or
+    ``{"aggregatedate": "%Y-%m-%d"}``.
+    """
+
+    def __init__(
+        self,
+        date_partition_cols: Dict[str, str],
+        parameter_partition_col: Optional[str] = None,
+    ):
+        self.date_partition_cols = date_partition_cols
+        self.parameter_partition_col = parameter_partition_col
+
+    @classmethod
+    def from_dataclass_config(cls, config) -> "PartitionLayout":
+        return cls(
+            date_partition_cols=dict(config.PARTITION_COLS),
+            parameter_partition_col=config.PARAMETER_PARTITION_COL,
+        )
+
+    @property
+    def is_partitioned(self) -> bool:
+        return bool(self.date_partition_cols) or bool(self.parameter_partition_col)
+
+    def expected_partitions(self, start_date, end_date) -> pd.DataFrame:
+        """
+        Return one row per date partition touched by the window between
+        `start_date` and `end_date` (inclusive).
+        """
+        return self._format_days(
+            pd.date_range(
+                pd.Timestamp(start_date).normalize(),
+                pd.Timestamp(end_date).normalize(),
+                freq="D",
+            )
+        )
+
+    def partition_filter(
+        self,
+        start_date,
+        end_date,
+        parameter: Optional[Union[str, Sequence[str]]] = None,
+    ) -> str:
+        """
+        Return the partition predicates for a window, prefixed with `AND`
+        so they can be appended to an existing timestamp filter.
+        """
+        clauses = []
+        if self.date_partition_cols:
+            clauses.append(self._date_predicate(start_date, end_date))
+        if self.parameter_partition_col and parameter:
+            clauses.append(self._parameter_predicate(parameter))
+        return "".join(f"\n                AND {clause}" for clause in clauses)
+
+    def boundary_partition_query(
+        self, table: str, parameter: Optional[str], ascending: bool
+    ) -> str:
+        """
+        Query the partition metadata for the first (`ascending`) or last
+        date partition, which is free compared to scanning the table.
+        """
+        cols = list(self.date_partition_cols)
+        direction = "ASC" if ascending else "DESC"
+        where = (
+            f"WHERE {self._parameter_predicate(parameter)}"
+            if self.parameter_partition_col and parameter
+            else ""
+        )
+        return """SELECT {cols} FROM "{table}$partitions" {where}
+        ORDER BY {order} limit 1;""".format(
+            cols=", ".join(cols),
+            table=table,
+            where=where,
+            order=", ".join(f"{col} {direction}" for col in cols),
+        )
+
+    def equals_filter(self, partition_values: Dict[str, str]) -> str:
+        """Return `AND` predicates pinning a query to a single partition"""
+        return "".join(
+            f"\n        AND {col} = '{partition_values[col]}'"
+            for col in self.date_partition_cols
+        )
+
+    def _parameter_predicate(self, parameter: Union[str, Sequence[str]]) -> str:
+        values = ", ".join(f"'{value}'" for value in to_list(parameter))
+        return f"{self.parameter_partition_col} IN ({values})"
+
+    def _format_days(self, days: pd.DatetimeIndex) -> pd.DataFrame:
+        return pd.DataFrame(
+            {col: days.strftime(fmt) for col, fmt in self.date_partition_cols.items()}
+        ).drop_duplicates(ignore_index=True)
+
+    def _date_predicate(self, start_date, end_date) -> str:
+        cols = list(self.date_partition_cols)
+        window = self.expected_partitions(start_date, end_date)
+        if len(cols) == 1:
+            return "{col} BETWEEN '{start}' AND '{end}'".format(
+                col=cols[0], start=window[cols[0]].min(), end=window[cols[0]].max()
+            )
+        calendar = self._format_days(
+            pd.date_range(
+                pd.Timestamp(start_date).to_period("Y").start_time,
+                pd.Timestamp(end_date).to_period("Y").end_time.normalize(),
+                freq="D",
+            )
+        )
+        return "({})".format(" OR ".join(self._compress(window, calendar, cols)))
+
+    def _compress(
+        self, window: pd.DataFrame, calendar: pd.DataFrame, cols: List[str]
+    ) -> List[str]:
+        """
+        Collapse the window partitions into nested predicates, only
+        descending into finer columns where a coarser partition is not
+        fully covered by the window.
+        """
+        col = cols[0]
+        full_values, clauses = [], []
+        for value, group in window.groupby(col, sort=True):
+            calendar_group = calendar[calendar[col] == value]
+            if len(cols) == 1 or len(group) == len(calendar_group):
+                full_values.append(value)
+            else:
+                inner = self._compress(
+                    group[cols[1:]].drop_duplicates(),
+                    calendar_group[cols[1:]].drop_duplicates(),
+                    cols[1:],
+                )
+                clauses.append(f"({col} = '{value}' AND ({' OR '.join(inner)}))")
+        if len(full_values) == 1:
+            clauses.insert(0, f"{col} = '{full_values[0]}'")
+        elif full_values:
+            values = ", ".join(f"'{value}'" for value in full_values)
+            clauses.insert(0, f"{col} IN ({values})")
+        return clauses
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from config.model_settings import ScanBudgetConfig
+
+# set by --ignore-scan-budget for the stages of one run
+IGNORE_BUDGET_ENV = "OPENAQ_IGNORE_SCAN_BUDGET"
+
+
+class PlannedQuery(NamedTuple):
+    name: str
+    query: str
+    table: str
+    # date partitions the query is pruned to, None when it scans the table
+    partition_days: Optional[int]
+    estimated_bytes: Optional[float] = None
+
+
+def _normalize(query: str) -> str:
+    return query.strip().rstrip(";").strip()
+
+
+def _format_gb(n_bytes: Optional[float]) -> str:
+    return "unknown" if n_bytes is None else f"{n_bytes / 2**30:.2f} GB"
+
+
+class ScanStats:
+    """
+    Bytes athena scanned per stage and table, kept in a local json file:
+    the bytes per date partition of pruned queries and the bytes of a
+    full scan, both calibrated from the `DataScannedInBytes` of the
+    queries run. Stages select different columns, and athena only reads
+    those, so each stage is calibrated on its own.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.tables: Dict[str, Dict[str, float]] = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.tables = json.load(f)
+
+    def estimate(self, key: str, partition_days: Optional[int]) -> Optional[float]:
+        stats = self.tables.get(key, {})
+        if partition_days is None:
+            return stats.get("table_bytes")
+        if not stats.get("partition_days"):
+            return None
+        return partition_days * stats["partition_bytes"] / stats["partition_days"]
+
+    def record(self, key: str, partition_days: Optional[int], bytes_scanned: int):
+        stats = self.tables.setdefault(key, {})
+        if partition_days is None:
+            stats["table_bytes"] = bytes_scanned
+        else:
+            stats["partition_days"] = stats.get("partition_days", 0) + partition_days
+            stats["partition_bytes"] = stats.get("partition_bytes", 0) + bytes_scanned
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "w") as f:
+                json.dump(self.tables, f, indent=4)
+
+
+class ScanBudget:
+    """
+    Estimate what the queries of a stage will scan before any of them is
+    submitted, log the plan and refuse to run it past `max_scan_gb`
+    unless `ignore_budget`. Queries with no statistics yet count as
+    unknown, the bytes they actually scan calibrate the next estimates.
+    """
+
+    def __init__(
+        self,
+        stats: Optional[ScanStats] = None,
+        max_scan_gb: Optional[float] = None,
+        ignore_budget: bool = False,
+    ):
+        self.stats = stats or ScanStats(None)
+        self.max_scan_gb = max_scan_gb
+        self.ignore_budget = ignore_budget
+        # the statistics key and plan of every query not run yet
+        self.planned: Dict[str, Tuple[str, PlannedQuery]] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_dataclass_config(cls, config: ScanBudgetConfig) -> "ScanBudget":
+        return cls(
+            stats=ScanStats(config.STATS_PATH),
+            max_scan_gb=config.MAX_SCAN_GB,
+            ignore_budget=os.getenv(IGNORE_BUDGET_ENV) == "1",
+        )
+
+    def plan(self, stage: str, queries: List[PlannedQuery]) -> List[PlannedQuery]:
+        queries = [
+            query._replace(
+                estimated_bytes=self.stats.estimate(
+                    f"{stage}/{query.table}", query.partition_days
+                )
+            )
+            for query in queries
+        ]
+        total = sum(query.estimated_bytes or 0 for query in queries)
+        unknown = sum(query.estimated_bytes is None for query in queries)
+        lines = "\n".join(
+            f"    {query.name}: {_format_gb(query.estimated_bytes)}"
+            + (
+                ""
+                if query.partition_days is None
+                else f" over {query.partition_days} partitions"
+            )
+            for query in queries
+        )
+        logging.info(
+            f"""Scan plan of {stage}, {len(queries)} queries:
+{lines}
+    total: {_format_gb(total)}{f", {unknown} unknown" if unknown else ""}"""
+        )
+        if self.max_scan_gb is not None and total > self.max_scan_gb * 2**30:
+            message = f"""{stage} would scan {_format_gb(total)}, more than the
+                {self.max_scan_gb} GB budget"""
+            if not self.ignore_budget:
+                raise RuntimeError(
+                    f"""{message}, raise MAX_SCAN_GB or pass
+                    --ignore-scan-budget"""
+                )
+            logging.warning(f"{message}, running anyway")
+        with self.lock:
+            self.planned.update(
+                {
+                    _normalize(query.query): (f"{stage}/{query.table}", query)
+                    for query in queries
+                }
+            )
+        return queries
+
+    def record(self, query: str, response: Dict[str, Any]):
+        """Calibrate the statistics with what a planned query scanned"""
+        with self.lock:
+            key, planned = self.planned.pop(_normalize(query), (None, None))
+            bytes_scanned = response.get("Statistics", {}).get("DataScannedInBytes")
+            if planned is None or bytes_scanned is None:
+                return
+            self.stats.record(key, planned.partition_days, bytes_scanned)
+        logging.info(
+            f"""{planned.name} scanned {_format_gb(bytes_scanned)},
+            estimated {_format_gb(planned.estimated_bytes)}"""
+        )
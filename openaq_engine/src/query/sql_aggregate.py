@@ -0,0 +1,57 @@
+class SqlAggregate:
+    """
+    SQL aggregations pushed into the cohort query, so athena returns one
+    row per sensor and day instead of every reading.
+    """
+
+    GROUP_COLS = [
+        "location",
+        "city",
+        "country",
+        "sourcetype",
+        "mobile",
+        "parameter",
+        "unit",
+        "coordinates",
+    ]
+
+    @classmethod
+    def daily(
+        cls,
+        query: str,
+        date_col: str,
+        filters: str,
+        expected_daily_readings: int,
+    ) -> str:
+        """
+        Wrap `query` into a GROUP BY location/coordinates/day with the
+        mean, min, max, count and completeness of `value`.
+
+        `date` is rebuilt as a struct at midnight utc, so the result keeps
+        the shape `Preprocess` parses.
+        """
+        group_cols = ", ".join(cls.GROUP_COLS)
+        return """SELECT {group_cols},
+            CAST(
+                ROW(day || 'T00:00:00Z', day || 'T00:00:00+00:00')
+                AS ROW(utc varchar, local varchar)
+            ) AS date,
+            day,
+            avg(value) AS value,
+            min(value) AS value_min,
+            max(value) AS value_max,
+            count(value) AS value_count,
+            least(count(value) / {expected_daily_readings}.0, 1.0)
+                AS value_completeness
+        FROM (
+            SELECT *, substr({date_col}, 1, 10) AS day
+            FROM ({query})
+            WHERE {filters}
+        )
+        GROUP BY {group_cols}, day""".format(
+            group_cols=group_cols,
+            date_col=date_col,
+            query=query,
+            filters=filters,
+            expected_daily_readings=expected_daily_readings,
+        )
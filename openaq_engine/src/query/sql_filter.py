@@ -0,0 +1,60 @@
+from typing import List, Optional, Sequence, Union
+
+from src.preprocessing.region import Region
+from src.utils.utils import to_list
+
+
+class SqlFilter:
+    """
+    SQL counterparts of `Filter`, so the same filters can be pushed down
+    into athena instead of being applied to the downloaded rows.
+    """
+
+    @staticmethod
+    def filter_pollutant(pollutant_to_predict: Union[str, Sequence[str]]) -> str:
+        pollutants = ", ".join(
+            f"'{pollutant}'" for pollutant in to_list(pollutant_to_predict)
+        )
+        return f"parameter IN ({pollutants})"
+
+    @staticmethod
+    def filter_no_coordinates() -> str:
+        return "coordinates.latitude IS NOT NULL AND coordinates.longitude IS NOT NULL"
+
+    @staticmethod
+    def filter_non_null_values() -> str:
+        return "value >= 0"
+
+    @staticmethod
+    def filter_extreme_values() -> str:
+        return "value <= 500"
+
+    @staticmethod
+    def filter_region(region: Region) -> str:
+        """
+        The region's bounding box, which lets athena skip the row groups
+        outside it. Rows inside the box but outside the region's polygons
+        are dropped by `Filter.filter_region` after download.
+        """
+        min_x, min_y, max_x, max_y = region.bounds
+        return f"""coordinates.longitude BETWEEN {min_x!r} AND {max_x!r}
+            AND coordinates.latitude BETWEEN {min_y!r} AND {max_y!r}"""
+
+    @classmethod
+    def from_options(
+        cls,
+        filters: List[str],
+        pollutant_to_predict: Union[str, Sequence[str]],
+        region: Optional[Region] = None,
+    ) -> str:
+        """Combine the selected filters into a single `AND` predicate"""
+        predicates = []
+        for filter_ in filters:
+            if filter_ == "filter_pollutant":
+                predicates.append(cls.filter_pollutant(pollutant_to_predict))
+            elif filter_ == "filter_region":
+                if region is not None:
+                    predicates.append(cls.filter_region(region))
+            elif hasattr(cls, filter_):
+                predicates.append(getattr(cls, filter_)())
+        return " AND ".join(predicates) or "TRUE"
@@ -0,0 +1,100 @@
+from typing import List, Optional, Sequence
+
+from config.model_settings import SamplingConfig
+
+# hash buckets, so fractions down to 0.01% are kept exactly
+SAMPLE_BUCKETS = 10_000
+SAMPLE_METHODS = ["hash", "bernoulli"]
+
+
+class SqlSample:
+    """
+    Sample the cohort query inside athena, so experiments only download
+    and process a `fraction` of the data.
+
+    `hash` keeps the locations whose crc32 of `seed` and `id_col` falls
+    in the first `fraction` of the buckets, the same locations on every
+    run and in every window. With `strata`, the first location of each
+    stratum by hash is kept too, so no country or source type drops out
+    of a small sample. These are queried once with `strata_query` and
+    passed to `sample_filter`, so every window keeps the same ones.
+    `bernoulli` is athena's TABLESAMPLE over rows, a different subset on
+    every run.
+    """
+
+    def __init__(
+        self,
+        fraction: Optional[float] = None,
+        method: str = "hash",
+        id_col: str = "location",
+        strata: Optional[List[str]] = None,
+        seed: int = 0,
+    ):
+        if method not in SAMPLE_METHODS:
+            raise ValueError(
+                f"Unknown sample method {method}, use one of {SAMPLE_METHODS}"
+            )
+        if fraction is not None and not 0 < fraction <= 1:
+            raise ValueError(f"The sample fraction must be in (0, 1], not {fraction}")
+        self.fraction = fraction
+        self.method = method
+        self.id_col = id_col
+        self.strata = strata or []
+        self.seed = seed
+
+    @classmethod
+    def from_dataclass_config(cls, config: SamplingConfig) -> "SqlSample":
+        return cls(
+            fraction=config.FRACTION,
+            method=config.METHOD,
+            id_col=config.ID_COL,
+            strata=config.STRATA,
+            seed=config.SEED,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.fraction is not None and self.fraction < 1
+
+    @property
+    def stratified(self) -> bool:
+        return self.enabled and self.method == "hash" and bool(self.strata)
+
+    def table_sample(self) -> str:
+        """The TABLESAMPLE clause following the table name, if any"""
+        if not self.enabled or self.method != "bernoulli":
+            return ""
+        return f" TABLESAMPLE BERNOULLI ({self.fraction * 100:g})"
+
+    def bucket(self) -> str:
+        return f"""crc32(to_utf8('{self.seed}:' || CAST({self.id_col} AS varchar)))
+            % {SAMPLE_BUCKETS}"""
+
+    def strata_query(self, table: str, where: str) -> str:
+        """The first location of each stratum by hash among the rows `where` selects"""
+        strata = ", ".join(self.strata)
+        return f"""SELECT min_by({self.id_col}, sample_bucket) AS {self.id_col}
+            FROM (
+                SELECT {self.id_col}, {strata}, {self.bucket()} AS sample_bucket
+                FROM {table}
+                WHERE {where}
+            )
+            GROUP BY {strata}"""
+
+    def sample_filter(self, stratum_ids: Sequence[str] = ()) -> str:
+        """
+        The hash sample predicate prefixed with `AND`, keeping the
+        `stratum_ids` returned by `strata_query` as well.
+        """
+        if not self.enabled or self.method != "hash":
+            return ""
+        threshold = max(round(self.fraction * SAMPLE_BUCKETS), 1)
+        if not stratum_ids:
+            return f"""
+            AND {self.bucket()} < {threshold}"""
+        ids = ", ".join(
+            "'{}'".format(stratum_id.replace("'", "''")) for stratum_id in stratum_ids
+        )
+        return f"""
+            AND ({self.bucket()} < {threshold}
+            OR CAST({self.id_col} AS varchar) IN ({ids}))"""
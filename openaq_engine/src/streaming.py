@@ -0,0 +1,208 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator, List, Sequence
+
+from src.utils.instrumentation import record
+
+# tells the next stage that no more items will come
+_DONE = object()
+
+
+class StreamStage:
+    """A step of a `stream`, applying `func` to each item on `workers` threads"""
+
+    def __init__(self, name: str, func: Callable[[Any], Any], workers: int = 1):
+        self.name = name
+        self.func = func
+        self.workers = max(workers, 1)
+        self.busy_seconds = 0.0
+        self.items = 0
+
+
+class _Stream:
+    def __init__(
+        self, source: Iterable[Any], stages: Sequence[StreamStage], queue_size: int
+    ):
+        self.source = source
+        self.stages = stages
+        self.queues: List[queue.Queue] = [
+            queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)
+        ]
+        self.stop = threading.Event()
+        self.errors: List[BaseException] = []
+        self.lock = threading.Lock()
+        self.running = [stage.workers for stage in stages]
+
+    def _put(self, index: int, item: Any) -> bool:
+        # blocks while the next stage is behind, which is the backpressure
+        while not self.stop.is_set():
+            try:
+                self.queues[index].put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, index: int) -> Any:
+        while not self.stop.is_set():
+            try:
+                return self.queues[index].get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self, error: BaseException):
+        with self.lock:
+            self.errors.append(error)
+        self.stop.set()
+
+    def _produce(self):
+        try:
+            for item in self.source:
+                if not self._put(0, item):
+                    return
+            self._put(0, _DONE)
+        except BaseException as error:
+            self._fail(error)
+
+    def _work(self, index: int):
+        stage = self.stages[index]
+        try:
+            while True:
+                item = self._get(index)
+                if item is _DONE:
+                    # let the stage's other workers see it too
+                    self._put(index, _DONE)
+                    break
+                start = time.perf_counter()
+                result = stage.func(item)
+                with self.lock:
+                    stage.busy_seconds += time.perf_counter() - start
+                    stage.items += 1
+                if not self._put(index + 1, result):
+                    return
+            with self.lock:
+                self.running[index] -= 1
+                last = self.running[index] == 0
+            if last:
+                self._put(index + 1, _DONE)
+        except BaseException as error:
+            self._fail(error)
+
+    def __iter__(self) -> Iterator[Any]:
+        threads = [threading.Thread(target=self._produce, daemon=True)] + [
+            threading.Thread(target=self._work, args=(index,), daemon=True)
+            for index, stage in enumerate(self.stages)
+            for _ in range(stage.workers)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self._get(len(self.stages))
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+        if self.errors:
+            raise self.errors[0]
+        self._report(time.perf_counter() - start)
+
+    def _report(self, seconds: float):
+        for stage in self.stages:
+            record(
+                "stream",
+                stage.name,
+                seconds=stage.busy_seconds,
+                rows_out=stage.items,
+                workers=stage.workers,
+            )
+        busy = ", ".join(
+            f"{stage.name} {stage.busy_seconds:.1f}s" for stage in self.stages
+        )
+        logging.info(f"Streamed in {seconds:.1f}s, stages busy for {busy}")
+
+
+class _Interleave(_Stream):
+    def __init__(self, sources: Iterable[Iterable[Any]], workers: int, queue_size: int):
+        super().__init__(iter(sources), [], queue_size)
+        self.workers = max(workers, 1)
+        self.running = [self.workers]
+
+    def _next_source(self) -> Any:
+        with self.lock:
+            return next(self.source, _DONE)
+
+    def _work(self, index: int):
+        try:
+            while True:
+                source = self._next_source()
+                if source is _DONE:
+                    break
+                for item in source:
+                    if not self._put(0, item):
+                        return
+        except BaseException as error:
+            self._fail(error)
+        finally:
+            with self.lock:
+                self.running[0] -= 1
+                last = self.running[0] == 0
+            if last:
+                self._put(0, _DONE)
+
+    def __iter__(self) -> Iterator[Any]:
+        threads = [
+            threading.Thread(target=self._work, args=(0,), daemon=True)
+            for _ in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self._get(0)
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+def interleave(
+    sources: Iterable[Iterable[Any]], workers: int = 1, queue_size: int = 2
+) -> Iterator[Any]:
+    """
+    Iterate up to `workers` of `sources` at once, each on its own thread,
+    and yield their items in the order they come. A worker moves on to the
+    next source once its own is exhausted. As with `stream`, at most
+    `queue_size` items wait for the consumer and the first error is
+    raised to it.
+    """
+    return iter(_Interleave(sources, workers, queue_size))
+
+
+def stream(
+    source: Iterable[Any], stages: Sequence[StreamStage], queue_size: int = 2
+) -> Iterator[Any]:
+    """
+    Pass every item of `source` through `stages` in turn, each stage on its
+    own threads, so that a stage works on one item while the previous
+    stage works on the next. Stages are connected by queues holding at
+    most `queue_size` items, and a stage waits while its output queue is
+    full, which bounds the items in flight however fast `source` is.
+
+    Items come out of a stage with several workers in completion order.
+    The first error raised by the source or a stage stops the stream and
+    is raised to the consumer.
+    """
+    return iter(_Stream(source, stages, queue_size))
@@ -1,16 +1,96 @@
 import logging
 from abc import ABC
-from datetime import datetime
-from typing import Any, Dict, List
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
 
-import pandas as pd
-from dateutil.relativedelta import relativedelta
+import numpy as np
+from src.query.partitions import PartitionLayout
+from src.query.scan_cost import PlannedQuery, ScanBudget
+from src.utils.instrumentation import timed
 from src.utils.utils import query_results
 
 from config.model_settings import TimeSplitterConfig
 
 logging.basicConfig(level=logging.INFO)
 
+# the columns of the array of windows `TimeSplitter.execute` returns
+SPLIT_COLUMNS = ["train_start", "train_end", "validation_start", "validation_end"]
+WINDOW_UNITS = ["months", "weeks", "days"]
+
+
+def shift_dates(dates: np.ndarray, amounts: np.ndarray, unit: str) -> np.ndarray:
+    """
+    `dates` moved by `amounts` units, elementwise. Moving by months keeps
+    the day of month, clipped to the length of the month it lands in,
+    like `relativedelta`.
+    """
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    amounts = np.asarray(amounts, dtype=np.int64)
+    if unit == "days":
+        return dates + amounts.astype("timedelta64[D]")
+    if unit == "weeks":
+        return dates + (7 * amounts).astype("timedelta64[D]")
+    if unit != "months":
+        raise ValueError(f"Unknown window unit {unit}, use one of {WINDOW_UNITS}")
+    months = dates.astype("datetime64[M]")
+    day_of_month = dates - months.astype("datetime64[D]")
+    shifted = months + amounts.astype("timedelta64[M]")
+    first_day = shifted.astype("datetime64[D]")
+    next_month = shifted + np.timedelta64(1, "M")
+    last_day = next_month.astype("datetime64[D]") - np.timedelta64(1, "D")
+    return np.minimum(first_day + day_of_month, last_day)
+
+
+def time_splits(
+    start_date: Any,
+    end_date: Any,
+    validation_length: int,
+    step: int,
+    window_count: int,
+    unit: str = "months",
+    training_length: Optional[int] = None,
+    gap: int = 0,
+) -> np.ndarray:
+    """
+    Every window at once as a `(window_count, 4)` datetime64[D] array of
+    `SPLIT_COLUMNS`, latest first. Validation windows are
+    `validation_length` units long and end `step` units apart, the last
+    one on `end_date`. Each training window ends `gap` units before its
+    validation window starts and either expands back to `start_date` or
+    rolls over the `training_length` units before its end. Windows whose
+    training would end before `start_date` are left out.
+    """
+    start_date = np.datetime64(start_date, "D")
+    folds = np.arange(window_count)
+    validation_start = shift_dates(
+        np.full(window_count, np.datetime64(end_date, "D")),
+        -(folds * step + validation_length),
+        unit,
+    )
+    validation_end = shift_dates(
+        validation_start, np.full(window_count, validation_length), unit
+    )
+    train_end = shift_dates(validation_start, np.full(window_count, -gap), unit)
+    train_start = np.full(window_count, start_date)
+    if training_length is not None:
+        train_start = np.maximum(
+            train_start,
+            shift_dates(train_end, np.full(window_count, -training_length), unit),
+        )
+    splits = np.stack(
+        [train_start, train_end, validation_start, validation_end], axis=1
+    )
+    return splits[train_end >= start_date]
+
+
+def to_train_validation_dict(splits: np.ndarray) -> Dict[str, List[Tuple[date, date]]]:
+    """The windows as lists of (start, end) dates per cohort type"""
+    train_start, train_end, validation_start, validation_end = splits.astype(object).T
+    return dict(
+        validation=list(zip(validation_start, validation_end)),
+        training=list(zip(train_start, train_end)),
+    )
+
 
 class TimeSplitterBase(ABC):
     def __init__(
@@ -21,6 +101,8 @@ class TimeSplitterBase(ABC):
         region_name: str,
         bucket: str,
         s3_output: str,
+        partition_layout: PartitionLayout,
+        scan_budget: Optional[ScanBudget] = None,
     ):
 
         self.date_col = date_col
@@ -29,39 +111,78 @@ class TimeSplitterBase(ABC):
         self.region_name = region_name
         self.bucket = bucket
         self.s3_output = s3_output
+        self.partition_layout = partition_layout
+        self.scan_budget = scan_budget or ScanBudget()
 
-    def create_end_date(self, params) -> pd.DataFrame:
-        sql_query = """SELECT from_iso8601_timestamp({date_col}) AS datetime
+    def _bounds_query(self, ascending: bool, partition_filter: str = "") -> str:
+        """The query of the first (`ascending`) or last timestamp"""
+        return """SELECT from_iso8601_timestamp({date_col}) AS datetime
         FROM {table} WHERE parameter='{target_variable}'
-        AND from_iso8601_timestamp({date_col}) <= DATE(NOW())
-        ORDER BY {date_col} DESC limit 1;""".format(
+        AND from_iso8601_timestamp({date_col}) <= DATE(NOW()){partition_filter}
+        ORDER BY {date_col} {direction} limit 1;""".format(
             table=self.table_name,
             date_col=self.date_col,
             target_variable=self.target_variable,
+            partition_filter=partition_filter,
+            direction="ASC" if ascending else "DESC",
         )
-        response_query_result = self._build_response_from_aws(params, sql_query)
 
+    def _query_date(self, params, ascending: bool, partition_filter: str) -> date:
+        """
+        Run the bounds query pinned by `partition_filter`. Unless the table
+        is partitioned by parameter, the boundary partition may hold no
+        readings of the target variable, the whole table is queried then.
+        """
+        response_query_result = self._build_response_from_aws(
+            params, self._bounds_query(ascending, partition_filter)
+        )
+        if response_query_result is None and partition_filter:
+            name = "first date" if ascending else "last date"
+            logging.warning(
+                f"""The {name} partition holds no {self.target_variable}
+                readings, querying the whole table"""
+            )
+            sql_query = self._bounds_query(ascending)
+            self.scan_budget.plan(
+                "time-splitter",
+                [PlannedQuery(f"{name} unpinned", sql_query, self.table_name, None)],
+            )
+            response_query_result = self._build_response_from_aws(params, sql_query)
+        if response_query_result is None:
+            raise ValueError(
+                f"No {self.target_variable} readings found in {self.table_name}"
+            )
         return datetime.strptime(
             f"{response_query_result}", "%Y-%m-%d %H:%M:%S.000 UTC"
         ).date()
 
-    def create_start_date(self, params: Dict[str, Any]) -> datetime:
-        sql_query = """SELECT from_iso8601_timestamp({date_col}) AS datetime
-        FROM {table} WHERE parameter='{target_variable}'
-        AND from_iso8601_timestamp({date_col}) <= DATE(NOW())
-        ORDER BY {date_col} ASC limit 1;""".format(
-            table=self.table_name,
-            date_col=self.date_col,
-            target_variable=self.target_variable,
+    def _boundary_partition_filter(self, params, ascending: bool) -> str:
+        """
+        Restrict the bounds query to the first or last date partition
+        so athena does not scan the full table to find one timestamp.
+        """
+        if not self.partition_layout.date_partition_cols:
+            return ""
+        response_query_result = query_results(
+            params,
+            self.partition_layout.boundary_partition_query(
+                self.table_name, self.target_variable, ascending
+            ),
+        )
+        rows = response_query_result["ResultSet"]["Rows"]
+        if len(rows) < 2:
+            return ""
+        header, row = rows[:2]
+        return self.partition_layout.equals_filter(
+            {
+                column["VarCharValue"]: value["VarCharValue"]
+                for column, value in zip(header["Data"], row["Data"])
+            }
         )
-
-        response_query_result = self._build_response_from_aws(params, sql_query)
-        return datetime.strptime(
-            f"{response_query_result}", "%Y-%m-%d %H:%M:%S.000 UTC"
-        ).date()
 
     def _build_response_from_aws(self, params, sql_query):
         response_query_result = query_results(params, sql_query)
+        self.scan_budget.record(sql_query, response_query_result)
         response_query_result["ResultSet"]["Rows"][0]
         rows = response_query_result["ResultSet"]["Rows"][1:]
         for row in rows:
@@ -81,14 +202,24 @@ class TimeSplitter(TimeSplitterBase):
         time_window_length: int,
         within_window_sampler: int,
         window_count: int,
-        train_validation_dict: Dict[str, List[Any]],
         target_variable: str,
+        partition_layout: PartitionLayout,
+        window_unit: str = "months",
+        training_window_length: Optional[int] = None,
+        gap: int = 0,
+        scan_budget: Optional[ScanBudget] = None,
     ) -> None:
+        if window_unit not in WINDOW_UNITS:
+            raise ValueError(
+                f"Unknown window unit {window_unit}, use one of {WINDOW_UNITS}"
+            )
         self.time_window_length = time_window_length
         self.within_window_sampler = within_window_sampler
         self.window_count = window_count
-        self.train_validation_dict = train_validation_dict
         self.target_variable = target_variable
+        self.window_unit = window_unit
+        self.training_window_length = training_window_length
+        self.gap = gap
         super().__init__(
             TimeSplitterConfig.DATE_COL,
             TimeSplitterConfig.TABLE_NAME,
@@ -96,6 +227,8 @@ class TimeSplitter(TimeSplitterBase):
             TimeSplitterConfig.REGION,
             TimeSplitterConfig.S3_BUCKET,
             TimeSplitterConfig.S3_OUTPUT,
+            partition_layout,
+            scan_budget,
         )
 
     @classmethod
@@ -104,73 +237,90 @@ class TimeSplitter(TimeSplitterBase):
             time_window_length=config.TIME_WINDOW_LENGTH,
             within_window_sampler=config.WITHIN_WINDOW_SAMPLER,
             window_count=config.WINDOW_COUNT,
-            train_validation_dict=config.TRAIN_VALIDATION_DICT,
             target_variable=config.TARGET_VARIABLE,
+            partition_layout=PartitionLayout.from_dataclass_config(config),
+            window_unit=config.WINDOW_UNIT,
+            training_window_length=config.TRAINING_WINDOW_LENGTH,
+            gap=config.GAP,
+            scan_budget=ScanBudget.from_dataclass_config(config.SCAN_BUDGET),
         )
 
-    def execute(
-        self,
-    ):
+    @timed("stage", "time-splitter")
+    def execute(self) -> np.ndarray:
         """
-        Input
-        ----
-        creates list of dates between start and end date of each time
-        window within a given window time length and a given number of
-        months to sample
-        ----
-        The start and end dates for each time window
+        Find the first and last dates of the target variable and plan
+        every time window between them.
+
+        Returns
+        -------
+        np.ndarray
+            One row of `SPLIT_COLUMNS` dates per window, see `time_splits`
         """
-        window_no = 0
         params = {
             "region": str(self.region_name),
             "database": str(self.database),
             "bucket": str(self.bucket),
             "path": f"{self.s3_output}/max_date",
         }
-        end_date = self.create_end_date(params)
-        start_date = self.create_start_date(params)
-
-        while window_no < self.window_count:
-            window_start_date, window_end_date = self.get_validation_window(
-                end_date, window_no
-            )
-            logging.info(
-                f"""Getting cohort between {window_start_date}
-                and {window_end_date}"""
-            )
-            if window_start_date < start_date:
-                logging.warning(
-                    f"""Date: {window_start_date.date()} is earlier than
-                    the first date within data: {start_date.date()}"""
+        partition_filters = {
+            ascending: self._boundary_partition_filter(params, ascending)
+            for ascending in [False, True]
+        }
+        queries = {
+            ascending: self._bounds_query(ascending, partition_filter)
+            for ascending, partition_filter in partition_filters.items()
+        }
+        self.scan_budget.plan(
+            "time-splitter",
+            [
+                PlannedQuery(
+                    "first date" if ascending else "last date",
+                    query,
+                    self.table_name,
+                    # pruned to the first or last date partition
+                    1 if partition_filters[ascending] else None,
                 )
-                window_no += 1
-            else:
-                self.train_validation_dict["validation"] += [
-                    (
-                        window_start_date,
-                        window_end_date,
-                    )
-                ]
-                self.train_validation_dict["training"] += [
-                    (start_date, window_start_date)
-                ]
-                window_no += 1
-        return self.train_validation_dict
-
-    def get_validation_window(self, end_date, window_no):
-        """Gets start and end date of each training window"""
-        window_start_date = self._get_start_time_windows(end_date, window_no)
-        window_end_date = self._get_end_time_windows(window_start_date)
-        return window_start_date, window_end_date
-
-    def _get_start_time_windows(self, window_date, window_no):
-        """Gets start date of window based on the window length and
-        the number of sample months used in the window"""
-        return window_date - relativedelta(
-            months=+window_no * self.time_window_length + self.within_window_sampler
+                for ascending, query in queries.items()
+            ],
+        )
+        end_date = self._query_date(params, False, partition_filters[False])
+        start_date = self._query_date(params, True, partition_filters[True])
+        splits = self.splits(start_date, end_date)
+        if len(splits) < self.window_count:
+            logging.warning(
+                f"""{self.window_count - len(splits)} windows start earlier
+                than the first date within data: {start_date}"""
+            )
+        logging.info(
+            f"""Planned {len(splits)} windows of {self.within_window_sampler}
+            {self.window_unit} between {start_date} and {end_date}"""
+        )
+        if len(splits):
+            self._log_expected_partitions(splits[0])
+        return splits
+
+    def splits(self, start_date: Any, end_date: Any) -> np.ndarray:
+        return time_splits(
+            start_date,
+            end_date,
+            validation_length=self.within_window_sampler,
+            step=self.time_window_length,
+            window_count=self.window_count,
+            unit=self.window_unit,
+            training_length=self.training_window_length,
+            gap=self.gap,
         )
 
-    def _get_end_time_windows(self, window_start_date):
-        """Gets end date of window based on the window length
-        and the number of sample months used in the window"""
-        return window_start_date + relativedelta(months=+self.within_window_sampler)
+    def _log_expected_partitions(self, split: np.ndarray):
+        """Report how many date partitions the latest window's queries will scan"""
+        if not self.partition_layout.date_partition_cols:
+            return
+        train_start, train_end, validation_start, validation_end = split.astype(object)
+        training = self.partition_layout.expected_partitions(train_start, train_end)
+        validation = self.partition_layout.expected_partitions(
+            validation_start, validation_end
+        )
+        logging.info(
+            f"""The latest window expects {len(training)} training
+            partitions and {len(validation)} validation partitions"""
+        )
@@ -0,0 +1,173 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import resource
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# set while profiling, inherited by the joblib worker processes so their
+# athena queries and earth engine calls land in the same report
+PROFILE_EVENTS_ENV = "OPENAQ_ENGINE_PROFILE_EVENTS"
+
+
+def profiling_enabled() -> bool:
+    return PROFILE_EVENTS_ENV in os.environ
+
+
+def record(kind: str, name: str, **metrics: Any) -> None:
+    """Append one event to the run's event log, a no-op when not profiling"""
+    if not profiling_enabled():
+        return
+    event = dict(kind=kind, name=name, pid=os.getpid(), **metrics)
+    # single short appends are atomic, so concurrent workers can share the file
+    with open(os.environ[PROFILE_EVENTS_ENV], "a") as f:
+        f.write(json.dumps(event, default=str) + "\n")
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def measure(kind: str, name: str, **metrics: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Time a block and record it as an event. The yielded dict can be
+    filled with metrics known only inside the block, e.g. `rows_out`.
+    """
+    if not profiling_enabled():
+        yield metrics
+        return
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics["seconds"] = time.perf_counter() - start
+        metrics["peak_rss_mb"] = _peak_rss_mb()
+        if tracemalloc.is_tracing():
+            metrics["tracemalloc_peak_mb"] = (
+                tracemalloc.get_traced_memory()[1] / 2**20
+            )
+        record(kind, name, **metrics)
+
+
+def timed(kind: str, name: Optional[str] = None) -> Callable:
+    """Decorator version of `measure`, recording the rows returned"""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(kind, name or func.__qualname__) as metrics:
+                result = func(*args, **kwargs)
+                if hasattr(result, "shape"):
+                    metrics["rows_out"] = len(result)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+class RunReport:
+    """Summarise the recorded events into the structured run report"""
+
+    def __init__(self, events: List[Dict[str, Any]]):
+        self.events = events
+
+    @classmethod
+    def from_file(cls, path: str) -> "RunReport":
+        if not os.path.exists(path):
+            return cls([])
+        with open(path) as f:
+            return cls([json.loads(line) for line in f if line.strip()])
+
+    def summary(self) -> Dict[str, Any]:
+        totals = defaultdict(lambda: defaultdict(float))
+        for event in self.events:
+            total = totals[f"{event['kind']}:{event['name']}"]
+            total["calls"] += 1
+            for metric in [
+                "seconds",
+                "rows_in",
+                "rows_out",
+                "bytes_scanned",
+                "engine_execution_ms",
+                "query_queue_ms",
+            ]:
+                total[metric] += event.get(metric) or 0
+        athena = [event for event in self.events if event["kind"] == "athena"]
+        return dict(
+            totals={name: dict(total) for name, total in totals.items()},
+            athena=dict(
+                queries=len(athena),
+                bytes_scanned=sum(event.get("bytes_scanned", 0) for event in athena),
+                engine_execution_ms=sum(
+                    event.get("engine_execution_ms", 0) for event in athena
+                ),
+                query_queue_ms=sum(event.get("query_queue_ms", 0) for event in athena),
+            ),
+            ee_calls=sum(event["kind"] == "ee" for event in self.events),
+            peak_rss_mb=max(
+                [event.get("peak_rss_mb", 0) for event in self.events], default=0
+            ),
+            tracemalloc_peak_mb=max(
+                [event.get("tracemalloc_peak_mb", 0) for event in self.events],
+                default=0,
+            ),
+        )
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(
+                dict(summary=self.summary(), events=self.events),
+                f,
+                indent=4,
+                default=str,
+            )
+
+
+@contextmanager
+def profile_run(profile_dir: str, command: str) -> Iterator[None]:
+    """
+    Collect events for the whole command and write `run_report.json`,
+    plus a pyinstrument html profile when it is installed, or a cProfile
+    `.prof` file otherwise, to `profile_dir`.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    events_path = os.path.join(profile_dir, "events.jsonl")
+    if os.path.exists(events_path):
+        os.remove(events_path)
+    os.environ[PROFILE_EVENTS_ENV] = events_path
+    tracemalloc.start()
+    try:
+        from pyinstrument import Profiler
+
+        profiler = Profiler()
+    except ImportError:
+        profiler = cProfile.Profile()
+    if isinstance(profiler, cProfile.Profile):
+        profiler.enable()
+    else:
+        profiler.start()
+    try:
+        with measure("command", command):
+            yield
+    finally:
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            profiler.dump_stats(os.path.join(profile_dir, f"{command}.prof"))
+        else:
+            profiler.stop()
+            with open(os.path.join(profile_dir, f"{command}.html"), "w") as f:
+                f.write(profiler.output_html())
+        tracemalloc.stop()
+        RunReport.from_file(events_path).write(
+            os.path.join(profile_dir, "run_report.json")
+        )
+        del os.environ[PROFILE_EVENTS_ENV]
+        logging.info(f"Wrote run report to {profile_dir}")
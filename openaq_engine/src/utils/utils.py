@@ -1,12 +1,18 @@
 import json
+import logging
 import time
-from typing import Any, List
+from typing import Any, Dict, Iterator, List, Sequence, Union
 
-import boto3
 import numpy as np
 import pandas as pd
 from pydantic.json import pydantic_encoder
-from setup_environment import connect_to_db
+from src.utils.instrumentation import measure
+
+from config.model_settings import BackendConfig
+
+QUERY_TIMEOUT_SECONDS = 30 * 60
+# polls start quick for the short queries and back off to this interval
+MAX_POLL_SECONDS = 1.0
 
 
 def read_csv(path: str, **kwargs: Any) -> pd.DataFrame:
@@ -43,53 +49,150 @@ def write_csv(df: pd.DataFrame, path: str, **kwargs: Any) -> None:
     )
 
 
-def query_results(params, query, wait=True):
-    session = boto3.Session()
+def get_athena_client(region: str, config: BackendConfig):
+    """The boto3 athena client, or the local fake selected in `BackendConfig`"""
+    if config.ATHENA_BACKEND == "fake":
+        from src.backends.fake_athena import FakeAthenaClient
 
-    client = session.client("athena", params["region"])
+        return FakeAthenaClient.from_dataclass_config(config)
+    import boto3
 
-    response_query_execution_id = client.start_query_execution(
-        QueryString=query,
-        QueryExecutionContext={"Database": "default"},
-        ResultConfiguration={
-            "OutputLocation": "s3://" + params["bucket"] + "/" + params["path"] + "/"
-        },
-    )
+    session = boto3.Session()
+    return session.client("athena", region)
 
-    if not wait:
-        return response_query_execution_id["QueryExecutionId"]
-    else:
-        response_get_query_details = client.get_query_execution(
-            QueryExecutionId=response_query_execution_id["QueryExecutionId"]
+
+def query_results(params, query, wait=True):
+    with measure("athena", "query_results", query=query[:200]) as metrics:
+        backend_config = BackendConfig()
+        client = get_athena_client(params["region"], backend_config)
+
+        response_query_execution_id = client.start_query_execution(
+            QueryString=query,
+            QueryExecutionContext={"Database": "default"},
+            ResultConfiguration={
+                "OutputLocation": "s3://"
+                + params["bucket"]
+                + "/"
+                + params["path"]
+                + "/"
+            },
         )
-        status = "RUNNING"
-        iterations = 360000  # 30 mins
 
-        while iterations > 0:
-            iterations = iterations - 1
-            response_get_query_details = client.get_query_execution(
-                QueryExecutionId=response_query_execution_id["QueryExecutionId"]
-            )
-            status = response_get_query_details["QueryExecution"]["Status"]["State"]
-
-            if (status == "FAILED") or (status == "CANCELLED"):
-                failure_reason = response_get_query_details["QueryExecution"]["Status"][
-                    "StateChangeReason"
-                ]
-                print(failure_reason)
-                return False, False
-
-            elif status == "SUCCEEDED":
-                # Function to get output results
-                response_query_result = client.get_query_results(
+        if not wait:
+            return response_query_execution_id["QueryExecutionId"]
+        else:
+            deadline = time.monotonic() + QUERY_TIMEOUT_SECONDS
+            poll_seconds = 0.05
+
+            while time.monotonic() < deadline:
+                response_get_query_details = client.get_query_execution(
                     QueryExecutionId=response_query_execution_id["QueryExecutionId"]
                 )
-                return response_query_result
+                status = response_get_query_details["QueryExecution"]["Status"]["State"]
+
+                if (status == "FAILED") or (status == "CANCELLED"):
+                    failure_reason = response_get_query_details["QueryExecution"][
+                        "Status"
+                    ].get("StateChangeReason", "")
+                    logging.error(
+                        f"""Athena query {status.lower()}: {failure_reason}
+                        {query[:200]}"""
+                    )
+                    raise RuntimeError(
+                        f"Athena query {status.lower()}: {failure_reason}"
+                    )
+
+                elif status == "SUCCEEDED":
+                    statistics = response_get_query_details["QueryExecution"].get(
+                        "Statistics", {}
+                    )
+                    metrics.update(
+                        bytes_scanned=statistics.get("DataScannedInBytes", 0),
+                        engine_execution_ms=statistics.get(
+                            "EngineExecutionTimeInMillis", 0
+                        ),
+                        query_queue_ms=statistics.get("QueryQueueTimeInMillis", 0),
+                    )
+                    # Function to get output results
+                    response_query_result = client.get_query_results(
+                        QueryExecutionId=response_query_execution_id["QueryExecutionId"]
+                    )
+                    # lets callers page through results past the first 1000 rows
+                    response_query_result[
+                        "QueryExecutionId"
+                    ] = response_query_execution_id["QueryExecutionId"]
+                    # what the query scanned, to calibrate the scan estimates
+                    response_query_result["Statistics"] = statistics
+                    # longer results are recorded once they are paged through
+                    if _recording(backend_config) and (
+                        "NextToken" not in response_query_result
+                    ):
+                        from src.backends.fake_athena import record_response
+
+                        record_response(
+                            backend_config.ATHENA_RECORDINGS_DIR,
+                            query,
+                            [response_query_result],
+                        )
+                    # the first row of the result set holds the column names
+                    metrics["rows_out"] = (
+                        len(response_query_result["ResultSet"]["Rows"]) - 1
+                    )
+                    return response_query_result
+
+                time.sleep(poll_seconds)
+                poll_seconds = min(poll_seconds * 2, MAX_POLL_SECONDS)
+
+            raise TimeoutError(
+                f"Athena query timed out after {QUERY_TIMEOUT_SECONDS}s: {query[:200]}"
+            )
 
-        else:
-            time.sleep(0.001)
 
-        return False
+def iter_query_result_pages(params, query) -> Iterator[Dict[str, Any]]:
+    """
+    Run `query` and yield every page of its results, only the first
+    page starts with the header row.
+    """
+    response_query_result = query_results(params, query)
+    backend_config = BackendConfig()
+    pages = _iter_pages(
+        get_athena_client(params["region"], backend_config), response_query_result
+    )
+    if _recording(backend_config) and "NextToken" in response_query_result:
+        # every page, so replays follow the same NextToken chain
+        pages = _record_pages(backend_config.ATHENA_RECORDINGS_DIR, query, pages)
+    yield from pages
+
+
+def _recording(backend_config: BackendConfig) -> bool:
+    return bool(
+        backend_config.ATHENA_BACKEND == "aws" and backend_config.ATHENA_RECORDINGS_DIR
+    )
+
+
+def _record_pages(
+    recordings_dir: str, query: str, pages: Iterator[Dict[str, Any]]
+) -> Iterator[Dict[str, Any]]:
+    """Pass the pages on, and record them once the last one is read"""
+    from src.backends.fake_athena import record_response
+
+    recorded = []
+    for page in pages:
+        recorded.append(page)
+        yield page
+    record_response(recordings_dir, query, recorded)
+
+
+def _iter_pages(client, response_query_result) -> Iterator[Dict[str, Any]]:
+    """The first page of a query's results and those its NextToken chain leads to"""
+    query_execution_id = response_query_result["QueryExecutionId"]
+    yield response_query_result
+    while "NextToken" in response_query_result:
+        response_query_result = client.get_query_results(
+            QueryExecutionId=query_execution_id,
+            NextToken=response_query_result["NextToken"],
+        )
+        yield response_query_result
 
 
 def get_s3_file_path_list(resource, bucket, folder):
@@ -114,6 +217,13 @@ def write_dataclass(dclass: object, path: str) -> None:
         )
 
 
+def to_list(value: Union[str, Sequence[str]]) -> List[str]:
+    """Wrap a single string in a list, leaving sequences of strings as lists"""
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
 def get_categorical_feature_indices(df: pd.DataFrame) -> List[int]:
     return list(np.where(df.dtypes == "category")[0])
 
@@ -146,8 +256,12 @@ def get_data(query):
        Dump of Query into a DataFrame
     """
 
-    with connect_to_db() as conn:
-        df = pd.read_sql_query(query, conn)
+    from setup_environment import connect_to_db
+
+    with measure("db_read", "get_data") as metrics:
+        with connect_to_db() as conn:
+            df = pd.read_sql_query(query, conn)
+        metrics["rows_out"] = len(df)
     return df
 
 
@@ -163,14 +277,15 @@ def write_to_db(
     #     with engine.begin() as connection:
     #         connection.execute(text("""SET ROLE "pakistan-ihhn-role" """))
 
-    df.to_sql(
-        name=table_name,
-        schema=schema_name,
-        con=engine,
-        if_exists=table_behaviour,
-        index=index,
-        **kwargs,
-    )
+    with measure("db_write", table_name, rows_in=len(df)):
+        df.to_sql(
+            name=table_name,
+            schema=schema_name,
+            con=engine,
+            if_exists=table_behaviour,
+            index=index,
+            **kwargs,
+        )
 
 
 def ee_array_to_df(arr, list_of_bands):
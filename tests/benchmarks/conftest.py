@@ -0,0 +1,14 @@
+import os
+
+import pytest
+from src.backends.synthetic import openaq_frame
+
+# e.g. OPENAQ_BENCHMARK_ROWS=10000,1000000,10000000 for the full sweep
+BENCHMARK_ROWS = [
+    int(rows) for rows in os.getenv("OPENAQ_BENCHMARK_ROWS", "10000").split(",")
+]
+
+
+@pytest.fixture(params=BENCHMARK_ROWS, ids=lambda rows: f"{rows}_rows", scope="session")
+def raw_df(request):
+    return openaq_frame(request.param)
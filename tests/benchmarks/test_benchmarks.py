@@ -0,0 +1,218 @@
+"""
+Throughput benchmarks for the hot paths, on synthetic openaq data.
+
+Run with `make benchmark`, which saves every run under `.benchmarks`
+and fails when a mean regresses past the threshold against the last
+saved run.
+"""
+from os import cpu_count
+
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+pytest.importorskip("pytest_benchmark")
+
+from src.backends.synthetic import (  # noqa: E402
+    CITIES,
+    COUNTRIES,
+    athena_response,
+    ee_region_array,
+)
+from src.cohort_builder import CohortBuilder  # noqa: E402
+from src.executor import Executor  # noqa: E402
+from src.features.feature_matrix import MATRIX_NAME, FeatureMatrix  # noqa: E402
+from src.features.spatial._neighbors import NeighborFeatures  # noqa: E402
+from src.features.temporal._lags import TemporalFeatures  # noqa: E402
+from src.model_runner import ModelRunner  # noqa: E402
+from src.preprocess import Preprocess  # noqa: E402
+from src.preprocessing.filter import Filter  # noqa: E402
+from src.preprocessing.region import Region  # noqa: E402
+from src.time_splitter import TimeSplitter, time_splits  # noqa: E402
+from src.utils.utils import ee_array_to_df  # noqa: E402
+
+from config.model_settings import (  # noqa: E402
+    CohortBuilderConfig,
+    NeighborFeaturesConfig,
+    TemporalFeaturesConfig,
+    TimeSplitterConfig,
+)
+
+BANDS = ["NO2_column_number_density", "tropospheric_NO2_column_number_density"]
+
+
+def test_preprocess_execute(benchmark, raw_df):
+    preprocess = Preprocess.from_options(
+        list(CohortBuilderConfig().FILTER_DICT.keys()),
+        pollutant_to_predict=["pm25", "pm10"],
+    )
+    benchmark.pedantic(
+        preprocess.execute, setup=lambda: ((raw_df.copy(),), {}), rounds=3
+    )
+
+
+def test_preprocess_execute_sharded(benchmark, raw_df):
+    preprocess = Preprocess.from_options(
+        list(CohortBuilderConfig().FILTER_DICT.keys()),
+        pollutant_to_predict=["pm25", "pm10"],
+        executor=Executor("loky", name="preprocess"),
+        shard_rows=max(len(raw_df) // (4 * cpu_count()), 1),
+    )
+    benchmark.pedantic(
+        preprocess.execute, setup=lambda: ((raw_df.copy(),), {}), rounds=3
+    )
+
+
+@pytest.mark.parametrize(
+    "filter_, args",
+    [
+        (Filter.filter_pollutant, (["pm25", "no2"],)),
+        (Filter.filter_no_coordinates, ()),
+        (Filter.filter_non_null_values, ()),
+        (Filter.filter_extreme_values, ()),
+        (Filter.filter_countries, (COUNTRIES[:2],)),
+        (Filter.filter_cities, (CITIES[:2],)),
+    ],
+    ids=lambda value: getattr(value, "__name__", ""),
+)
+def test_filter(benchmark, raw_df, filter_, args):
+    benchmark(filter_, raw_df, *args)
+
+
+def test_filter_region(benchmark, raw_df):
+    rng = np.random.default_rng(0)
+    points_df = pd.DataFrame(
+        dict(
+            x=rng.uniform(-180, 180, len(raw_df)),
+            y=rng.uniform(-90, 90, len(raw_df)),
+        )
+    )
+    # a few hundred small polygons, like a GeoJSON of city boundaries
+    region = Region(
+        shapely.buffer(
+            shapely.points(rng.uniform(-180, 180, 300), rng.uniform(-60, 60, 300)),
+            2,
+        )
+    )
+    benchmark(Filter.filter_region, points_df, region)
+
+
+def test_neighbor_features(benchmark, raw_df):
+    # one reading per sensor, spread over a week of global sensors
+    rng = np.random.default_rng(0)
+    readings_df = pd.DataFrame(
+        dict(
+            parameter="pm25",
+            timestamp_utc=rng.choice(
+                pd.date_range("2021-01-01", periods=7).strftime("%Y-%m-%d"),
+                len(raw_df),
+            ),
+            x=rng.uniform(-180, 180, len(raw_df)),
+            y=rng.uniform(-60, 70, len(raw_df)),
+            value=rng.uniform(0, 100, len(raw_df)),
+        )
+    )
+    benchmark(
+        NeighborFeatures.from_dataclass_config(NeighborFeaturesConfig()).execute,
+        readings_df,
+    )
+
+
+def test_temporal_features(benchmark, raw_df):
+    # hourly readings of a few hundred sensors over a year
+    rng = np.random.default_rng(0)
+    readings_df = pd.DataFrame(
+        dict(
+            parameter="pm25",
+            location=rng.integers(0, 500, len(raw_df)).astype(str),
+            timestamp_utc=rng.choice(
+                pd.date_range("2021-01-01", periods=24 * 365, freq="h").strftime(
+                    "%Y-%m-%dT%H:%M:%S.%fZ"
+                ),
+                len(raw_df),
+            ),
+            value=rng.uniform(0, 100, len(raw_df)),
+        )
+    )
+    benchmark(
+        TemporalFeatures.from_dataclass_config(TemporalFeaturesConfig()).execute,
+        readings_df,
+    )
+
+
+def test_model_runner(benchmark, raw_df, tmp_path):
+    # three expanding training windows, each followed by its validation window
+    rng = np.random.default_rng(0)
+    rows = len(raw_df)
+    FeatureMatrix(
+        rng.uniform(0, 100, (rows, 20)).astype(np.float32),
+        [f"feature_{index}" for index in range(20)],
+        [],
+        rng.uniform(0, 100, rows).astype(np.float32),
+    ).save(str(tmp_path), MATRIX_NAME)
+    cohorts_df = pd.DataFrame(
+        [
+            dict(
+                cohort=f"{cohort_type}_{window}",
+                cohort_type=cohort_type,
+                parameter="pm25",
+                train_validation_set=window,
+                start_row=0 if cohort_type == "training" else end,
+                end_row=end if cohort_type == "training" else end + rows // 4,
+            )
+            for window, end in enumerate([rows // 4, rows // 2, rows * 3 // 4])
+            for cohort_type in ["training", "validation"]
+        ]
+    )
+    model_runner = ModelRunner(
+        str(tmp_path),
+        dict(n_estimators=10, random_state=0, n_jobs=1),
+        Executor("threads", n_jobs=cpu_count()),
+        "model_metrics",
+    )
+    benchmark(model_runner.execute, cohorts_df)
+
+
+def test_ee_array_to_df(benchmark, raw_df):
+    benchmark(ee_array_to_df, ee_region_array(len(raw_df), BANDS), BANDS)
+
+
+def test_build_response_from_aws(benchmark, monkeypatch, raw_df):
+    response = athena_response(raw_df)
+    monkeypatch.setattr(
+        "src.cohort_builder.query_results", lambda params, query: response
+    )
+    cohort_builder = CohortBuilder.from_dataclass_config(CohortBuilderConfig())
+    benchmark(cohort_builder._build_response_from_aws, {}, "")
+
+
+def test_time_splitter_execute(benchmark, monkeypatch):
+    def query_results(params, query):
+        timestamp = "2015-06-01" if "ASC" in query else "2022-12-31"
+        return {
+            "ResultSet": {
+                "Rows": [
+                    {"Data": [{"VarCharValue": "datetime"}]},
+                    {"Data": [{"VarCharValue": f"{timestamp} 00:00:00.000 UTC"}]},
+                ]
+            }
+        }
+
+    monkeypatch.setattr("src.time_splitter.query_results", query_results)
+    benchmark(TimeSplitter.from_dataclass_config(TimeSplitterConfig()).execute)
+
+
+def test_time_splits(benchmark):
+    # a daily rolling backtest over a decade
+    benchmark(
+        time_splits,
+        "2013-01-01",
+        "2022-12-31",
+        validation_length=7,
+        step=1,
+        window_count=3000,
+        unit="days",
+        training_length=365,
+        gap=1,
+    )
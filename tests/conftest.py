@@ -0,0 +1,41 @@
+import os
+import sys
+from dataclasses import replace
+
+import pytest
+
+# the engine modules import each other as `src.*` and `config.*`
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "openaq_engine"))
+
+from config.model_settings import BackendConfig  # noqa: E402
+
+
+@pytest.fixture
+def fake_athena(monkeypatch):
+    """Answer athena queries from the duckdb fake, without latency"""
+    pytest.importorskip("duckdb")
+    from src.utils import utils
+
+    config = BackendConfig(
+        ATHENA_BACKEND="fake",
+        ATHENA_RECORDINGS_DIR=None,
+        FAKE_ATHENA_ROWS=5000,
+        FAKE_ATHENA_QUEUE_SECONDS=0,
+        FAKE_ATHENA_EXECUTION_SECONDS=0,
+        FAKE_ATHENA_API_SECONDS=0,
+    )
+    monkeypatch.setattr(utils, "BackendConfig", lambda: config)
+    return config
+
+
+@pytest.fixture
+def fake_backends(monkeypatch, fake_athena):
+    """Answer earth engine requests from the fake too"""
+    pytest.importorskip("ee")
+    from src.features.satellite import _ee_data
+    from src.utils import utils
+
+    config = replace(fake_athena, EE_BACKEND="fake", FAKE_EE_LATENCY_SECONDS=0)
+    monkeypatch.setattr(utils, "BackendConfig", lambda: config)
+    monkeypatch.setattr(_ee_data, "BackendConfig", lambda: config)
+    return config
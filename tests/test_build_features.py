@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip("ee")
+
+from src.features.build_features import BuildFeaturesRandomForest  # noqa: E402
+from src.features.feature_matrix import FEATURES_TABLE  # noqa: E402
+from src.intermediate_store import ArrowStore  # noqa: E402
+
+from config.model_settings import BuildFeaturesConfig  # noqa: E402
+from tests.test_cohort_builder import (  # noqa: E402
+    TRAIN_VALIDATION_DICT,
+    cohort_builder,
+)
+
+
+@pytest.fixture
+def store_dir(tmp_path, fake_backends):
+    cohort_builder(tmp_path).execute(TRAIN_VALIDATION_DICT, None)
+    return str(tmp_path / "intermediate")
+
+
+def feature_builder(store_dir, **options) -> BuildFeaturesRandomForest:
+    return BuildFeaturesRandomForest.from_dataclass_config(
+        BuildFeaturesConfig(STORE_DIR=store_dir, **options)
+    )
+
+
+@pytest.mark.parametrize("feature_store", [False, True])
+def test_builds_features(tmp_path, store_dir, feature_store):
+    builder = feature_builder(
+        store_dir,
+        FEATURE_STORE_DIR=str(tmp_path / "feature_store") if feature_store else None,
+    )
+    measurements_df = builder._read_measurements()
+    df = builder.execute()
+    assert list(df.columns) == builder.all_model_features
+    assert len(df) == len(measurements_df)
+    assert df[["pca_lat", "pca_lng"]].notna().all().all()
+    assert df.knn_mean.notna().any()
+
+
+def test_builds_features_out_of_core(store_dir):
+    builder = feature_builder(store_dir, FEATURE_STORE_DIR=None)
+    in_memory_df = builder.execute()
+    builder.out_of_core = True
+    assert builder.execute() is None
+    df = ArrowStore(store_dir).read(FEATURES_TABLE)
+    assert list(df.columns) == builder.all_model_features
+    assert len(df) == len(in_memory_df)
+    assert df.pca_lat.sort_values().to_numpy() == pytest.approx(
+        in_memory_df.pca_lat.sort_values().to_numpy()
+    )
@@ -0,0 +1,103 @@
+from dataclasses import replace
+from datetime import date
+
+import pytest
+
+from src.backends.synthetic import POLLUTANTS, SOURCE_TYPES
+from src.cohort_builder import CohortBuilder
+from src.cohort_store import CohortStore
+from src.intermediate_store import ArrowStore
+
+from config.model_settings import (
+    CohortBuilderConfig,
+    ExecutorConfig,
+    MaterializeConfig,
+    SamplingConfig,
+)
+
+TRAIN_VALIDATION_DICT = dict(
+    validation=[(date(2021, 6, 1), date(2021, 7, 1))],
+    training=[(date(2021, 1, 1), date(2021, 6, 1))],
+)
+
+
+def cohort_builder(tmp_path, **options) -> CohortBuilder:
+    return CohortBuilder.from_dataclass_config(
+        CohortBuilderConfig(
+            STORE_DIR=str(tmp_path / "intermediate"),
+            SPILL_DIR=str(tmp_path / "spill"),
+            PREPROCESS_EXECUTOR=ExecutorConfig(BACKEND="serial"),
+            **options,
+        )
+    )
+
+
+def test_builds_cohorts_without_a_database(tmp_path, fake_athena):
+    cohort_store = cohort_builder(tmp_path).execute(TRAIN_VALIDATION_DICT, None)
+    assert len(cohort_store.measurements_df) > 0
+    stored = CohortStore.from_store(ArrowStore(str(tmp_path / "intermediate")))
+    assert stored.cohorts == cohort_store.cohorts
+
+
+@pytest.mark.parametrize("aggregation", ["sql", "pandas"])
+def test_daily_aggregation(tmp_path, fake_athena, aggregation):
+    cohort_store = cohort_builder(tmp_path, AGGREGATION=aggregation).execute(
+        TRAIN_VALIDATION_DICT, None
+    )
+    measurements_df = cohort_store.measurements_df
+    assert len(measurements_df) > 0
+    assert {"sourcetype", "mobile", "value_count"} <= set(measurements_df.columns)
+    assert not measurements_df.duplicated(["location", "timestamp_utc"]).any()
+
+
+def test_stratified_by_source_type(tmp_path, fake_athena):
+    cohort_store = cohort_builder(
+        tmp_path,
+        SAMPLING=SamplingConfig(FRACTION=0.01, STRATA=["country", "sourcetype"]),
+    ).execute(TRAIN_VALIDATION_DICT, None)
+    assert cohort_store.measurements_df.sourcetype.nunique() == len(SOURCE_TYPES)
+
+
+def test_preprocesses_batches_while_fetching(tmp_path, fake_athena, monkeypatch):
+    from src.utils import utils
+
+    # every pollutant over the whole table, for more pages than the queues hold
+    config = replace(fake_athena, FAKE_ATHENA_ROWS=8000)
+    monkeypatch.setattr(utils, "BackendConfig", lambda: config)
+    builder = cohort_builder(tmp_path, POLLUTANT_TO_PREDICT=POLLUTANTS, BATCH_ROWS=1)
+    events = []
+    iter_response_batches = builder._iter_response_batches
+    preprocess = builder._preprocess
+
+    def fetch(*args):
+        yield from iter_response_batches(*args)
+        events.append("fetched")
+
+    def record_preprocess(measurements_df):
+        events.append("preprocess")
+        return preprocess(measurements_df)
+
+    monkeypatch.setattr(builder, "_iter_response_batches", fetch)
+    monkeypatch.setattr(builder, "_preprocess", record_preprocess)
+    cohort_store = builder.execute(
+        dict(training=[(date(2019, 1, 1), date(2023, 1, 1))]), None
+    )
+    assert events.count("preprocess") > 1
+    assert events.index("preprocess") < events.index("fetched")
+    assert len(cohort_store.measurements_df) > 0
+
+
+def test_staging_table_holds_every_pollutant():
+    assert MaterializeConfig().POLLUTANT_TO_PREDICT == (
+        CohortBuilderConfig().POLLUTANT_TO_PREDICT
+    )
+    with pytest.raises(ValueError, match="no2"):
+        CohortBuilder._check_staging_table(
+            CohortBuilderConfig(USE_STAGING_TABLE=True, POLLUTANT_TO_PREDICT=["no2"]),
+            MaterializeConfig(),
+        )
+    with pytest.raises(ValueError, match="materialized"):
+        CohortBuilder._check_staging_table(
+            CohortBuilderConfig(USE_STAGING_TABLE=True),
+            MaterializeConfig(STAGING_TABLE_NAME="other_staging"),
+        )
@@ -0,0 +1,118 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+from src.cohort_store import CohortStore
+from src.intermediate_store import ArrowStore
+
+PARAMETERS = ["no2", "pm25"]
+TRAIN_VALIDATION_DICT = dict(
+    validation=[
+        (date(2022, 3, 1), date(2022, 4, 1)),
+        (date(2022, 2, 1), date(2022, 3, 1)),
+    ],
+    training=[
+        (date(2022, 1, 1), date(2022, 3, 1)),
+        (date(2022, 1, 1), date(2022, 2, 1)),
+    ],
+)
+
+
+@pytest.fixture(scope="module")
+def measurements_df():
+    rng = np.random.default_rng(0)
+    n_rows = 5000
+    timestamps = pd.Timestamp("2021-12-20", tz="UTC") + pd.to_timedelta(
+        rng.integers(0, 24 * 120, n_rows), unit="h"
+    )
+    return pd.DataFrame(
+        dict(
+            # the pm10 readings belong to no cohort
+            parameter=rng.choice(PARAMETERS + ["pm10"], n_rows),
+            location=rng.integers(0, 50, n_rows),
+            timestamp_utc=timestamps.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            value=rng.random(n_rows) * 50,
+        )
+    )
+
+
+@pytest.fixture(scope="module")
+def cohort_store(measurements_df):
+    return CohortStore.from_windows(measurements_df, TRAIN_VALIDATION_DICT, PARAMETERS)
+
+
+def window_rows(measurements_df, parameter, start_date, end_date):
+    """The readings `date.utc BETWEEN start AND end` selects"""
+    return measurements_df[
+        (measurements_df.parameter == parameter)
+        & (measurements_df.timestamp_utc >= str(start_date))
+        & (measurements_df.timestamp_utc <= str(end_date))
+    ]
+
+
+def sort_rows(df):
+    return df.sort_values(list(df.columns), ignore_index=True)
+
+
+def test_cohorts_match_window_filters(measurements_df, cohort_store):
+    definitions_df = cohort_store.cohort_definitions_df
+    assert len(definitions_df) == len(PARAMETERS) * 4
+    for cohort, definition in definitions_df.iterrows():
+        pd.testing.assert_frame_equal(
+            sort_rows(cohort_store.get_cohort(cohort)),
+            sort_rows(
+                window_rows(
+                    measurements_df,
+                    definition.parameter,
+                    definition.start_date,
+                    definition.end_date,
+                )
+            ),
+        )
+
+
+def test_read_cohort_from_store(tmp_path, cohort_store):
+    store = ArrowStore(str(tmp_path))
+    cohort_store.to_store(store)
+    for cohort in cohort_store.cohorts:
+        pd.testing.assert_frame_equal(
+            CohortStore.read_cohort(store, cohort).reset_index(drop=True),
+            cohort_store.get_cohort(cohort).reset_index(drop=True),
+        )
+
+
+@pytest.mark.parametrize("replace_from", [None, "2022-02-15"])
+def test_append_to_store(tmp_path, measurements_df, replace_from):
+    watermark = "2022-02-15T12:00:00"
+    stored_df = measurements_df[measurements_df.timestamp_utc <= watermark]
+    new_df = measurements_df[
+        measurements_df.timestamp_utc >= replace_from
+        if replace_from
+        else measurements_df.timestamp_utc > watermark
+    ]
+    store = ArrowStore(str(tmp_path))
+    CohortStore.from_windows(stored_df, TRAIN_VALIDATION_DICT, PARAMETERS).to_store(
+        store
+    )
+    CohortStore.append_to_store(
+        store, new_df, TRAIN_VALIDATION_DICT, PARAMETERS, replace_from=replace_from
+    )
+
+    expected = CohortStore.from_windows(
+        measurements_df, TRAIN_VALIDATION_DICT, PARAMETERS
+    )
+    appended = CohortStore.from_store(store)
+    pd.testing.assert_frame_equal(
+        appended.cohort_definitions_df, expected.cohort_definitions_df
+    )
+    pd.testing.assert_frame_equal(
+        appended.measurements_df.reset_index(drop=True),
+        expected.measurements_df,
+        check_like=True,
+    )
+    for cohort in expected.cohorts:
+        pd.testing.assert_frame_equal(
+            CohortStore.read_cohort(store, cohort).reset_index(drop=True),
+            expected.get_cohort(cohort).reset_index(drop=True),
+        )
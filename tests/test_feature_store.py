@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.features.feature_store import FeatureStore
+from src.features.spatial._neighbors import NeighborFeatures
+from src.features.temporal._lags import TemporalFeatures
+
+from config.model_settings import NeighborFeaturesConfig, TemporalFeaturesConfig
+
+FEATURES = ["knn_mean", "radius_count", "lag_1", "lag_24", "rolling_24_mean"]
+
+
+@pytest.fixture(scope="module")
+def readings_df():
+    rng = np.random.default_rng(0)
+    n_rows = 6000
+    timestamps = pd.Timestamp("2022-01-01", tz="UTC") + pd.to_timedelta(
+        rng.integers(0, 24 * 10, n_rows), unit="h"
+    )
+    locations = rng.integers(0, 30, n_rows)
+    return (
+        pd.DataFrame(
+            dict(
+                parameter="pm25",
+                location=locations,
+                timestamp_utc=timestamps.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                value=rng.random(n_rows) * 50,
+                x=locations / 10,
+                y=locations / 20,
+            )
+        )
+        .drop_duplicates(["location", "timestamp_utc"])
+        .sort_values("timestamp_utc", ignore_index=True)
+    )
+
+
+def compute(df: pd.DataFrame) -> pd.DataFrame:
+    temporal_config = TemporalFeaturesConfig(PROFILES=[])
+    return df.pipe(
+        NeighborFeatures.from_dataclass_config(NeighborFeaturesConfig()).execute
+    ).pipe(TemporalFeatures.from_dataclass_config(temporal_config).execute)
+
+
+def test_incremental_matches_full(tmp_path, readings_df):
+    store = FeatureStore(str(tmp_path), "test")
+    # each run ends part way through a day, whose later readings come next run
+    for end in ["2022-01-04T12", "2022-01-07T06", "2022-01-11"]:
+        df = readings_df[readings_df.timestamp_utc < end].reset_index(drop=True)
+        store.update(df, compute, lookback_days=2)
+        pd.testing.assert_frame_equal(
+            store.read(df, FEATURES)[FEATURES],
+            compute(df)[FEATURES],
+            check_dtype=False,
+        )
+    assert store.update(readings_df, compute, lookback_days=2) == 0
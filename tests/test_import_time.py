@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+ENGINE_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "openaq_engine")
+
+# loaded by the subcommands that need them, never by the cli itself
+HEAVY_MODULES = [
+    "boto3",
+    "ee",
+    "geetools",
+    "googleapiclient",
+    "joblib",
+    "pandas",
+    "psycopg2",
+    "shapely",
+    "sqlalchemy",
+]
+IMPORT_BUDGET_SECONDS = 1.0
+
+
+def import_times(module: str):
+    """Cumulative import time in seconds of every module `module` imports"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ENGINE_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def test_cli_import_skips_heavy_modules():
+    times = import_times("main")
+    assert [module for module in HEAVY_MODULES if module in times] == []
+
+
+def test_cli_import_time():
+    assert import_times("main")["main"] < IMPORT_BUDGET_SECONDS
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.features.spatial._neighbors import (
+    EARTH_RADIUS_KM,
+    NEIGHBOR_FEATURES,
+    NeighborFeatures,
+)
+
+from config.model_settings import NeighborFeaturesConfig
+
+
+@pytest.fixture(scope="module")
+def neighbors():
+    return NeighborFeatures.from_dataclass_config(NeighborFeaturesConfig())
+
+
+@pytest.fixture(scope="module")
+def readings_df():
+    rng = np.random.default_rng(0)
+    n_rows = 400
+    return pd.DataFrame(
+        dict(
+            parameter=rng.choice(["pm25", "no2"], n_rows),
+            location=rng.integers(0, 100, n_rows),
+            timestamp_utc=rng.choice(
+                [
+                    "2022-01-01T01:00:00Z",
+                    "2022-01-01T05:00:00Z",
+                    "2022-01-02T01:00:00Z",
+                ],
+                n_rows,
+            ),
+            value=rng.random(n_rows) * 50,
+            x=rng.uniform(-1, 1, n_rows),
+            y=rng.uniform(50, 52, n_rows),
+        )
+    )
+
+
+@pytest.mark.parametrize(
+    "select",
+    [
+        lambda df: df.head(0),
+        lambda df: df.assign(x=np.nan),
+        lambda df: df.assign(value="not a number"),
+    ],
+    ids=["no_rows", "no_coordinates", "no_values"],
+)
+def test_no_usable_sensors(neighbors, readings_df, select):
+    df = neighbors.execute(select(readings_df))
+    assert set(NEIGHBOR_FEATURES) <= set(df.columns)
+    assert (df.radius_count == 0).all()
+    assert df[["knn_mean", "radius_mean"]].isna().all().all()
+
+
+def brute_force_features(df: pd.DataFrame, config: NeighborFeaturesConfig):
+    """Every sensor's neighbors from the haversine distance to all the others"""
+    sensors_df = (
+        df.assign(day=df.timestamp_utc.str[:10])
+        .groupby(["parameter", "day", "x", "y"], as_index=False)
+        .value.mean()
+    )
+    features = []
+    for _, day_df in sensors_df.groupby(["parameter", "day"]):
+        lat, lon = np.radians(day_df.y.to_numpy()), np.radians(day_df.x.to_numpy())
+        for i, sensor in enumerate(day_df.itertuples()):
+            distances_km = (
+                2
+                * EARTH_RADIUS_KM
+                * np.arcsin(
+                    np.sqrt(
+                        np.sin((lat - lat[i]) / 2) ** 2
+                        + np.cos(lat[i]) * np.cos(lat) * np.sin((lon - lon[i]) / 2) ** 2
+                    )
+                )
+            )
+            others = np.arange(len(day_df)) != i
+            values = day_df.value.to_numpy()[others]
+            distances_km = distances_km[others]
+            weights = 1 / np.maximum(distances_km, config.MIN_DISTANCE_KM)
+            nearest = np.argsort(distances_km)[: config.K_NEIGHBORS]
+            within = distances_km <= config.RADIUS_KM
+            features.append(
+                dict(
+                    parameter=sensor.parameter,
+                    day=sensor.day,
+                    x=sensor.x,
+                    y=sensor.y,
+                    knn_mean=values[nearest].mean(),
+                    knn_idw=np.average(values[nearest], weights=weights[nearest]),
+                    knn_distance_km=distances_km[nearest].mean(),
+                    radius_count=within.sum(),
+                    radius_mean=values[within].mean() if within.any() else np.nan,
+                    radius_idw=(
+                        np.average(values[within], weights=weights[within])
+                        if within.any()
+                        else np.nan
+                    ),
+                )
+            )
+    return df.assign(day=df.timestamp_utc.str[:10]).merge(
+        pd.DataFrame(features), on=["parameter", "day", "x", "y"], how="left"
+    )
+
+
+def test_matches_brute_force(neighbors, readings_df):
+    pd.testing.assert_frame_equal(
+        neighbors.execute(readings_df)[NEIGHBOR_FEATURES],
+        brute_force_features(readings_df, NeighborFeaturesConfig())[NEIGHBOR_FEATURES],
+        check_dtype=False,
+    )
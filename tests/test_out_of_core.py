@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+from src.out_of_core import SpillStore
+
+
+def test_spill_batch_spanning_years(tmp_path):
+    rng = np.random.default_rng(0)
+    n_rows = 5000
+    days = pd.date_range("2018-01-01", periods=700, freq="D").strftime("%Y-%m-%d")
+    # athena returns the rows in no particular order
+    df = pd.DataFrame(
+        dict(
+            parameter=rng.choice(["pm25", "no2"], n_rows),
+            day=rng.choice(days, n_rows),
+            value=np.arange(n_rows, dtype=float),
+        )
+    )
+    spill_store = SpillStore(str(tmp_path), ["parameter", "day"])
+    spill_store.write(df.head(n_rows // 2))
+    spill_store.write(df.tail(n_rows - n_rows // 2))
+    partitions = list(spill_store.iter_partitions())
+    assert len(partitions) == df.groupby(["parameter", "day"]).ngroups > 1024
+    assert [values for values, _ in partitions] == sorted(
+        values for values, _ in partitions
+    )
+    for (parameter, day), partition_df in partitions:
+        # the rows of a partition come back in the order they were written
+        expected = df[(df.parameter == parameter) & (df.day == day)].value
+        assert partition_df.value.tolist() == expected.tolist()
@@ -0,0 +1,55 @@
+import pandas as pd
+from src.pipeline import PipelineRunner, Stage, fingerprint_config, source_modules
+
+from config.model_settings import CohortBuilderConfig, ScanBudgetConfig
+
+
+def stage(config: CohortBuilderConfig) -> Stage:
+    return Stage(
+        "cohort-builder",
+        config,
+        lambda: pd.DataFrame(),
+        lambda df: {"df": df},
+        lambda frames: frames["df"],
+    )
+
+
+def test_scan_budget_is_not_fingerprinted(tmp_path):
+    runner = PipelineRunner(str(tmp_path))
+    config = CohortBuilderConfig()
+    budgeted = CohortBuilderConfig(
+        SCAN_BUDGET=ScanBudgetConfig(MAX_SCAN_GB=1.0, STATS_PATH="stats.json")
+    )
+    assert budgeted.SCAN_BUDGET.MAX_SCAN_GB == 1.0
+    assert runner._fingerprint(stage(budgeted), {}) == runner._fingerprint(
+        stage(config), {}
+    )
+    batched = CohortBuilderConfig(BATCH_ROWS=1)
+    assert runner._fingerprint(stage(batched), {}) != runner._fingerprint(
+        stage(config), {}
+    )
+
+
+def test_class_attributes_are_fingerprinted():
+    config = fingerprint_config(CohortBuilderConfig())
+    assert config["TABLE_NAME"] == CohortBuilderConfig.TABLE_NAME
+    assert config["REGION"] == CohortBuilderConfig.REGION
+    assert "S3_OUTPUT" in config
+    assert "MAX_SCAN_GB" not in config["SCAN_BUDGET"]
+
+
+def test_stage_code_includes_imported_modules():
+    from src.cohort_builder import CohortBuilder
+
+    modules = source_modules([CohortBuilder])
+    assert {
+        "src.cohort_builder",
+        "src.preprocess",
+        "src.preprocessing.filter",
+        "src.preprocessing.aggregate",
+        "src.preprocessing.region",
+        "src.query.sql_filter",
+        "src.query.sql_aggregate",
+        # imported inside a function
+        "src.backends.fake_athena",
+    } <= set(modules)
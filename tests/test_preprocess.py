@@ -0,0 +1,41 @@
+import pandas as pd
+import pytest
+from src.backends.synthetic import openaq_frame
+from src.executor import Executor
+from src.preprocess import Preprocess
+
+from config.model_settings import CohortBuilderConfig
+
+FILTERS = list(CohortBuilderConfig().FILTER_DICT.keys())
+
+
+@pytest.fixture(scope="module")
+def raw_df():
+    # sorted, so the shards at either end hold no pm25 readings at all
+    return openaq_frame(2000).sort_values("parameter", ignore_index=True)
+
+
+def test_sharded_matches_serial(raw_df):
+    serial_df = Preprocess.from_options(FILTERS, pollutant_to_predict="pm25").execute(
+        raw_df
+    )
+    sharded_df = Preprocess.from_options(
+        FILTERS,
+        pollutant_to_predict="pm25",
+        executor=Executor("serial"),
+        shard_rows=200,
+    ).execute(raw_df)
+    assert len(serial_df) > 0
+    pd.testing.assert_frame_equal(
+        serial_df.reset_index(drop=True), sharded_df.reset_index(drop=True)
+    )
+
+
+@pytest.mark.parametrize("aggregate_daily", [False, True])
+def test_no_rows_left_after_filtering(raw_df, aggregate_daily):
+    df = Preprocess.from_options(
+        FILTERS, countries=["ZZ"], aggregate_daily=aggregate_daily
+    ).execute(raw_df)
+    assert df.empty
+    assert {"timestamp_utc", "x", "y"} <= set(df.columns)
+    assert "pnt" not in df.columns
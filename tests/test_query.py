@@ -0,0 +1,111 @@
+import pandas as pd
+import pytest
+import shapely
+from src.preprocessing.region import Region
+from src.query.partitions import PartitionLayout
+from src.query.sql_filter import SqlFilter
+from src.query.sql_sample import SqlSample
+
+YMD_COLS = {"year": "%Y", "month": "%m", "day": "%d"}
+
+
+def test_filter_sql():
+    assert SqlFilter.filter_pollutant("pm25") == "parameter IN ('pm25')"
+    assert (
+        SqlFilter.from_options(
+            ["filter_pollutant", "filter_non_null_values", "filter_extreme_values"],
+            ["pm25", "no2"],
+        )
+        == "parameter IN ('pm25', 'no2') AND value >= 0 AND value <= 500"
+    )
+    assert SqlFilter.from_options(["filter_region"], "pm25") == "TRUE"
+
+
+def test_filter_region_sql():
+    region = Region([shapely.box(-1.5, 50.0, 2.25, 52.5)])
+    assert SqlFilter.filter_region(region) == (
+        """coordinates.longitude BETWEEN -1.5 AND 2.25
+            AND coordinates.latitude BETWEEN 50.0 AND 52.5"""
+    )
+
+
+def test_single_column_partition_filter():
+    layout = PartitionLayout({"aggregatedate": "%Y-%m-%d"}, "parameter")
+    assert layout.partition_filter("2021-12-30", "2022-03-02", ["pm25", "no2"]) == (
+        """
+                AND aggregatedate BETWEEN '2021-12-30' AND '2022-03-02'
+                AND parameter IN ('pm25', 'no2')"""
+    )
+
+
+@pytest.mark.parametrize(
+    "start_date, end_date",
+    [
+        ("2022-03-04", "2022-03-04"),
+        ("2021-12-30", "2022-03-02"),
+        ("2022-01-01", "2022-12-31"),
+        ("2020-02-15", "2022-02-15"),
+    ],
+)
+def test_partition_filter_selects_window_days(start_date, end_date):
+    duckdb = pytest.importorskip("duckdb")
+    days = pd.date_range("2019-01-01", "2023-12-31", freq="D")
+    calendar_df = pd.DataFrame(
+        {col: days.strftime(fmt) for col, fmt in YMD_COLS.items()}
+    ).assign(date=days.strftime("%Y-%m-%d"))
+    predicate = PartitionLayout(YMD_COLS).partition_filter(start_date, end_date)
+    connection = duckdb.connect()
+    connection.register("calendar", calendar_df)
+    selected = connection.execute(
+        f"SELECT date FROM calendar WHERE TRUE {predicate} ORDER BY date"
+    ).fetchall()
+    assert [day for day, in selected] == list(
+        pd.date_range(start_date, end_date, freq="D").strftime("%Y-%m-%d")
+    )
+
+
+def test_sample_sql():
+    assert SqlSample().sample_filter() == ""
+    assert SqlSample(0.1).table_sample() == ""
+    assert SqlSample(0.1, method="bernoulli").table_sample() == (
+        " TABLESAMPLE BERNOULLI (10)"
+    )
+    assert SqlSample(0.1, method="bernoulli").sample_filter(["a"]) == ""
+    bucket = "crc32(to_utf8('0:' || CAST(location AS varchar)))\n            % 10000"
+    assert SqlSample(0.1).sample_filter() == f"\n            AND {bucket} < 1000"
+    assert SqlSample(0.1, strata=["country"]).sample_filter(["st john's", "b"]) == (
+        f"""
+            AND ({bucket} < 1000
+            OR CAST(location AS varchar) IN ('st john''s', 'b'))"""
+    )
+
+
+def test_stratified_sample_keeps_every_stratum():
+    pytest.importorskip("duckdb")
+    from src.backends.fake_athena import _duckdb_connection
+
+    connection = _duckdb_connection(None, "openaq", 5000, 0)
+    sample = SqlSample(0.05, strata=["country"])
+    stratum_ids = [
+        location
+        for location, in connection.execute(
+            sample.strata_query("openaq", "TRUE")
+        ).fetchall()
+    ]
+    countries = connection.execute(
+        "SELECT count(DISTINCT country) FROM openaq"
+    ).fetchone()[0]
+    assert len(stratum_ids) == countries
+    sampled_df = connection.execute(
+        f"""SELECT location, country FROM openaq
+        WHERE TRUE {sample.sample_filter(stratum_ids)}"""
+    ).df()
+    assert sampled_df.country.nunique() == countries
+    assert set(stratum_ids) <= set(sampled_df.location)
+    hashed_df = connection.execute(
+        f"SELECT DISTINCT location FROM openaq WHERE TRUE {sample.sample_filter()}"
+    ).df()
+    all_locations = connection.execute(
+        "SELECT count(DISTINCT location) FROM openaq"
+    ).fetchone()[0]
+    assert 0 < len(hashed_df) < 0.2 * all_locations
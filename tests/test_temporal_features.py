@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.features.temporal._lags import TemporalFeatures
+
+from config.model_settings import TemporalFeaturesConfig
+
+CONFIG = TemporalFeaturesConfig()
+
+
+@pytest.fixture(scope="module")
+def readings_df():
+    rng = np.random.default_rng(0)
+    n_rows = 20000
+    timestamps = (
+        pd.Timestamp("2022-01-01", tz="UTC")
+        + pd.to_timedelta(rng.integers(0, 24 * 21, n_rows), unit="h")
+        + pd.to_timedelta(rng.integers(0, 60, n_rows), unit="min")
+    )
+    df = pd.DataFrame(
+        dict(
+            parameter=rng.choice(["pm25", "no2"], n_rows),
+            location=rng.integers(0, 30, n_rows),
+            timestamp_utc=timestamps.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            value=rng.random(n_rows) * 50,
+        )
+    )
+    # a few sensors go quiet for days at a time
+    quiet = (df.location < 4) & (timestamps.day % 7 < 4)
+    return (
+        df[~quiet]
+        .assign(day=lambda df: df.timestamp_utc.str[:10])
+        .sort_values(["parameter", "day", "timestamp_utc"], ignore_index=True)
+    )
+
+
+def test_batches_match_whole_frame(readings_df):
+    temporal = TemporalFeatures.from_dataclass_config(CONFIG)
+    batches_df = pd.concat(
+        temporal.execute_batches(
+            day_df for _, day_df in readings_df.groupby(["parameter", "day"])
+        )
+    )
+    pd.testing.assert_frame_equal(
+        batches_df.sort_index()[CONFIG.FEATURE_NAMES],
+        temporal.execute(readings_df)[CONFIG.FEATURE_NAMES],
+        check_dtype=False,
+        # the windows' prefix sums start at different readings, so the
+        # variance of nearly constant windows differs in the low digits
+        rtol=1e-3,
+    )
+
+
+def reference_features(df: pd.DataFrame) -> pd.DataFrame:
+    """The features from each sensor's hourly series with pandas groupby"""
+    df = df.assign(step=pd.to_datetime(df.timestamp_utc, utc=True).dt.floor("1h"))
+    features_dfs = []
+    for _, sensor_df in df.groupby(CONFIG.ENTITY_COLS):
+        steps = sensor_df.groupby("step").value.mean()
+        hourly = steps.asfreq("1h")
+        earlier = hourly.shift(1)
+        features_df = pd.DataFrame(index=hourly.index)
+        for lag in CONFIG.LAGS:
+            features_df[f"lag_{lag}"] = hourly.shift(lag)
+        for window in CONFIG.ROLLING_WINDOWS:
+            rolling = earlier.rolling(window, min_periods=1)
+            for stat in CONFIG.ROLLING_STATS:
+                features_df[f"rolling_{window}_{stat}"] = getattr(rolling, stat)()
+        for profile, groups in [
+            ("diurnal", hourly.index.hour),
+            ("weekly", hourly.index.dayofweek),
+        ]:
+            features_df[f"{profile}_mean"] = hourly.groupby(groups).transform(
+                lambda values: values.shift(1).expanding().mean()
+            )
+        features_df["gap_steps"] = steps.index.to_series().diff() / pd.Timedelta("1h")
+        features_dfs.append(sensor_df.join(features_df, on="step"))
+    return pd.concat(features_dfs).sort_index()
+
+
+def test_matches_groupby_reference(readings_df):
+    temporal = TemporalFeatures.from_dataclass_config(CONFIG)
+    pd.testing.assert_frame_equal(
+        temporal.execute(readings_df)[CONFIG.FEATURE_NAMES],
+        reference_features(readings_df)[CONFIG.FEATURE_NAMES],
+        check_dtype=False,
+        # the std from prefix sums of squares loses a few low digits
+        rtol=1e-6,
+        atol=1e-6,
+    )
@@ -0,0 +1,108 @@
+from datetime import date
+
+import pytest
+from dateutil.relativedelta import relativedelta
+from src import time_splitter
+from src.query.partitions import PartitionLayout
+from src.time_splitter import TimeSplitter, time_splits
+
+
+def athena_response(header, rows):
+    return {
+        "ResultSet": {
+            "Rows": [
+                {"Data": [{"VarCharValue": value} for value in row]}
+                for row in [header] + rows
+            ]
+        }
+    }
+
+
+@pytest.fixture
+def splitter():
+    return TimeSplitter(
+        time_window_length=1,
+        within_window_sampler=1,
+        window_count=2,
+        target_variable="pm25",
+        partition_layout=PartitionLayout({"aggregatedate": "%Y-%m-%d"}),
+    )
+
+
+def test_boundary_partition_without_target_falls_back(monkeypatch, splitter):
+    def query_results(params, query):
+        if "$partitions" in query:
+            boundary = "2022-01-01" if "ASC" in query else "2022-12-31"
+            return athena_response(["aggregatedate"], [[boundary]])
+        if "aggregatedate" in query:
+            # the boundary partitions only hold other parameters
+            return athena_response(["datetime"], [])
+        boundary = "2022-01-05" if "ASC" in query else "2022-12-20"
+        return athena_response(["datetime"], [[f"{boundary} 00:00:00.000 UTC"]])
+
+    monkeypatch.setattr(time_splitter, "query_results", query_results)
+    splits = splitter.execute()
+    assert str(splits[0, -1]) == "2022-12-20"
+    assert str(splits[:, 0].min()) == "2022-01-05"
+
+
+def test_no_target_readings_raises(monkeypatch, splitter):
+    monkeypatch.setattr(
+        time_splitter,
+        "query_results",
+        lambda params, query: athena_response(["datetime"], []),
+    )
+    with pytest.raises(ValueError):
+        splitter.execute()
+
+
+def reference_splits(
+    start_date,
+    end_date,
+    validation_length,
+    step,
+    window_count,
+    unit,
+    training_length,
+    gap,
+):
+    """The windows as the original relativedelta loop planned them"""
+    splits = []
+    for window_no in range(window_count):
+        validation_start = end_date - relativedelta(
+            **{unit: window_no * step + validation_length}
+        )
+        validation_end = validation_start + relativedelta(**{unit: validation_length})
+        train_end = validation_start - relativedelta(**{unit: gap})
+        if train_end < start_date:
+            continue
+        train_start = start_date
+        if training_length is not None:
+            train_start = max(
+                start_date, train_end - relativedelta(**{unit: training_length})
+            )
+        splits.append([train_start, train_end, validation_start, validation_end])
+    return splits
+
+
+@pytest.mark.parametrize("end_date", [date(2022, 3, 31), date(2020, 2, 29)])
+@pytest.mark.parametrize("unit", ["months", "weeks", "days"])
+@pytest.mark.parametrize(
+    "training_length, gap",
+    [(None, 0), (4, 0), (6, 1)],
+    ids=["expanding", "rolling", "gap"],
+)
+def test_time_splits_match_relativedelta(end_date, unit, training_length, gap):
+    options = dict(
+        validation_length=2,
+        step=3,
+        window_count=12,
+        unit=unit,
+        training_length=training_length,
+        gap=gap,
+    )
+    start_date = date(2019, 11, 30)
+    splits = time_splits(start_date, end_date, **options)
+    assert splits.astype(object).tolist() == reference_splits(
+        start_date, end_date, **options
+    )
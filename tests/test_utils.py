@@ -0,0 +1,72 @@
+from dataclasses import replace
+
+import pytest
+from src.utils import utils
+
+
+def test_failed_query_raises(monkeypatch, fake_athena):
+    config = replace(fake_athena, FAKE_ATHENA_FAILURE_RATE=1.0)
+    monkeypatch.setattr(utils, "BackendConfig", lambda: config)
+    params = dict(region="region", bucket="bucket", path="path")
+    with pytest.raises(RuntimeError, match="Injected failure"):
+        utils.query_results(params, "SELECT 1")
+    with pytest.raises(RuntimeError):
+        list(utils.iter_query_result_pages(params, "SELECT 1"))
+
+
+def test_polls_until_the_query_succeeds(monkeypatch, fake_athena):
+    config = replace(fake_athena, FAKE_ATHENA_EXECUTION_SECONDS=0.3)
+    monkeypatch.setattr(utils, "BackendConfig", lambda: config)
+    polls = []
+    get_athena_client = utils.get_athena_client
+
+    def counting_client(region, config):
+        client = get_athena_client(region, config)
+        get_query_execution = client.get_query_execution
+
+        def poll(**kwargs):
+            polls.append(kwargs)
+            return get_query_execution(**kwargs)
+
+        client.get_query_execution = poll
+        return client
+
+    monkeypatch.setattr(utils, "get_athena_client", counting_client)
+    response = utils.query_results(
+        dict(region="region", bucket="bucket", path="path"), "SELECT 1"
+    )
+    assert response["ResultSet"]["Rows"][1]["Data"][0]["VarCharValue"] == "1"
+    # the polls sleep between them rather than spinning
+    assert 1 < len(polls) < 10
+
+
+def test_replays_every_recorded_page(tmp_path, monkeypatch, fake_athena):
+    from src.backends.fake_athena import PAGE_SIZE, FakeAthenaClient
+
+    get_athena_client = utils.get_athena_client
+    params = dict(region="region", bucket="bucket", path="path")
+    query = "SELECT * FROM openaq"
+    # the fake computing the results stands in for athena while recording
+    recording_config = replace(
+        fake_athena, ATHENA_BACKEND="aws", ATHENA_RECORDINGS_DIR=str(tmp_path)
+    )
+    monkeypatch.setattr(utils, "BackendConfig", lambda: recording_config)
+    monkeypatch.setattr(
+        utils,
+        "get_athena_client",
+        lambda region, config: FakeAthenaClient.from_dataclass_config(fake_athena),
+    )
+    recorded_pages = list(utils.iter_query_result_pages(params, query))
+    assert len(recorded_pages) > 1
+
+    # replayed from the recording, not from a table of other rows
+    replay_config = replace(
+        fake_athena, ATHENA_RECORDINGS_DIR=str(tmp_path), FAKE_ATHENA_ROWS=10
+    )
+    monkeypatch.setattr(utils, "BackendConfig", lambda: replay_config)
+    monkeypatch.setattr(utils, "get_athena_client", get_athena_client)
+    replayed_pages = list(utils.iter_query_result_pages(params, query))
+    assert [page["ResultSet"]["Rows"] for page in replayed_pages] == [
+        page["ResultSet"]["Rows"] for page in recorded_pages
+    ]
+    assert sum(len(page["ResultSet"]["Rows"]) for page in replayed_pages) > PAGE_SIZE